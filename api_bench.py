@@ -0,0 +1,331 @@
+'''Load test and latency benchmark for the games and auth APIs
+
+Simulated players register, log in, and play full games (POST, GET, PUTs
+until the game ends, DELETE) from concurrent threads.  Latency percentiles
+and requests/sec are reported per endpoint, and can be saved as a baseline
+JSON file and compared against later runs.
+
+In-process, against the Flask test client (uses ``FLASK_ENV``, e.g.,
+``dev_lite`` or ``dev_postgres``, and ``FLASK_JWT_SECRET_KEY``)::
+
+    python api_bench.py --players 8 --games 5 --save bench_baseline.json
+
+Against a running server, e.g., a local gunicorn::
+
+    gunicorn -w 4 -b 127.0.0.1:8000 server.app:app
+    python api_bench.py --url http://127.0.0.1:8000 --compare bench_baseline.json
+
+With ``--compare``, the exit status is 1 if any endpoint's p95 latency or
+throughput is worse than the baseline by more than ``--tolerance``.
+
+With ``--logins N`` each player instead registers once and logs in N
+times, and logins/sec are reported.  In-process, ``--hash-setting`` (e.g.,
+``scrypt:16384`` or ``pbkdf2-sha256:200000``, repeatable) reruns this for
+each password hashing scheme and cost::
+
+    python api_bench.py --players 16 --logins 10 --hash-setting scrypt:16384 \
+        --hash-setting scrypt:32768 --hash-setting pbkdf2-sha256:200000
+
+With ``--statements`` (in-process), one player starts ``--games`` games
+and the SQL statements and commits each game POST sends to the games DB
+are reported, for the first game (which creates the player's record)
+and the later ones::
+
+    python api_bench.py --statements --games 20
+'''
+import argparse
+import collections
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+LETTERS = 'etaoinshrdlcumwfgypbvkjxqz'
+
+class InProcessClient:
+    '''Sends requests through the Flask test client of ``server.app``, with
+    each thread coming from its own client address'''
+    def __init__(self):
+        from server.app import app
+        app.config['TESTING'] = True
+        self.app = app
+        self._local = threading.local()
+        self._clients = itertools.count(1)
+
+    def request(self, method, path, token=None, body=None):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            n = next(self._clients)
+            client = self._local.client = self.app.test_client()
+            self._local.address = '10.{}.{}.{}'.format(n >> 16 & 255, n >> 8 & 255, n & 255)
+        headers = {'Content-Type': 'application/json'}
+        if token:
+            headers['Authorization'] = 'Bearer ' + token
+        response = client.open(path, method=method, headers=headers,
+                               environ_base={'REMOTE_ADDR': self._local.address},
+                               data=None if body is None else json.dumps(body))
+        data = response.get_data(as_text=True)
+        return response.status_code, json.loads(data) if data else None
+
+class HttpClient:
+    '''Sends requests to a server at ``base_url``'''
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def request(self, method, path, token=None, body=None):
+        headers = {'Content-Type': 'application/json'}
+        if token:
+            headers['Authorization'] = 'Bearer ' + token
+        request = urllib.request.Request(
+            self.base_url + path, method=method, headers=headers,
+            data=None if body is None else json.dumps(body).encode())
+        try:
+            with urllib.request.urlopen(request) as response:
+                status, data = response.status, response.read()
+        except urllib.error.HTTPError as error:
+            status, data = error.code, error.read()
+        return status, json.loads(data.decode()) if data else None
+
+class Recorder:
+    '''Collects request latencies by endpoint label'''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def call(self, client, label, method, path, token=None, body=None, expect=(200,)):
+        start = time.perf_counter()
+        status, data = client.request(method, path, token, body)
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.latencies.setdefault(label, []).append(elapsed)
+            if status not in expect:
+                self.errors[label] = self.errors.get(label, 0) + 1
+        return status, data
+
+def register(client, recorder, player):
+    '''Register and log in as a new user; return the access token or None'''
+    name = 'bench-{}-{}'.format(player, random.randrange(10**9))
+    recorder.call(client, 'POST /api/auth', 'POST', '/api/auth',
+                  body={'username': name, 'password': 'bench'})
+    status, data = recorder.call(client, 'PUT /api/auth', 'PUT', '/api/auth',
+                                 body={'username': name, 'password': 'bench'})
+    return data['access_token'] if status == 200 else None
+
+def play(client, recorder, player, games, language):
+    '''Register and log in as a new user, then play ``games`` full games'''
+    token = register(client, recorder, player)
+    if token is None:
+        return
+    for _ in range(games):
+        lang = language or random.choice(('en', 'es', 'fr'))
+        status, data = recorder.call(client, 'POST /api/games', 'POST', '/api/games',
+                                     token, {'language': lang})
+        if status != 200:
+            continue
+        path = '/api/games/' + data['game_id']
+        status, game = recorder.call(client, 'GET /api/games/<id>', 'GET', path, token)
+        if status != 200:
+            continue
+        game_token = game['access_token']
+        letters = list(LETTERS)
+        while game['result'] == 'active' and letters:
+            letter = letters.pop(random.randrange(min(len(letters), 8)))
+            status, data = recorder.call(client, 'PUT /api/games/<id>', 'PUT', path,
+                                         game_token, {'letter': letter})
+            if status != 200:
+                break
+            game = data
+        recorder.call(client, 'DELETE /api/games/<id>', 'DELETE', path, game_token)
+
+def login_storm(client, recorder, player, logins):
+    '''Register as a new user, then log in ``logins`` times'''
+    name = 'bench-{}-{}'.format(player, random.randrange(10**9))
+    recorder.call(client, 'POST /api/auth', 'POST', '/api/auth',
+                  body={'username': name, 'password': 'bench'})
+    for _ in range(logins):
+        recorder.call(client, 'PUT /api/auth', 'PUT', '/api/auth',
+                      body={'username': name, 'password': 'bench'})
+
+def hash_options(setting):
+    '''Return the ``PASSWORDS`` options for a ``SCHEME:COST`` setting'''
+    scheme, _, cost = setting.partition(':')
+    options = {'scheme': scheme}
+    if cost:
+        options['scrypt_n' if scheme == 'scrypt' else 'pbkdf2_iterations'] = int(cost)
+    return options
+
+def percentile(values, p):
+    '''Nearest-rank ``p``-th percentile of the sorted list ``values``'''
+    index = max(0, min(len(values) - 1, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+def summarize(recorder, wall_time):
+    '''Return the per-endpoint statistics of a run as a dict'''
+    summary = {}
+    for label, latencies in sorted(recorder.latencies.items()):
+        latencies = sorted(latencies)
+        summary[label] = {
+            'count': len(latencies),
+            'errors': recorder.errors.get(label, 0),
+            'rps': len(latencies) / wall_time,
+            'p50_ms': 1000 * percentile(latencies, 50),
+            'p95_ms': 1000 * percentile(latencies, 95),
+            'p99_ms': 1000 * percentile(latencies, 99),
+        }
+    return summary
+
+def report(summary, out=sys.stdout):
+    out.write('{:<24} {:>7} {:>6} {:>9} {:>9} {:>9} {:>9}\n'.format(
+        'endpoint', 'count', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for label, s in summary.items():
+        out.write('{:<24} {:>7} {:>6} {:>9.1f} {:>9.2f} {:>9.2f} {:>9.2f}\n'.format(
+            label, s['count'], s['errors'], s['rps'], s['p50_ms'],
+            s['p95_ms'], s['p99_ms']))
+
+def compare(summary, baseline, tolerance, out=sys.stdout):
+    '''Print and return the endpoints whose p95 latency or throughput is
+    worse than ``baseline`` by more than the fraction ``tolerance``'''
+    regressions = []
+    for label, s in summary.items():
+        b = baseline.get(label)
+        if b is None:
+            continue
+        if s['p95_ms'] > b['p95_ms'] * (1 + tolerance):
+            regressions.append('{}: p95 {:.2f} ms vs baseline {:.2f} ms'.format(
+                label, s['p95_ms'], b['p95_ms']))
+        if s['rps'] < b['rps'] * (1 - tolerance):
+            regressions.append('{}: {:.1f} req/s vs baseline {:.1f} req/s'.format(
+                label, s['rps'], b['rps']))
+    for line in regressions:
+        out.write('REGRESSION ' + line + '\n')
+    return regressions
+
+def run_threads(players, target, *args):
+    '''Run ``target(i, *args)`` in ``players`` concurrent threads and
+    return the wall time'''
+    threads = [ threading.Thread(target=target, args=(i,) + args)
+                for i in range(players) ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start
+
+def run(client, players, games, language=None):
+    '''Run ``players`` concurrent players for ``games`` games each and return
+    the summary'''
+    recorder = Recorder()
+    wall_time = run_threads(players, lambda i: play(client, recorder, i, games, language))
+    return summarize(recorder, wall_time)
+
+def run_logins(client, players, logins, settings=(None,), out=sys.stdout):
+    '''Run a login storm for each password hash setting (None for the
+    server's own) and print and return logins/sec and latencies by setting'''
+    results = {}
+    out.write('{:<24} {:>7} {:>6} {:>9} {:>9} {:>9}\n'.format(
+        'hash setting', 'logins', 'errors', 'logins/s', 'p50 ms', 'p95 ms'))
+    for setting in settings:
+        if setting is not None:
+            from server.passwords import passwords
+            passwords.configure({'PASSWORDS': dict(
+                client.app.config.get('PASSWORDS') or {}, **hash_options(setting))})
+        recorder = Recorder()
+        wall_time = run_threads(players, lambda i: login_storm(client, recorder, i, logins))
+        s = results[setting or 'server'] = summarize(recorder, wall_time)['PUT /api/auth']
+        out.write('{:<24} {:>7} {:>6} {:>9.1f} {:>9.2f} {:>9.2f}\n'.format(
+            setting or 'server', s['count'], s['errors'], s['rps'],
+            s['p50_ms'], s['p95_ms']))
+    return results
+
+def count_statements(client, games, out=sys.stdout):
+    '''Start ``games`` games for one new player and print and return the
+    SQL statements and commits per game POST, counted by SQLAlchemy events
+    on the games engine (in-process only).  The first POST also creates
+    the player's ``users`` row.'''
+    from sqlalchemy import event
+    from server.db import registry
+    engine = registry.engine('DB_GAMES')
+    counts = collections.Counter()
+    def statement(*args):
+        counts['statements'] += 1
+    def commit(*args):
+        counts['commits'] += 1
+    event.listen(engine, 'before_cursor_execute', statement)
+    event.listen(engine, 'commit', commit)
+    recorder = Recorder()
+    results = {'new player': [], 'returning player': []}
+    try:
+        token = register(client, recorder, 0)
+        for i in range(games):
+            counts.clear()
+            recorder.call(client, 'POST /api/games', 'POST', '/api/games',
+                          token, {'language': random.choice(('en', 'es', 'fr'))})
+            results['returning player' if i else 'new player'].append(dict(counts))
+    finally:
+        event.remove(engine, 'before_cursor_execute', statement)
+        event.remove(engine, 'commit', commit)
+    out.write('{:<18} {:>6} {:>11} {:>8}\n'.format('POST /api/games', 'posts',
+                                                  'statements', 'commits'))
+    for label, posts in results.items():
+        if posts:
+            out.write('{:<18} {:>6} {:>11.1f} {:>8.1f}\n'.format(
+                label, len(posts),
+                sum(p.get('statements', 0) for p in posts) / len(posts),
+                sum(p.get('commits', 0) for p in posts) / len(posts)))
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', help='base url of a running server '
+                        '(default: in-process test client)')
+    parser.add_argument('--players', type=int, default=4,
+                        help='concurrent simulated players')
+    parser.add_argument('--games', type=int, default=5, help='games per player')
+    parser.add_argument('--language', choices=('en', 'es', 'fr'),
+                        help='play only this language')
+    parser.add_argument('--save', metavar='FILE', help='save results as a baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare with a baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed fractional slowdown before a regression')
+    parser.add_argument('--logins', type=int,
+                        help='only register and log in this many times per player')
+    parser.add_argument('--hash-setting', action='append', metavar='SCHEME:COST',
+                        help='password hashing to benchmark logins with (in-process)')
+    parser.add_argument('--statements', action='store_true',
+                        help='only count SQL statements and commits per game '
+                             'POST (in-process)')
+    args = parser.parse_args(argv)
+    if args.hash_setting and (args.url or not args.logins):
+        parser.error('--hash-setting needs --logins and the in-process client')
+    if args.statements and args.url:
+        parser.error('--statements needs the in-process client')
+
+    client = HttpClient(args.url) if args.url else InProcessClient()
+    if args.logins:
+        run_logins(client, args.players, args.logins, args.hash_setting or (None,))
+        return 0
+    if args.statements:
+        count_statements(client, args.games)
+        return 0
+    summary = run(client, args.players, args.games, args.language)
+    report(summary)
+    if not args.url:
+        from server.tokens import tokens
+        print('tokens', ', '.join('{}={}'.format(k, v) for k, v in tokens.stats().items()))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(summary, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(summary, json.load(f), args.tolerance):
+                return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -97,3 +97,653 @@ def test_full_random_game(test_app):
 def test_multiple_games(test_app):   # takes about 1s
     for i in range(10):
         test_full_random_game(test_app)
+
+def login(test_app):
+    '''Register a new random user and return an access token for them.'''
+    username = 'test-' + random_string() + str(random.random())
+    response = test_app.post(
+        '/api/auth',
+        data = json.dumps(dict(username=username, password='secret')),
+        headers = {'Content-Type': 'application/json'}
+    )
+    assert response.status_code == 200, 'Error registering test user'
+    return json.loads(response.data.decode())['access_token']
+
+def start_game(test_app, language='en'):
+    '''Start a game for a new user; return the game id and game token.'''
+    headers = {'Content-Type': 'application/json',
+               'Authorization': 'Bearer ' + login(test_app)}
+    response = test_app.post('/api/games', headers=headers,
+                             data=json.dumps(dict(language=language)))
+    assert response.status_code == 200, 'Error when POSTing to start new game'
+    game = json.loads(response.data.decode())
+    return game['game_id'], game['access_token']
+
+def test_batch_guesses(test_app):
+    '''Guess several letters at once, including invalid and repeated ones,
+    and check each gets the status a single PUT would.'''
+    game_id, token = start_game(test_app)
+    headers = {'Content-Type': 'application/json',
+               'Authorization': 'Bearer ' + token}
+    response = test_app.put(
+        '/api/games/' + game_id + '/guesses', headers=headers,
+        data = json.dumps(dict(letters=['e', 'E', '7', 'xy'] + list('zqjkvwbfgpmhcd')))
+    )
+    assert response.status_code == 200, 'Error in PUT of several letters'
+    game = json.loads(response.data.decode())
+    statuses = [ r['status'] for r in game['results'] ]
+    assert statuses[:4] == [200, 403, 400, 400]
+    assert game['guessed'] == ''.join(sorted([ r['letter'] for r in game['results']
+                                               if r['status'] == 200 ]))
+    assert game['bad_guesses'] == len([ r for r in game['results']
+                                        if r['status'] == 200 and not r['correct'] ])
+    assert game['bad_guesses'] <= 6, 'Guesses after the game ends should be forbidden'
+    from server.game_store import game_store
+    game_store.flush()
+    assert _stored_game(game_id).guess_order == ''.join(
+        r['letter'] for r in game['results'] if r['status'] == 200)
+
+def test_etag(test_app):
+    '''A game GET repeated with its ETag gets an empty 304 until a guess
+    changes the game.'''
+    user_headers = {'Content-Type': 'application/json',
+                    'Authorization': 'Bearer ' + login(test_app)}
+    response = test_app.post('/api/games', headers=user_headers,
+                             data=json.dumps(dict(language='en')))
+    game = json.loads(response.data.decode())
+    url = '/api/games/' + game['game_id']
+    response = test_app.get(url, headers=user_headers)
+    etag = response.headers['ETag']
+    response = test_app.get(url, headers=dict(user_headers, **{'If-None-Match': etag}))
+    assert response.status_code == 304 and response.data == b''
+    assert response.headers['ETag'] == etag
+
+    from server.tokens import tokens
+    tokens.configure(app.config)   # as another worker would
+    response = test_app.get(url, headers=user_headers)
+    assert response.headers['ETag'] == etag, 'Every worker should give the same tag'
+
+    test_app.put(url, data=json.dumps(dict(letter='e')),
+                 headers={'Content-Type': 'application/json',
+                          'Authorization': 'Bearer ' + game['access_token']})
+    response = test_app.get(url, headers=dict(user_headers, **{'If-None-Match': etag}))
+    assert response.status_code == 200, 'A guess should change the ETag'
+    assert response.headers['ETag'] != etag
+
+def test_history_and_stats(test_app):
+    '''Play a few games as one user, then page through their history and
+    check their statistics.'''
+    token = login(test_app)
+    headers = {'Content-Type': 'application/json',
+               'Authorization': 'Bearer ' + token}
+    game_ids = []
+    for language in ('en', 'es', 'fr'):
+        response = test_app.post('/api/games', headers=headers,
+                                 data=json.dumps(dict(language=language)))
+        game_ids.append(json.loads(response.data.decode())['game_id'])
+
+    seen, after = [], ''
+    while after is not None:
+        response = test_app.get('/api/users/me/games?limit=2&after=' + after,
+                                headers=headers)
+        assert response.status_code == 200, 'Error in GET of game history'
+        page = json.loads(response.data.decode())
+        assert len(page['games']) <= 2
+        seen.extend([ game['game_id'] for game in page['games'] ])
+        after = page['next']
+    assert seen == game_ids[::-1], 'History should list all games, newest first'
+
+    response = test_app.get('/api/users/me/stats', headers=headers)
+    stats = json.loads(response.data.decode())
+    assert stats['num_games'] == 3
+    assert stats['outcomes']['active'] == 3
+    assert stats['by_lang'] == {'en': 1, 'es': 1, 'fr': 1}
+
+def test_search(test_app):
+    '''Search ignores accents, and its pages do not overlap.'''
+    headers = {'Authorization': 'Bearer ' + login(test_app)}
+    found = []
+    for q in ('ecole', 'ÉCOLE'):
+        response = test_app.get('/api/usages/search?lang=fr&q=' + q, headers=headers)
+        assert response.status_code == 200, 'Error searching usages'
+        found.append([ u['usage_id'] for u in json.loads(response.data.decode())['usages'] ])
+    assert found[0] and found[0] == found[1]
+
+    seen, after = [], ''
+    for _ in range(3):
+        response = test_app.get('/api/usages/search?q=the&limit=5' + after,
+                                headers=headers)
+        page = json.loads(response.data.decode())
+        seen += [ u['usage_id'] for u in page['usages'] ]
+        after = '&after=' + page['next']
+    assert len(seen) == len(set(seen)) == 15
+
+def test_difficulty(test_app):
+    '''Start games at each difficulty and check the puzzle comes from the
+    matching bucket of the usage index.'''
+    from server.usage_index import usage_index
+    headers = {'Content-Type': 'application/json',
+               'Authorization': 'Bearer ' + login(test_app)}
+    for difficulty in ('easy', 'medium', 'hard'):
+        response = test_app.post('/api/games', headers=headers,
+                                 data=json.dumps(dict(language='fr', difficulty=difficulty)))
+        assert response.status_code == 200, 'Error when POSTing with a difficulty'
+        game_id = json.loads(response.data.decode())['game_id']
+        response = test_app.get('/api/games/' + game_id, headers=headers)
+        usage_id = json.loads(response.data.decode())['usage_id']
+        assert usage_id in usage_index.ids('fr', difficulty)
+
+    response = test_app.post('/api/games', headers=headers,
+                             data=json.dumps(dict(language='fr', difficulty='extreme')))
+    assert response.status_code == 400, 'Unknown difficulty should be refused'
+
+def test_no_repeats():
+    '''Picking with a seen-set serves every usage of a bucket once before
+    any repeats.'''
+    from server.usage_index import usage_index, SeenSet
+    ids = usage_index.ids('es', 'easy')
+    seen = SeenSet()
+    picked = [ usage_index.random('es', 'easy', seen).usage_id for _ in ids ]
+    assert sorted(picked) == sorted(ids)
+    usage_id = usage_index.random('es', 'easy', seen).usage_id
+    assert [ i for i in ids if i in SeenSet(seen.to_bytes()) ] == [usage_id]
+
+def test_usage_index_sources(monkeypatch):
+    '''The usage index reads the CSV only when the usages table is empty; a
+    database error is raised on the first load and keeps the loaded corpus
+    on a reload.'''
+    from sqlalchemy.exc import OperationalError
+    from server.usage_index import UsageIndex
+    index = UsageIndex()
+    index.configure({'DB_USAGE': 'sqlite:///unused.db'})
+    monkeypatch.setattr(UsageIndex, '_read_db', lambda self: [])
+    index.reload()
+    assert len(index) > 0, 'An empty table should fall back to the CSV'
+
+    def fail(self):
+        raise OperationalError('SELECT', {}, Exception('no such table: usages'))
+    monkeypatch.setattr(UsageIndex, '_read_db', fail)
+    loaded = index.rows()
+    index.reload()
+    assert index.rows() is loaded, 'A failed reload should keep the corpus'
+    index.configure({'DB_USAGE': 'sqlite:///unused.db'})
+    with pytest.raises(OperationalError):
+        index.reload()
+
+def _guess(state, letters):
+    '''Apply the guesses ``letters`` to the game ``state``, as a PUT does'''
+    from server.langman_orm import LETTER_BITS
+    from server.usage_index import usage_index
+    guess = usage_index.get(state.usage_id).guess
+    for letter in letters:
+        state.guessed_mask |= LETTER_BITS[letter]
+        if not guess.is_good(letter):
+            state.bad_guesses += 1
+
+def _stored_game(game_id):
+    from server.db import registry
+    from server.langman_orm import Game
+    games = Game.__table__
+    return registry.engine('DB_GAMES').execute(
+        games.select().where(games.c.game_id == game_id)).first()
+
+def test_game_store_flush_and_eviction(test_app, tmp_path):
+    '''Guesses stay in the cache and its replay log until a flush, which
+    also empties the log; the background thread flushes by itself; a
+    finished game leaves the cache only once its commit succeeds.'''
+    import datetime, time
+    from server.db import registry
+    from server.game_store import GameStore
+    from server.usage_index import usage_index
+    store = GameStore()
+    store.configure({'GAME_STORE': {'backend': 'memory', 'path': str(tmp_path),
+                                    'flush_interval': 3600}})
+    session = registry.session('DB_GAMES')
+    game_id, _ = start_game(test_app)
+    state = store.load(session, game_id)
+    _guess(state, 'e')
+    store.save(session, state)
+    replay = tmp_path / 'games-{}.jsonl'.format(os.getpid())
+    assert _stored_game(game_id).guessed_mask == 0, 'A guess should wait for a flush'
+    assert len(replay.read_text().splitlines()) == 1
+    assert store.flush() == 1
+    assert _stored_game(game_id).guessed_mask == state.guessed_mask
+    assert replay.read_text() == '', 'A flush should compact the replay log'
+
+    store.configure({'GAME_STORE': {'backend': 'memory', 'path': str(tmp_path),
+                                    'flush_interval': 0.05}})
+    state = store.load(session, game_id)
+    _guess(state, 'a')
+    store.save(session, state)
+    for _ in range(100):
+        if _stored_game(game_id).guessed_mask == state.guessed_mask:
+            break
+        time.sleep(0.02)
+    assert _stored_game(game_id).guessed_mask == state.guessed_mask, \
+        'The background thread should flush without further requests'
+
+    active_mask = state.guessed_mask
+    guess = usage_index.get(state.usage_id).guess
+    _guess(state, [ letter for letter in 'zqxjkvwyfbgpmhcduoi'
+                    if not guess.is_good(letter) ][:6 - state.bad_guesses])
+    assert state._result() == 'lost'
+    assert store.end(session, state, datetime.datetime.now())
+    session.rollback()
+    assert store.cached(game_id).guessed_mask == active_mask, \
+        'A failed commit should leave the game in the cache as it was'
+    assert _stored_game(game_id).end_time is None
+    assert store.end(session, state, datetime.datetime.now())
+    session.commit()
+    store.committed(state)
+    assert store.cached(game_id) is None
+    assert _stored_game(game_id).end_time is not None
+    store.configure({})
+
+def test_game_store_crash_replay(test_app, tmp_path):
+    '''The replay log of a worker that died is written to the games DB,
+    torn final line and all, before the next worker serves the game.'''
+    import subprocess, sys
+    from server.db import registry
+    from server.game_store import GameStore, game_to_state
+    from server.langman_orm import Game, GameState
+    dead = subprocess.Popen([sys.executable, '-c', ''])
+    dead.wait()
+    game_id, _ = start_game(test_app)
+    session = registry.session('DB_GAMES')
+    state = GameState.from_game(session.query(Game).filter(Game.game_id == game_id).one())
+    session.rollback()
+    lines = []
+    for letter in 'ea':
+        _guess(state, letter)
+        lines.append(json.dumps(game_to_state(state)))
+    replay = tmp_path / 'games-{}.jsonl'.format(dead.pid)
+    replay.write_text('\n'.join(lines) + '\n{"game_id": "')
+
+    store = GameStore()
+    store.configure({'GAME_STORE': {'backend': 'memory', 'path': str(tmp_path),
+                                    'flush_interval': 3600}})
+    assert store.load(session, game_id).guessed_mask == state.guessed_mask
+    assert _stored_game(game_id).guessed_mask == state.guessed_mask
+    assert not replay.exists(), 'A replayed log should be removed'
+    store.configure({})
+
+def test_game_time_totals(test_app):
+    '''Games of one player ending in separate sessions, each loaded before
+    the other committed, both count towards the total and average time.'''
+    import datetime, uuid
+    from server.db import registry
+    from server.langman_orm import User
+    from sqlalchemy.orm import Session
+    engine = registry.engine('DB_GAMES')
+    user_id = str(uuid.uuid4())
+    session = Session(bind=engine)
+    session.add(User(user_id=user_id, user_name='timer', num_games=2,
+                     outcome_active=2, total_micros=1000000))
+    session.commit()
+    session.close()
+    first, second = Session(bind=engine), Session(bind=engine)
+    players = [ session.query(User).get(user_id) for session in (first, second) ]
+    for session, player, seconds in zip((first, second), players, (90.25, 30.5)):
+        player._game_ended('lost', datetime.timedelta(seconds=seconds))
+        session.commit()
+        session.close()
+    player = Session(bind=engine).query(User).get(user_id)
+    assert player.total_time == datetime.timedelta(seconds=121.75)
+    assert player.avg_time == datetime.timedelta(seconds=121.75 / 2)
+    assert (player.outcome_active, player.outcome_lost) == (0, 2)
+
+def test_leaderboard_rollover(test_app):
+    '''As the day rolls over, recording a game prunes the day and week
+    periods past retention and keeps the all-time row.'''
+    import datetime, types, uuid
+    from flask import current_app
+    from server.db import registry
+    from server.langman_orm import Ranking
+    from server.leaderboard import leaderboard, record_game
+    session = registry.session('DB_GAMES')
+    player = types.SimpleNamespace(user_id=str(uuid.uuid4()), user_name='roller')
+    leaderboard.keep_days, leaderboard.keep_weeks = 2, 1
+    monday = datetime.datetime(2020, 3, 2, 12)
+    try:
+        kept = []
+        for days in (0, 1, 2, 7):
+            record_game(session, player, 'en', 'won', datetime.timedelta(seconds=60),
+                        monday + datetime.timedelta(days=days))
+            session.commit()
+            kept.append(sorted(period for period, in session.query(Ranking.period).filter(
+                Ranking.user_id == player.user_id, Ranking.lang == 'en')))
+    finally:
+        leaderboard.configure(current_app.config)
+    assert kept == [['all', 'd2020-03-02', 'w2020-10'],
+                    ['all', 'd2020-03-02', 'd2020-03-03', 'w2020-10'],
+                    ['all', 'd2020-03-03', 'd2020-03-04', 'w2020-10'],
+                    ['all', 'd2020-03-09', 'w2020-11']]
+    assert session.query(Ranking.games).filter(
+        Ranking.user_id == player.user_id, Ranking.period == 'all',
+        Ranking.lang == 'en').scalar() == 4
+
+def test_leaderboard_ties(test_app):
+    '''Players tied on the sort key are ranked by average time, then by
+    user_id, whatever order their rows were written in.'''
+    import datetime
+    from server.db import registry
+    from server.langman_orm import Ranking
+    from server.leaderboard import leaderboard
+    session = registry.session('DB_GAMES')
+    rows = [ ('c', 30.0), ('a', 30.0), ('d', 10.0), ('b', 30.0) ]
+    for user_id, seconds in rows:
+        session.add(Ranking(period='d1999-01-01', lang='xx', user_id='tie-' + user_id,
+                            user_name=user_id, games=5, wins=3, total_seconds=5 * seconds,
+                            win_rate=0.6, avg_seconds=seconds))
+    session.commit()
+    try:
+        for sort in ('wins', 'win_rate', 'avg_time'):
+            leaders = leaderboard.top(session, 'xx', 'day', sort, 10,
+                                      datetime.datetime(1999, 1, 1))
+            assert [ l['user_name'] for l in leaders ] == ['d', 'a', 'b', 'c']
+    finally:
+        session.query(Ranking).filter(Ranking.lang == 'xx').delete()
+        session.commit()
+
+def test_token_verify_cache(test_app):
+    '''A token reused on protected views is verified once; a tampered one
+    is still refused, and flask_jwt_extended itself is left as it was.'''
+    import flask_jwt_extended.view_decorators as jwt_views
+    from flask_jwt_extended.utils import decode_token
+    from server.tokens import tokens
+    assert jwt_views.decode_token is decode_token
+    token = login(test_app)
+    before = tokens.stats()
+    for _ in range(3):
+        response = test_app.get('/api/users/me/stats',
+                                headers={'Authorization': 'Bearer ' + token})
+        assert response.status_code == 200
+    after = tokens.stats()
+    assert after['verified'] - before['verified'] == 1
+    assert after['verify_cached'] - before['verify_cached'] == 2
+    response = test_app.get('/api/users/me/stats',
+                            headers={'Authorization': 'Bearer ' + token[:-2] + 'xx'})
+    assert response.status_code in (401, 422)
+
+def test_reap_idle(test_app):
+    '''The reaper abandons games by their last guess, not their age, counts
+    each once, and a game it abandoned while loaded cannot then end.'''
+    import datetime
+    from server.db import registry
+    from server.game_store import game_store
+    from server.langman_orm import Game, User
+    from server.reaper import reap_idle
+    engine = registry.engine('DB_GAMES')
+    games = Game.__table__
+    now = datetime.datetime.now()
+    days_ago = lambda n: now - datetime.timedelta(days=n)
+    old_idle, old_played = start_game(test_app)[0], start_game(test_app)[0]
+    engine.execute(games.update().where(games.c.game_id == old_idle)
+                   .values(start_time=days_ago(3), last_move=days_ago(2)))
+    engine.execute(games.update().where(games.c.game_id == old_played)
+                   .values(start_time=days_ago(3), last_move=now))
+    session = registry.session('DB_GAMES')
+    loaded = session.query(Game).filter(Game.game_id == old_idle).one()
+
+    reap_idle(engine, days_ago(1))
+    assert _stored_game(old_idle).end_time is not None
+    assert _stored_game(old_played).end_time is None, 'A game played lately is not idle'
+    player = registry.session('DB_GAMES').query(User).get(loaded.player)
+    assert (player.outcome_active, player.outcome_abandoned) == (0, 1)
+    assert not game_store.end(session, loaded, now), \
+        'A game abandoned since it was loaded should not end again'
+    session.rollback()
+    reap_idle(engine, days_ago(1))
+    session.expire_all()
+    assert (player.outcome_active, player.outcome_abandoned) == (0, 1)
+
+def test_asgi_app(test_app):
+    '''The ASGI app serves the Flask views, a request body sent in parts
+    included, and answers the lifespan events.'''
+    import asyncio
+    from server.app import app as flask_app
+    from server.asgi import AsgiApp
+    asgi = AsgiApp(flask_app, 2)
+    loop = asyncio.new_event_loop()
+
+    def call(scope, messages):
+        sent = []
+        async def receive():
+            return messages.pop(0) if messages else {'type': 'http.disconnect'}
+        async def send(message):
+            sent.append(message)
+        loop.run_until_complete(asgi(scope, receive, send))
+        return sent
+
+    def http(method, path, body=b'', headers=()):
+        scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+                 'method': method, 'scheme': 'http', 'path': path,
+                 'raw_path': path.encode(), 'query_string': b'', 'root_path': '',
+                 'headers': [(b'host', b'testserver'),
+                             (b'content-type', b'application/json'),
+                             (b'content-length', str(len(body)).encode())] + list(headers),
+                 'client': ('127.0.0.1', 50000), 'server': ('testserver', 80)}
+        half = len(body) // 2
+        sent = call(scope, [
+            {'type': 'http.request', 'body': body[:half], 'more_body': True},
+            {'type': 'http.request', 'body': body[half:], 'more_body': False}])
+        assert sent[0]['type'] == 'http.response.start'
+        return sent[0]['status'], b''.join(m.get('body', b'') for m in sent[1:])
+
+    status, content = http('POST', '/api/auth', json.dumps(dict(
+        username='asgi-' + str(random.random()), password='secret')).encode())
+    assert status == 200, 'Error registering through the ASGI app'
+    token = json.loads(content.decode())['access_token']
+    status, content = http('GET', '/api/users/me/stats',
+                           headers=[(b'authorization', b'Bearer ' + token.encode())])
+    assert status == 200 and json.loads(content.decode())['num_games'] == 0
+
+    sent = call({'type': 'lifespan', 'asgi': {'version': '3.0'}},
+                [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}])
+    assert [ m['type'] for m in sent ] == ['lifespan.startup.complete',
+                                           'lifespan.shutdown.complete']
+    loop.close()
+
+def test_unknown_names_shared(test_app, tmp_path):
+    '''With the sqlite backend, an unknown name remembered by one worker is
+    seen by the others, and a registration through any worker clears it.
+    In this process, a name refused as unknown can log in once registered.'''
+    from server.login_guard import LoginGuard
+    options = {'LOGIN_LIMITS': {'backend': 'sqlite', 'path': str(tmp_path / 'logins.db')}}
+    first, second = LoginGuard(), LoginGuard()
+    first.configure(options)
+    second.configure(options)
+    first.remember_unknown('nobody')
+    assert second.is_unknown('nobody')
+    second.forget_unknown('nobody')
+    assert not first.is_unknown('nobody')
+
+    credentials = dict(username='late-' + str(random.random()), password='secret')
+    headers = {'Content-Type': 'application/json'}
+    response = test_app.put('/api/auth', data=json.dumps(credentials), headers=headers)
+    assert response.status_code == 401
+    response = test_app.post('/api/auth', data=json.dumps(credentials), headers=headers)
+    assert response.status_code == 200
+    response = test_app.put('/api/auth', data=json.dumps(credentials), headers=headers)
+    assert response.status_code == 200, 'A registered name should no longer be unknown'
+
+def test_compact_games_migration(test_app, tmp_path):
+    '''Converting guessed letters keeps them in guess order, counts the
+    accented ones as other misses, keeps the old column in place, and
+    recounts the bad guesses of unfinished games only.'''
+    from sqlalchemy import create_engine, inspect
+    from server.langman_orm import GameState, LETTER_BITS
+    from server.migrations import migrate_compact_games
+    from server.usage_index import usage_index
+    usage = next(u for u in usage_index.rows().values()
+                 if 'e' not in u.secret_word and set(u.secret_word) <= set(LETTER_BITS))
+    wrong = [ l for l in 'zqxjkvwy' if l not in usage.secret_word ][:4]
+    engine = create_engine('sqlite:///' + str(tmp_path / 'old.db'))
+    for table in ('games', 'games_archive'):
+        engine.execute('CREATE TABLE {} (game_id VARCHAR(38) PRIMARY KEY, '
+                       'player VARCHAR(38) NOT NULL, usage_id INTEGER NOT NULL, '
+                       'guessed VARCHAR(30), reveal_word VARCHAR(25) NOT NULL, '
+                       'bad_guesses INTEGER, start_time DATETIME, end_time DATETIME)'
+                       .format(table))
+    insert = ('INSERT INTO games (game_id, player, usage_id, guessed, reveal_word, '
+              'bad_guesses, start_time, end_time) VALUES (?, ?, ?, ?, ?, ?, ?, ?)')
+    blank = '_' * len(usage.secret_word)
+    # 'é' was always a miss, apart from 'e'
+    engine.execute(insert, 'active', 'p', usage.usage_id, 'é' + wrong[0], blank, 5,
+                   '2020-01-01 00:00:00', None)
+    engine.execute(insert, 'lost', 'p', usage.usage_id, ''.join(wrong) + 'ée', blank, 6,
+                   '2020-01-01 00:00:00', '2020-01-01 00:10:00')
+    engine.execute(insert, 'miscounted', 'p', usage.usage_id, wrong[0], blank, 2,
+                   '2020-01-01 00:00:00', '2020-01-01 00:10:00')
+
+    assert migrate_compact_games(engine, usage_index) == 3
+    rows = { row.game_id: row for row in engine.execute('SELECT * FROM games') }
+    assert (rows['active'].guess_order, rows['active'].other_misses) == ('é' + wrong[0], 1)
+    assert rows['active'].bad_guesses == 2, 'An unfinished game is recounted'
+    assert rows['lost'].guess_order == rows['lost'].guessed == ''.join(wrong) + 'ée'
+    assert rows['lost'].bad_guesses == 6
+    assert rows['miscounted'].bad_guesses == 2, 'A finished game keeps its count'
+    states = { game_id: GameState(**{ k: v for k, v in row.items() if k in GameState.FIELDS })
+               for game_id, row in rows.items() }
+    for state in states.values():
+        state.end_time = state.end_time and True
+    states['active']._check_consistent(usage.guess)
+    states['lost']._check_consistent(usage.guess)
+    assert states['lost']._result(usage.guess) == 'lost'
+    with pytest.raises(AssertionError):
+        states['miscounted']._check_consistent(usage.guess)
+    columns = [ c['name'] for c in inspect(engine).get_columns('games') ]
+    assert 'reveal_word' not in columns and 'guessed' in columns
+    assert migrate_compact_games(engine, usage_index) == 0
+
+def test_accented_guesses(test_app):
+    '''An accented letter is a guess of its own: a miss, refused when
+    repeated, and not the same as its base letter.'''
+    game_id, token = start_game(test_app)
+    headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer ' + token}
+    url = '/api/games/' + game_id
+    statuses = []
+    for letter in ('é', 'É', 'e'):
+        response = test_app.put(url, data=json.dumps(dict(letter=letter)), headers=headers)
+        statuses.append(response.status_code)
+    assert statuses == [200, 403, 200]
+    game = json.loads(response.data.decode())
+    assert 'é' in game['guessed'] and 'e' in game['guessed']
+    assert game['bad_guesses'] >= 1, "'é' should count as a bad guess"
+
+def test_export_games(test_app, tmp_path):
+    '''Export writes games by the day they ended, a stale unfinished game
+    holds nothing back, the high-water mark on end time counts each game
+    once, and the guess-order and first-guess rollups count the guesses.'''
+    import datetime, gzip
+    from sqlalchemy import create_engine
+    from server.export import export_games
+    from server.langman_orm import (ArchivedGame, FirstGuessRollup, Game,
+                                    GuessOrderRollup, LETTER_BITS, base_games,
+                                    letters_to_mask)
+    from server.usage_index import usage_index
+    usage = next(u for u in usage_index.rows().values() if u.language == 'en' and
+                 set(u.secret_word) <= set(LETTER_BITS) and 'z' not in u.secret_word)
+    word = ''.join(dict.fromkeys(usage.secret_word))
+    engine = create_engine('sqlite:///' + str(tmp_path / 'games.db'))
+    base_games.metadata.create_all(engine)
+    now = datetime.datetime.now()
+    days_ago = lambda n: now - datetime.timedelta(days=n)
+
+    def add(table, game_id, order, start, end):
+        engine.execute(table.insert().values(
+            game_id=game_id, player='p', usage_id=usage.usage_id,
+            guessed_mask=letters_to_mask(order), guess_order=order,
+            bad_guesses=usage.guess.misses(letters_to_mask(order)),
+            start_time=start, end_time=end))
+    add(Game.__table__, 'won', word, days_ago(3), days_ago(2))
+    add(ArchivedGame.__table__, 'quit', 'z', days_ago(4), days_ago(1))
+    add(Game.__table__, 'stale', word[0], days_ago(5), None)
+    add(Game.__table__, 'recent', 'z', now, now)
+
+    totals = export_games(engine, str(tmp_path / 'out'), lag=600)
+    assert totals['games'] == 2, 'An unfinished game should not hold back the rest'
+    mark = totals['until']
+    records = {}
+    for day in (days_ago(2), days_ago(1)):
+        path = tmp_path / 'out' / 'date={:%Y-%m-%d}'.format(day) / 'lang=en' / \
+               'part-start.jsonl.gz'
+        with gzip.open(str(path), 'rt') as lines:
+            records.update((r['game_id'], r) for r in map(json.loads, lines))
+    assert sorted(records) == ['quit', 'won']
+    assert records['won']['guess_order'] == word
+
+    engine.execute(Game.__table__.update().where(Game.__table__.c.game_id == 'stale')
+                   .values(end_time=now - datetime.timedelta(seconds=300)))
+    totals = export_games(engine, str(tmp_path / 'out'), lag=0)
+    assert totals['games'] == 2, 'Each game should be exported once, when it ends'
+    assert totals['since'] == mark
+
+    first = { (r.letter): (r.games, r.good, r.won) for r in engine.execute(
+        FirstGuessRollup.__table__.select()) }
+    assert first == {word[0]: (2, 2, 1), 'z': (2, 0, 0)}
+    order = { (r.letter, r.turn): (r.guesses, r.good) for r in engine.execute(
+        GuessOrderRollup.__table__.select()) }
+    assert order[(word[0], 0)] == (2, 2) and order[('z', 0)] == (2, 0)
+    assert sum(guesses for guesses, _ in order.values()) == len(word) + 3
+
+def test_jwt_timing():
+    '''With instrumentation on, the ``jwt`` phase is timed in views using
+    ``tokens.jwt_required``, on a verify and on a cached hit alike.'''
+    from flask import Flask
+    from flask_jwt_extended import JWTManager, create_access_token
+    from server import instrument
+    from server.tokens import tokens
+    timed = Flask('timed')
+    timed.config.update(JWT_SECRET_KEY='secret', INSTRUMENT={'enabled': True})
+    JWTManager(timed)
+    instrument.init_app(timed)
+
+    @timed.route('/timed')
+    @tokens.jwt_required
+    def view():
+        return 'ok'
+    with timed.app_context():
+        headers = {'Authorization': 'Bearer ' + create_access_token('someone')}
+    client = timed.test_client()
+    cached = tokens.stats()['verify_cached']
+    for _ in range(2):
+        response = client.get('/timed', headers=headers)
+        assert response.status_code == 200
+        assert 'jwt;dur=' in response.headers['Server-Timing']
+    assert tokens.stats()['verify_cached'] == cached + 1
+
+def test_reaped_cached_game(test_app, tmp_path):
+    '''A cached game the reaper has abandoned takes no more guesses.'''
+    import datetime
+    from server.db import registry
+    from server.game_store import game_store
+    from server.langman_orm import Game
+    from server.reaper import reap_idle
+    two_days_ago = datetime.datetime.now() - datetime.timedelta(days=2)
+    game_store.configure({'GAME_STORE': {'backend': 'memory', 'path': str(tmp_path),
+                                         'flush_interval': 3600},
+                          'REAPER': {'idle_hours': 24}})
+    try:
+        game_id, token = start_game(test_app)
+        headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer ' + token}
+        url = '/api/games/' + game_id
+        response = test_app.put(url, data=json.dumps(dict(letter='e')), headers=headers)
+        assert response.status_code == 200
+        game_store.flush()
+        state = game_store.cached(game_id)
+        state.last_move = two_days_ago
+        game_store.backend.put(state, dirty=False)
+        games = Game.__table__
+        engine = registry.engine('DB_GAMES')
+        engine.execute(games.update().where(games.c.game_id == game_id)
+                       .values(last_move=two_days_ago))
+        reap_idle(engine, two_days_ago + datetime.timedelta(days=1))
+        assert _stored_game(game_id).end_time is not None
+        assert game_store.cached(game_id) is not None
+
+        response = test_app.put(url, data=json.dumps(dict(letter='a')), headers=headers)
+        assert response.status_code == 403, 'A reaped game should be over'
+        assert game_store.cached(game_id) is None
+    finally:
+        game_store.configure(app.config)
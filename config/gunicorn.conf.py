@@ -1,4 +1,31 @@
+import os
+
+from server.util import get_config
+
+# SERVER_MODE async serves server.serve:app from uvicorn's asyncio worker
+if get_config(os.environ.get('FLASK_ENV', 'dev_lite'), open('server/config.yaml')) \
+        .get('SERVER_MODE', 'sync') == 'async':
+    worker_class = 'uvicorn.workers.UvicornWorker'
+
 def when_ready(server):
     open('/tmp/app-initialized', 'w').close()
 
+def post_fork(server, worker):
+    # each worker builds its own engines & pools rather than sharing sockets
+    from server.db import registry
+    registry.reset()
+
+def post_worker_init(worker):
+    # load the usage corpus before the worker takes its first request
+    from server.usage_index import usage_index
+    usage_index.refresh()
+
+def worker_exit(server, worker):
+    # write cached game changes to the games DB before the worker goes away
+    from server.game_store import game_store
+    game_store.flush()
+    # and the queued log records
+    from server.logs import shutdown
+    shutdown()
+
 bind = 'unix:///tmp/nginx.socket'
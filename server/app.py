@@ -1,21 +1,39 @@
 from .util import get_config
+from . import instrument, logs
+from .consistency import consistency_checks
+from .db import registry
+from .leaderboard import leaderboard
+from .game_store import game_store
+from .login_guard import login_guard
+from .passwords import passwords
+from .tokens import tokens
+from .usage_index import usage_index
+from .usage_search import usage_search
 from flask import Flask, g
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
 from flask_restplus import Api
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 import flask_jwt_extended as JWT
 from .games_api import games_api
 from .auth_api import auth_api
+from .users_api import users_api
+from .leaderboard_api import leaderboard_api
+from .usages_api import usages_api
 
 app = Flask(__name__)                         # Create Flask app
 app.config.update(get_config(
     app.config['ENV'], app.open_resource('config.yaml')))
+logs.init_app(app)                            # JSON logs, written by a background thread
 CORS(app)                                     # Cross-origin resource sharing
+if app.config.get('PROXY_HOPS'):              # client address from X-Forwarded-For
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=int(app.config['PROXY_HOPS']))
 
 api = Api(app, doc=False)
 api.add_namespace(games_api, path='/api/games')
 api.add_namespace(auth_api, path='/api/auth')
+api.add_namespace(users_api, path='/api/users')
+api.add_namespace(leaderboard_api, path='/api/leaderboard')
+api.add_namespace(usages_api, path='/api/usages')
 
 assert ('JWT_SECRET_KEY' in app.config), 'Must set FLASK_JWT_SECRET_KEY env variable'
 if 'JWT_ACCESS_TOKEN_EXPIRES' not in app.config:
@@ -24,38 +42,37 @@ if 'JWT_ACCESS_TOKEN_EXPIRES' not in app.config:
 app.config['PROPAGATE_EXCEPTIONS'] = True    # avoids server error w/bad JWTs in gunicorn
 
 jwt = JWT.JWTManager(app)  # do this after config is set
+registry.configure(app.config)   # engines & pools are built lazily, once per worker
+usage_index.configure(app.config)  # corpus is loaded into memory on first use
+usage_search.configure(app.config) # full-text search backend, picked on first use
+game_store.configure(app.config)   # optional write-behind cache of active games
+leaderboard.configure(app.config)
+tokens.configure(app.config)       # reuse game tokens & cache verified claims
+passwords.configure(app.config)    # password hashing scheme & its thread pool
+login_guard.configure(app.config)  # login rate limits & unknown-name cache
+consistency_checks.configure(app.config)  # always, sampled or no inline game checks
+instrument.init_app(app)           # opt-in request timing; before init_db to time it
 
+app.logger.debug('URL map %s', app.url_map)
 
-print('URL MAP', app.url_map)   # useful for debugging
 @app.before_request
 def init_db():
-    '''Initialize db by creating the global db_session
+    '''Initialize db by attaching the scoped sessions to ``g``
 
-    This runs on each request.
+    This runs on each request; the engines and their pools are shared by
+    all requests in the worker.
     '''
-    db_auth = create_engine(app.config['DB_AUTH'])
-    g.auth_db = sessionmaker(db_auth)()
-        
-    db_usage = create_engine(app.config['DB_USAGE'])
-    g.usage_db = sessionmaker(db_usage)()
-        
-    db_games = create_engine(app.config['DB_GAMES'])
-    g.games_db = sessionmaker(db_games)()
+    g.auth_db  = registry.session('DB_AUTH')
+    g.usage_db = registry.session('DB_USAGE')
+    g.games_db = registry.session('DB_GAMES')
 
 @app.teardown_request
 def close_db(exception):    
-    '''Close down db connection; same one cannot be used b/w threads
+    '''Return the db connections to the pool; same session cannot be used
+    b/w threads
 
     This runs after each request.
     '''
-    if hasattr(g, 'auth_db'):
-        g.auth_db.close()
-        _ = g.pop('auth_db')
-
-    if hasattr(g, 'usage_db'):
-        g.usage_db.close()
-        _ = g.pop('usage_db')
-        
-    if hasattr(g, 'games_db'):
-        g.games_db.close()
-        _ = g.pop('games_db')
+    registry.remove()
+    for name in ('auth_db', 'usage_db', 'games_db'):
+        g.pop(name, None)
@@ -0,0 +1,63 @@
+'''ASGI entry point serving the games and auth APIs from an asyncio server
+
+The event loop accepts connections, reads request bodies and writes
+responses; each request is then handled by the same Flask views as the
+WSGI app (so payloads and status codes are identical), through uvicorn's
+``WSGIMiddleware``, on a bounded pool of ``ASGI_THREADS`` threads.
+SQLAlchemy 1.3 has no asyncio driver support, so database calls block
+one of these threads rather than a whole worker process, and a single
+worker keeps many connections open.  Size the pool to the engine pools
+(``pool_size + max_overflow`` in ``DB_POOL``) so requests never queue for
+a connection inside a thread.
+
+Select it with ``SERVER_MODE: async`` in ``config.yaml`` (or
+``FLASK_SERVER_MODE=async``), which makes ``config/gunicorn.conf.py`` use
+uvicorn's worker for ``server.serve:app``.  To benchmark both modes side
+by side::
+
+    gunicorn -c config/gunicorn.conf.py -b 127.0.0.1:8000 server.serve:app
+    FLASK_SERVER_MODE=async gunicorn -c config/gunicorn.conf.py -b 127.0.0.1:8001 server.serve:app
+    python api_bench.py --url http://127.0.0.1:8000 --save sync.json
+    python api_bench.py --url http://127.0.0.1:8001 --compare sync.json
+
+or run it alone with ``uvicorn server.asgi:app``.
+'''
+import asyncio
+
+from uvicorn.middleware.wsgi import WSGIMiddleware
+
+from .app import app as flask_app
+from .game_store import game_store
+from .usage_index import usage_index
+
+class AsgiApp:
+    '''ASGI 3 application serving http requests with the WSGI callable
+    ``wsgi_app`` on a pool of ``threads`` threads, and handling the
+    lifespan events, which ``WSGIMiddleware`` does not'''
+    def __init__(self, wsgi_app, threads):
+        self.http = WSGIMiddleware(wsgi_app, workers=threads)
+        self.executor = self.http.executor
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        else:
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        '''Load the corpus before serving, as ``post_worker_init`` does for
+        gunicorn, and flush cached game changes on shutdown'''
+        loop = asyncio.get_event_loop()
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await loop.run_in_executor(self.executor, usage_index.refresh)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if game_store.enabled:
+                    await loop.run_in_executor(self.executor, game_store.flush)
+                self.executor.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+app = AsgiApp(flask_app, int(flask_app.config.get('ASGI_THREADS', 10)))
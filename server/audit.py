@@ -0,0 +1,96 @@
+import collections
+import concurrent.futures
+import csv
+import os
+import time
+
+from sqlalchemy import select
+
+from .langman_orm import Game, GameState
+
+# the columns the checks read; of end_time, only whether it is set
+AUDIT_FIELDS = ('game_id', 'usage_id', 'guessed_mask', 'other_misses', 'bad_guesses',
+                'ended')
+
+_guess_tables = {}     # usage_id -> GuessTable, in each audit worker
+
+def _init_worker(guess_tables):
+    global _guess_tables
+    _guess_tables = guess_tables
+
+def audit_chunk(rows):
+    '''Check games ``rows`` (tuples of ``AUDIT_FIELDS``) against the
+    guess tables of their usages, as ``GameMethods._check_consistent``
+    does when serving them
+
+    :returns: the number of rows checked and a list of ``(game_id,
+              usage_id, problem)`` for each inconsistent game
+    '''
+    problems = []
+    for game_id, usage_id, guessed_mask, other_misses, bad_guesses, ended in rows:
+        state = GameState(game_id=game_id, usage_id=usage_id, guessed_mask=guessed_mask,
+                          other_misses=other_misses, bad_guesses=bad_guesses,
+                          end_time=True if ended else None)
+        guess_table = _guess_tables.get(state.usage_id)
+        if guess_table is None:
+            problems.append((state.game_id, state.usage_id, 'Unknown usage'))
+            continue
+        try:
+            state._check_consistent(guess_table)
+        except AssertionError as error:
+            problems.append((state.game_id, state.usage_id, str(error)))
+    return len(rows), problems
+
+def audit_games(engine, guess_tables, path, table=Game.__table__, workers=None,
+                chunk_size=10000, progress=None):
+    '''Check every game in ``table`` and write a CSV report of the
+    inconsistent ones to ``path``
+
+    Only the ``AUDIT_FIELDS`` of the rows are read, streamed with a
+    server-side cursor (``stream_results``) ``chunk_size`` at a time, and
+    each chunk is checked by ``audit_chunk`` on a pool of ``workers``
+    processes (default: one per CPU), each given ``guess_tables`` (usage
+    id -> ``GuessTable``) once when it starts.  At
+    most two chunks per worker are in flight, so memory stays flat however
+    large the table.  ``progress``, if given, is called with the running
+    totals after each chunk.
+
+    :returns: dict with counts of ``games`` checked and ``inconsistent``
+              games and the ``seconds`` taken
+    '''
+    workers = workers or os.cpu_count() or 1
+    query = select([ table.c.game_id, table.c.usage_id, table.c.guessed_mask,
+                     table.c.other_misses, table.c.bad_guesses,
+                     table.c.end_time.isnot(None) ])
+    totals = {'games': 0, 'inconsistent': 0}
+    start = time.perf_counter()
+
+    with open(path, 'w', newline='') as out, \
+         concurrent.futures.ProcessPoolExecutor(
+             workers, initializer=_init_worker, initargs=(guess_tables,)) as pool, \
+         engine.connect() as conn:
+        report = csv.writer(out)
+        report.writerow(('game_id', 'usage_id', 'problem'))
+        pending = collections.deque()
+
+        def collect():
+            checked, problems = pending.popleft().result()
+            report.writerows(problems)
+            totals['games'] += checked
+            totals['inconsistent'] += len(problems)
+            if progress is not None:
+                progress(totals)
+
+        result = conn.execution_options(stream_results=True).execute(query)
+        while True:
+            rows = [ tuple(row) for row in result.fetchmany(chunk_size) ]
+            if not rows:
+                break
+            pending.append(pool.submit(audit_chunk, rows))
+            if len(pending) >= 2 * workers:
+                collect()
+        while pending:
+            collect()
+
+    totals['seconds'] = time.perf_counter() - start
+    return totals
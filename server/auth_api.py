@@ -1,15 +1,24 @@
+import math
 import uuid                                    # creates the salt
 
-from flask import g                            # for database sessions
+from flask import g, request                   # for database sessions
 from flask_restplus import Resource, Namespace # creates a namespace & api
 import flask_jwt_extended as JWT               # works with access tokens
 
 import sqlalchemy
 
 from .auth_orm import Auth                     # has the new ORM class
+from .login_guard import login_guard           # rate limits & unknown names
+from .passwords import HasherBusy              # too many logins at once
+from .tokens import tokens                     # issues & caches tokens
 
 auth_api  = Namespace('auth', description='Authentication')
 
+def _too_many(wait):
+    '''The 429 response asking the client to retry after ``wait`` seconds'''
+    return ({'message': 'Too many attempts, try again later'}, 429,
+            {'Retry-After': str(math.ceil(wait))})
+
 @auth_api.route('')
 class Authenticate(Resource):
     def post(self):
@@ -23,12 +32,18 @@ class Authenticate(Resource):
         :returns:           
            The token within a JSON object:
               * ``access_token`` The JSON web token for this session
+
+        Too many registrations from one address get a 429 response with a
+        ``Retry-After`` header.
         '''
         # 1. make sure you have all the arguments you need
         if not (auth_api.payload and
                 'username' in auth_api.payload and
                 'password' in auth_api.payload):
             auth_api.abort(400, 'Registering requires username and password')
+        wait = login_guard.register_wait(request.remote_addr)
+        if wait:
+            return _too_many(wait)
         
         # 2. create record for account
         user_id = str(uuid.uuid3(
@@ -38,15 +53,19 @@ class Authenticate(Resource):
             user_id   = user_id,
             pass_salt = uuid.uuid1().hex
         )
-        user_auth._set_hash(auth_api.payload['password'])
+        try:
+            user_auth._set_hash(auth_api.payload['password'])
+        except HasherBusy:
+            auth_api.abort(503, 'Too many logins in progress, try again')
         g.auth_db.add(user_auth)
         try:
             g.auth_db.commit()
         except sqlalchemy.exc.IntegrityError:
             auth_api.abort(400, 'Username is already registered')
+        login_guard.forget_unknown(user_auth.user_name)
             
         # 3. create and return the access token for the user
-        return {'access_token':JWT.create_access_token(
+        return {'access_token':tokens.create(
             identity=user_id,
             user_claims={
                 'access':'player',
@@ -65,28 +84,45 @@ class Authenticate(Resource):
         :returns:
            The token within a JSON object:
               * ``access_token`` The JSON web token for this session
+
+        After too many failed logins from one address or for one username,
+        logins get a 429 response with a ``Retry-After`` header.
         '''
         # 1. make sure you have all the arguments you need
         if not (auth_api.payload and
                 'username' in auth_api.payload and
                 'password' in auth_api.payload):
             auth_api.abort(400, 'Login requires username and password')
+        user_name = auth_api.payload['username']
+        wait = login_guard.login_wait(request.remote_addr, user_name)
+        if wait:
+            return _too_many(wait)
         
-        # 2. check that the password is valid (to be filled in later)
-        user_auth = g.auth_db.query(Auth).filter(
-            Auth.user_name == auth_api.payload['username']).one_or_none()
-        if (user_auth is None or
-            not user_auth._check_password(auth_api.payload['password'])):
-            return {'message': 'Invalid credentials'}, 401
+        # 2. check that the password is valid, skipping names known not to exist
+        user_auth = None
+        if not login_guard.is_unknown(user_name):
+            user_auth = g.auth_db.query(Auth).filter(
+                Auth.user_name == user_name).one_or_none()
+            if user_auth is None:
+                login_guard.remember_unknown(user_name)
+        try:
+            if (user_auth is None or
+                not user_auth._check_password(auth_api.payload['password'])):
+                login_guard.login_failed(request.remote_addr, user_name)
+                return {'message': 'Invalid credentials'}, 401
+        except HasherBusy:
+            auth_api.abort(503, 'Too many logins in progress, try again')
+        if g.auth_db.dirty:                    # the hash was upgraded
+            g.auth_db.commit()
         
         # 3. create and return the access token for the user if valid
-        access_token = JWT.create_access_token(
+        access_token = tokens.create(
             identity=user_auth.user_id,
             user_claims={'access':'player', 'name':user_auth.user_name}
         )
         return {'access_token':access_token}
 
-    @JWT.jwt_required
+    @tokens.jwt_required
     def get(self):
         '''Test the access token, passed in as an authorization header
 
@@ -101,7 +137,7 @@ class Authenticate(Resource):
             'user_claims':  JWT.get_jwt_claims()
         }
     
-    @JWT.jwt_required
+    @tokens.jwt_required
     def delete(self):
         '''Remove the user's record from the database
 
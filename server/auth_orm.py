@@ -1,31 +1,49 @@
 import hashlib
+import hmac
 
-from sqlalchemy import Column, types
+from sqlalchemy import Column, Index, types
 from sqlalchemy.ext.declarative import declarative_base
 
+from .passwords import is_versioned, passwords
+
 base = declarative_base()    
 
 class Auth(base):
     '''Table ``auth`` with fields:
-      * ``user_name`` - String of maximum length 80 and the primary key
-      * ``pass_hash`` - The md5 hash of the user_name, salt, and password
-      * ``pass_salt`` - An arbitrary string used to harden the hash
+      * ``user_name`` - String of maximum length 80, uniquely indexed
+      * ``pass_hash`` - Versioned hash string of the password (see
+        ``passwords``), or for accounts not logged into since, the legacy
+        md5 hash of the user_name, salt, and password
+      * ``pass_salt`` - An arbitrary string used to harden the legacy hash
     '''
     __tablename__ = 'auth'
     user_id   = Column(types.String(length=38), primary_key=True)
     user_name = Column(types.String(length=80))
-    pass_hash = Column(types.String(length=32))
+    pass_hash = Column(types.String(length=128))
     pass_salt = Column(types.String(length=40), default='')
 
+    __table_args__ = (
+        # logins look accounts up by name
+        Index('ix_auth_user_name', 'user_name', unique=True),
+    )
+
     def _compute_hash(self, password):
-        '''Hash ``user_name``, ``pass_salt``, and ``password``.'''
+        '''Legacy md5 hash of ``user_name``, ``pass_salt``, and ``password``.'''
         return hashlib.md5((self.user_name + '|' + self.pass_salt + '|' + password).encode()).hexdigest()
     
     def _set_hash(self, password):
-        '''Given known ``user_name`` and ``pass_salt``, compute and store
-        ``pass_hash``.  Used for registering new users.  Does not commit.'''
-        self.pass_hash = self._compute_hash(password)
+        '''Compute and store ``pass_hash`` with the current password
+        hasher.  Used for registering new users.  Does not commit.'''
+        self.pass_hash = passwords.hash(password)
 
     def _check_password(self, password):
-        '''Check if ``password`` agrees with ``pass_hash`` and ``pass_salt``'''
-        return self.pass_hash == self._compute_hash(password)
+        '''Check if ``password`` agrees with ``pass_hash``.  On success, a
+        legacy md5 hash or one made with other hasher settings is replaced
+        by a current one.  Does not commit.'''
+        if is_versioned(self.pass_hash):
+            valid = passwords.verify(self.pass_hash, password)
+        else:
+            valid = hmac.compare_digest(self.pass_hash, self._compute_hash(password))
+        if valid and passwords.needs_rehash(self.pass_hash):
+            self._set_hash(password)
+        return valid
@@ -0,0 +1,49 @@
+import logging
+import random
+
+log = logging.getLogger(__name__)
+
+class ConsistencyChecks:
+    '''Decides which game states are checked as they are served: the
+    transition check of ``GameMethods._to_dict`` and ``_check_consistent``
+
+    Configured by ``CONSISTENCY`` in ``config.yaml``:
+      * ``checks`` - ``always`` (default), ``sampled`` or ``off``
+      * ``sample_rate`` - Fraction of states checked when ``sampled``
+      * ``strict`` - Raise on a failed check, so the request fails with a
+        500 (default); when false the failure is only logged
+
+    ``flask audit-games`` checks every stored game offline instead.
+    '''
+    MODES = ('always', 'sampled', 'off')
+
+    def __init__(self):
+        self.mode = 'always'
+        self.sample_rate = 0.01
+        self.strict = True
+        self.failures = 0
+
+    def configure(self, config):
+        options = dict(config.get('CONSISTENCY') or {})
+        mode = options.get('checks', 'always')
+        if mode not in self.MODES:
+            raise ValueError('Unknown CONSISTENCY checks {}'.format(mode))
+        self.mode = mode
+        self.sample_rate = float(options.get('sample_rate', 0.01))
+        self.strict = bool(options.get('strict', True))
+        self.failures = 0
+
+    def due(self):
+        '''True if the game state being served should be checked'''
+        if self.mode == 'always':
+            return True
+        return self.mode == 'sampled' and random.random() < self.sample_rate
+
+    def failed(self, game_id, error):
+        '''Log the failed check ``error`` of game ``game_id``; returns True
+        if it should be raised'''
+        self.failures += 1
+        log.error('Inconsistent game state: %s', error, extra={'game_id': game_id})
+        return self.strict
+
+consistency_checks = ConsistencyChecks()
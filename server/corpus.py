@@ -0,0 +1,86 @@
+import csv
+import hashlib
+import itertools
+import time
+
+from sqlalchemy import bindparam, select
+
+from .langman_orm import Usage
+
+def iter_corpus_csv(path):
+    '''Yield ``(usage_id, language, secret_word, usage, source)`` for each
+    usable row of the corpus CSV at ``path``, reading one row at a time.
+    Rows whose usage sentence is longer than 500 characters are skipped.'''
+    with open(path, encoding='utf8') as f:
+        for row in csv.reader(f):
+            if len(row[4]) <= 500:
+                yield int(row[0]), row[1], row[3], row[4], row[5]
+
+def content_hash(language, secret_word, usage, source):
+    '''Return the hex digest identifying the content of one usage'''
+    return hashlib.md5('\x1f'.join(
+        (language, secret_word, usage, source or '')).encode()).hexdigest()
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def load_corpus(engine, rows, chunk_size=1000, progress=None):
+    '''Upsert ``rows`` of ``(usage_id, language, secret_word, usage, source)``
+    into the ``usages`` table of ``engine``
+
+    Rows are handled ``chunk_size`` at a time, each chunk in its own
+    transaction, so memory stays bounded for any corpus size.  For each
+    chunk the stored content hashes are looked up by ``usage_id``; new rows
+    are inserted and changed rows updated with one executemany each, and
+    unchanged rows are skipped.  ``progress``, if given, is called with the
+    running totals after each chunk.
+
+    :returns: dict with counts of ``rows``, ``inserted``, ``updated`` and
+              ``unchanged`` rows, ``seconds`` taken and ``rows_per_sec``
+    '''
+    table = Usage.__table__
+    insert = table.insert()
+    update = table.update().where(table.c.usage_id == bindparam('b_usage_id')).values(
+        language=bindparam('b_language'), secret_word=bindparam('b_secret_word'),
+        usage=bindparam('b_usage'), source=bindparam('b_source'),
+        content_hash=bindparam('b_content_hash'))
+    lookup = select([table.c.usage_id, table.c.content_hash]).where(
+        table.c.usage_id.in_(bindparam('ids', expanding=True)))
+
+    totals = {'rows': 0, 'inserted': 0, 'updated': 0, 'unchanged': 0}
+    start = time.perf_counter()
+    for chunk in _chunks(rows, chunk_size):
+        records = {}
+        for usage_id, language, secret_word, usage, source in chunk:
+            records[usage_id] = {
+                'usage_id': usage_id, 'language': language,
+                'secret_word': secret_word, 'usage': usage, 'source': source,
+                'content_hash': content_hash(language, secret_word, usage, source)}
+        with engine.begin() as conn:
+            stored = {}
+            ids = list(records)
+            for i in range(0, len(ids), 500):    # keep under parameter limits
+                stored.update(conn.execute(lookup, ids=ids[i:i+500]).fetchall())
+            new = [ r for k, r in records.items() if k not in stored ]
+            changed = [ { 'b_' + f: v for f, v in r.items() }
+                        for k, r in records.items()
+                        if k in stored and stored[k] != r['content_hash'] ]
+            if new:
+                conn.execute(insert, new)
+            if changed:
+                conn.execute(update, changed)
+        totals['rows'] += len(chunk)
+        totals['inserted'] += len(new)
+        totals['updated'] += len(changed)
+        totals['unchanged'] += len(records) - len(new) - len(changed)
+        if progress is not None:
+            progress(totals)
+
+    totals['seconds'] = time.perf_counter() - start
+    totals['rows_per_sec'] = totals['rows'] / totals['seconds'] if totals['seconds'] else 0.0
+    return totals
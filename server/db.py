@@ -0,0 +1,102 @@
+import os
+import threading
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
+
+class EngineRegistry:
+    '''Process-wide registry of pooled engines and scoped sessions
+
+    One engine (with its connection pool) is kept for each distinct database
+    URL, so keys that point at the same database (e.g., ``DB_AUTH`` and
+    ``DB_GAMES`` in ``dev_lite``) share a pool.  Each config key gets a
+    thread-scoped session; ``remove`` hands the connections back to the pool
+    at the end of a request.
+
+    Engines are created lazily and are tied to the process that created them.
+    After a fork (e.g., gunicorn workers with ``preload_app``) the child drops
+    the inherited engines and builds its own instead of sharing sockets.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._config = {}
+        self._pid = os.getpid()
+        self._engines = {}
+        self._sessions = {}
+
+    def configure(self, config):
+        '''Store the application ``config`` holding the ``DB_*`` urls and the
+        optional ``DB_POOL`` options.  Existing engines are discarded.'''
+        with self._lock:
+            self._config = config
+            self._discard()
+
+    def _pool_options(self, url):
+        '''Return the ``create_engine`` keyword arguments for ``url``'''
+        pool = dict(self._config.get('DB_POOL') or {})
+        options = {
+            'poolclass': QueuePool,
+            'pool_size': int(pool.get('pool_size', 5)),
+            'max_overflow': int(pool.get('max_overflow', 10)),
+            'pool_recycle': int(pool.get('pool_recycle', -1)),
+            'pool_pre_ping': bool(pool.get('pool_pre_ping', False)),
+        }
+        if url.startswith('sqlite'):
+            # pooled sqlite connections are handed between request threads
+            options['connect_args'] = {'check_same_thread': False}
+        return options
+
+    def _check_pid(self):
+        '''Forget engines inherited from a parent process'''
+        if self._pid != os.getpid():
+            self._discard()
+            self._pid = os.getpid()
+
+    def _discard(self):
+        '''Drop references to all engines and sessions without closing their
+        connections, which may still belong to another process.'''
+        self._engines = {}
+        self._sessions = {}
+
+    def engine(self, key):
+        '''Return the shared engine for the database url in config ``key``'''
+        url = self._config[key]
+        with self._lock:
+            self._check_pid()
+            if url not in self._engines:
+                self._engines[url] = create_engine(url, **self._pool_options(url))
+            return self._engines[url]
+
+    def session(self, key):
+        '''Return the scoped session for config ``key`` (e.g., ``DB_GAMES``)'''
+        with self._lock:
+            self._check_pid()
+            session = self._sessions.get(key)
+        if session is None:
+            session = scoped_session(sessionmaker(bind=self.engine(key)))
+            with self._lock:
+                session = self._sessions.setdefault(key, session)
+        return session
+
+    def remove(self):
+        '''Close the current thread's sessions, returning their connections
+        to the pools.  Called at the end of each request.'''
+        for session in list(self._sessions.values()):
+            session.remove()
+
+    def reset(self):
+        '''Discard all engines; used in freshly forked worker processes'''
+        with self._lock:
+            self._discard()
+            self._pid = os.getpid()
+
+    def dispose(self):
+        '''Close all pooled connections owned by this process'''
+        with self._lock:
+            self._check_pid()
+            for engine in self._engines.values():
+                engine.dispose()
+            self._discard()
+
+registry = EngineRegistry()
@@ -0,0 +1,289 @@
+import collections
+import csv
+import datetime
+import gzip
+import json
+import os
+import time
+
+from sqlalchemy import bindparam, select, text, types, union_all
+
+from .langman_orm import (ArchivedGame, ExportMark, Game, GameMethods,
+                          LETTER_BITS, mask_to_letters)
+from .usage_index import usage_index
+
+FORMATS = ('jsonl', 'csv')
+EXPORT_FIELDS = ('game_id', 'player', 'usage_id', 'lang', 'source', 'secret_word',
+                 'word_length', 'guessed', 'guess_order', 'bad_guesses', 'result',
+                 'start_time', 'end_time', 'seconds')
+
+LETTERS_UPSERT = text(
+    'INSERT INTO rollup_letters (lang, letter, position, games, revealed, won) '
+    'VALUES (:lang, :letter, :position, :games, :revealed, :won) '
+    'ON CONFLICT (lang, letter, position) DO UPDATE SET '
+    'games = rollup_letters.games + excluded.games, '
+    'revealed = rollup_letters.revealed + excluded.revealed, '
+    'won = rollup_letters.won + excluded.won')
+
+LENGTHS_UPSERT = text(
+    'INSERT INTO rollup_lengths (lang, word_length, games, won, lost, abandoned, '
+    'bad_guesses, total_seconds) VALUES (:lang, :word_length, :games, :won, '
+    ':lost, :abandoned, :bad_guesses, :total_seconds) '
+    'ON CONFLICT (lang, word_length) DO UPDATE SET '
+    'games = rollup_lengths.games + excluded.games, '
+    'won = rollup_lengths.won + excluded.won, '
+    'lost = rollup_lengths.lost + excluded.lost, '
+    'abandoned = rollup_lengths.abandoned + excluded.abandoned, '
+    'bad_guesses = rollup_lengths.bad_guesses + excluded.bad_guesses, '
+    'total_seconds = rollup_lengths.total_seconds + excluded.total_seconds')
+
+ORDER_UPSERT = text(
+    'INSERT INTO rollup_guess_order (lang, letter, turn, guesses, good) '
+    'VALUES (:lang, :letter, :turn, :guesses, :good) '
+    'ON CONFLICT (lang, letter, turn) DO UPDATE SET '
+    'guesses = rollup_guess_order.guesses + excluded.guesses, '
+    'good = rollup_guess_order.good + excluded.good')
+
+FIRST_UPSERT = text(
+    'INSERT INTO rollup_first_guesses (lang, letter, games, good, won) '
+    'VALUES (:lang, :letter, :games, :good, :won) '
+    'ON CONFLICT (lang, letter) DO UPDATE SET '
+    'games = rollup_first_guesses.games + excluded.games, '
+    'good = rollup_first_guesses.good + excluded.good, '
+    'won = rollup_first_guesses.won + excluded.won')
+
+MARK_UPSERT = text(
+    'INSERT INTO export_marks (name, high_water, updated) '
+    'VALUES (:name, :high_water, :updated) ON CONFLICT (name) DO UPDATE SET '
+    'high_water = excluded.high_water, updated = excluded.updated'
+).bindparams(bindparam('high_water', type_=types.DateTime),
+             bindparam('updated', type_=types.DateTime))
+
+class Partitions:
+    '''Compressed files of game records under ``root``, one per end date
+    and language: ``date=YYYY-MM-DD/lang=xx/<part>.jsonl.gz`` (or
+    ``.csv.gz``).  Each file is written under a ``.tmp`` name and renamed
+    when closed, so readers never see a partial file.'''
+    def __init__(self, root, fmt, part):
+        self.root, self.fmt, self.part = root, fmt, part
+        self._open = {}      # (date, lang) -> (tmp path, file, csv writer)
+        self.files = 0
+
+    def write(self, date, lang, record):
+        key = (date, lang)
+        entry = self._open.get(key)
+        if entry is None:
+            folder = os.path.join(self.root, 'date=' + date, 'lang=' + lang)
+            os.makedirs(folder, exist_ok=True)
+            path = os.path.join(folder, '{}.{}.gz.tmp'.format(self.part, self.fmt))
+            out = gzip.open(path, 'wt', compresslevel=6, encoding='utf8', newline='')
+            writer = None
+            if self.fmt == 'csv':
+                writer = csv.DictWriter(out, EXPORT_FIELDS)
+                writer.writeheader()
+            entry = self._open[key] = (path, out, writer)
+        path, out, writer = entry
+        if writer is None:
+            out.write(json.dumps(record) + '\n')
+        else:
+            writer.writerow(record)
+
+    def close_before(self, date):
+        '''Finish the files of the dates before ``date``; the records come
+        in order of end time, so those get no more'''
+        for key in [ key for key in self._open if key[0] < date ]:
+            path, out, _ = self._open.pop(key)
+            out.close()
+            os.replace(path, path[:-len('.tmp')])
+            self.files += 1
+
+    def close(self):
+        self.close_before('9999')
+
+    def discard(self):
+        '''Remove the files not yet finished'''
+        for path, out, _ in self._open.values():
+            out.close()
+            os.remove(path)
+        self._open.clear()
+
+RESULTS = ('won', 'lost', 'abandoned')
+
+def game_record(row, usage, guessed):
+    '''Return the export record of the finished game ``row``, which has the
+    columns of ``games``, played on the ``UsageRow`` ``usage``; ``guessed``
+    is its guessed letters'''
+    return {
+        'game_id': row.game_id,
+        'player': row.player,
+        'usage_id': row.usage_id,
+        'lang': usage.language,
+        'source': usage.source,
+        'secret_word': usage.secret_word,
+        'word_length': len(usage.secret_word),
+        'guessed': guessed,
+        'guess_order': row.guess_order or '',
+        'bad_guesses': row.bad_guesses,
+        'result': GameMethods._result(row, usage.guess),
+        'start_time': row.start_time.isoformat(),
+        'end_time': row.end_time.isoformat(),
+        'seconds': (row.end_time - row.start_time).total_seconds(),
+    }
+
+def rollup_rows(outcomes, usages):
+    '''Return the rows to add to ``rollup_letters`` and ``rollup_lengths``
+    for the games counted in ``outcomes``, a dict of ``(usage_id, letters
+    of the secret word guessed as a mask, result)`` to ``[games, bad
+    guesses, seconds]``; ``usages`` is the ``usage_index`` rows'''
+    letters = collections.defaultdict(lambda: [0, 0, 0])           # (lang, letter, position)
+    lengths = collections.defaultdict(lambda: [0, 0, 0, 0, 0, 0.0])  # (lang, word_length)
+    for (usage_id, mask, result), (n, bad_guesses, seconds) in outcomes.items():
+        usage = usages[usage_id]
+        won = n if result == 'won' else 0
+        for letter, positions in usage.guess.masks.items():
+            revealed = n if mask & LETTER_BITS[letter] else 0
+            for i in range(positions.bit_length()):
+                if positions >> i & 1:
+                    counts = letters[(usage.language, letter, i)]
+                    counts[0] += n
+                    counts[1] += revealed
+                    counts[2] += won
+        counts = lengths[(usage.language, len(usage.secret_word))]
+        counts[0] += n
+        counts[1 + RESULTS.index(result)] += n
+        counts[4] += bad_guesses
+        counts[5] += seconds
+    return ([ {'lang': lang, 'letter': letter, 'position': position,
+               'games': n, 'revealed': revealed, 'won': won}
+              for (lang, letter, position), (n, revealed, won) in letters.items() ],
+            [ {'lang': lang, 'word_length': length, 'games': n, 'won': won,
+               'lost': lost, 'abandoned': abandoned, 'bad_guesses': bad_guesses,
+               'total_seconds': seconds}
+              for (lang, length), (n, won, lost, abandoned, bad_guesses, seconds)
+              in lengths.items() ])
+
+def count_guesses(order, first, usage, guess_order, won):
+    '''Count the guesses ``guess_order`` of a finished game played on the
+    ``UsageRow`` ``usage`` in ``order``, a dict of ``(lang, letter, turn)``
+    to ``[guesses, good]``, and its first guess in ``first``, a dict of
+    ``(lang, letter)`` to ``[games, good, won]``'''
+    for turn, letter in enumerate(guess_order):
+        good = usage.guess.is_good(letter)
+        counts = order[(usage.language, letter, turn)]
+        counts[0] += 1
+        counts[1] += good
+        if turn == 0:
+            counts = first[(usage.language, letter)]
+            counts[0] += 1
+            counts[1] += good
+            counts[2] += won
+
+def export_games(engine, root, fmt='jsonl', chunk_size=10000, lag=600, progress=None):
+    '''Export the games that ended since the last export to files under
+    ``root`` and add them to the ``rollup_letters``, ``rollup_lengths``,
+    ``rollup_guess_order`` and ``rollup_first_guesses`` tables
+
+    The window runs from the ``games`` high-water mark in ``export_marks``
+    (or the first game) up to ``lag`` seconds ago, by end time: a game's
+    ``end_time`` is set once, when it ends, so none is counted twice and
+    games still being played hold nothing back.  The games of ``games``
+    and ``games_archive`` in the window are streamed in order of end time
+    with a server-side cursor, ``chunk_size`` at a time, and joined with
+    their usage from the ``usage_index`` (the usages may live in another
+    database).  Each is written to a ``Partitions`` file in ``fmt``
+    (``jsonl`` or ``csv``) named after the start of the window, counted in
+    memory by usage, letters guessed and result, and its ``guess_order``
+    counted by ``count_guesses`` (games from before it was kept have none).
+    Once the files are complete, the counts are added to the rollups and
+    the mark is moved up in one transaction.  An interrupted export writes no
+    counts and, run again, rewrites the same files.  ``progress``, if
+    given, is called with the running totals after each chunk.
+
+    :returns: dict with counts of ``games`` exported, ``skipped`` games of
+              unknown usages and ``files`` written, the window ``since``
+              and ``until``, and the ``seconds`` taken
+    '''
+    if fmt not in FORMATS:
+        raise ValueError('Unknown export format {}'.format(fmt))
+    games, archive = Game.__table__, ArchivedGame.__table__
+    now = datetime.datetime.now()
+    with engine.connect() as conn:
+        since = conn.execute(select([ExportMark.high_water])
+                             .where(ExportMark.name == 'games')).scalar()
+    until = now - datetime.timedelta(seconds=lag)
+    totals = {'games': 0, 'skipped': 0, 'files': 0, 'since': since, 'until': until}
+    start = time.perf_counter()
+    if since is not None and until <= since:
+        totals['seconds'] = time.perf_counter() - start
+        return totals
+
+    def window(table):
+        query = select([ table.c[name] for name in GameMethods.FIELDS ]).where(
+            table.c.end_time < until)
+        if since is not None:
+            query = query.where(table.c.end_time >= since)
+        return query
+    query = union_all(window(games), window(archive)).order_by('end_time')
+
+    usages = usage_index.rows()
+    outcomes = collections.defaultdict(lambda: [0, 0, 0.0])   # see rollup_rows
+    order = collections.defaultdict(lambda: [0, 0])           # see count_guesses
+    first = collections.defaultdict(lambda: [0, 0, 0])
+    guessed = {}                                              # mask -> letters
+    part = 'part-' + (since.strftime('%Y%m%dT%H%M%S') if since else 'start')
+    partitions = Partitions(root, fmt, part)
+    try:
+        with engine.connect() as conn:
+            result = conn.execution_options(stream_results=True).execute(query)
+            while True:
+                rows = result.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for row in rows:
+                    usage = usages.get(row.usage_id)
+                    if usage is None:
+                        totals['skipped'] += 1
+                        continue
+                    mask = row.guessed_mask or 0
+                    letters = guessed.get(mask)
+                    if letters is None:
+                        letters = guessed[mask] = mask_to_letters(mask)
+                    record = game_record(row, usage, letters)
+                    date = record['end_time'][:10]
+                    partitions.close_before(date)
+                    partitions.write(date, usage.language, record)
+
+                    counts = outcomes[(row.usage_id, mask & usage.guess.letters_mask,
+                                       record['result'])]
+                    counts[0] += 1
+                    counts[1] += row.bad_guesses or 0
+                    counts[2] += record['seconds']
+                    count_guesses(order, first, usage, record['guess_order'],
+                                  record['result'] == 'won')
+                    totals['games'] += 1
+                if progress is not None:
+                    progress(totals)
+        partitions.close()
+    except BaseException:
+        partitions.discard()
+        raise
+    totals['files'] = partitions.files
+
+    letters, lengths = rollup_rows(outcomes, usages)
+    with engine.begin() as conn:
+        if letters:
+            conn.execute(LETTERS_UPSERT, letters)
+        if lengths:
+            conn.execute(LENGTHS_UPSERT, lengths)
+        if order:
+            conn.execute(ORDER_UPSERT, [
+                {'lang': lang, 'letter': letter, 'turn': turn,
+                 'guesses': guesses, 'good': good}
+                for (lang, letter, turn), (guesses, good) in order.items() ])
+        if first:
+            conn.execute(FIRST_UPSERT, [
+                {'lang': lang, 'letter': letter, 'games': n, 'good': good, 'won': won}
+                for (lang, letter), (n, good, won) in first.items() ])
+        conn.execute(MARK_UPSERT, name='games', high_water=until, updated=now)
+    totals['seconds'] = time.perf_counter() - start
+    return totals
@@ -0,0 +1,467 @@
+import contextlib
+import datetime
+import fcntl
+import glob
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
+
+from .db import registry
+from .langman_orm import Game, GameState, LETTER_BITS, letters_to_mask
+
+log = logging.getLogger(__name__)
+
+GAME_COLUMNS = [ c.name for c in Game.__table__.columns ]
+
+def game_to_state(game):
+    '''Return the columns of ``game`` as a JSON-serializable dict'''
+    state = {}
+    for name in GAME_COLUMNS:
+        value = getattr(game, name)
+        if isinstance(value, datetime.datetime):
+            value = value.isoformat()
+        state[name] = value
+    return state
+
+def state_to_game(state):
+    '''Return the ``GameState`` for the dict ``state`` from ``game_to_state``.
+    States logged before the compact encoding, with ``guessed`` letters and
+    a ``reveal_word``, are converted.'''
+    values = dict(state)
+    if 'guessed' in values:
+        guessed = values.pop('guessed') or ''
+        values['guessed_mask'] = letters_to_mask(guessed)
+        values['other_misses'] = len([ l for l in guessed if l not in LETTER_BITS ])
+        values['guess_order'] = guessed
+        values.pop('reveal_word', None)
+    for name in ('start_time', 'end_time', 'last_move'):
+        if values.get(name) is not None:
+            values[name] = datetime.datetime.fromisoformat(values[name])
+    return GameState(**values)
+
+def write_forward(session, state):
+    '''Write the ``GameState`` ``state`` to the games table unless the row
+    already holds all its guesses or has ended.  Game states only move
+    forward (each change adds a letter to ``guessed_mask`` or one to
+    ``other_misses``), so stale or
+    repeated writes (late flushes, replays) are harmless, and a game the
+    reaper has abandoned stays so.  Returns the number of rows written;
+    does not commit.'''
+    return session.query(Game).filter(
+        Game.game_id == state.game_id,
+        Game.end_time.is_(None),
+        Game.guessed_mask.op('&')(state.guessed_mask) == Game.guessed_mask,
+        Game.other_misses <= (state.other_misses or 0),
+        (Game.guessed_mask != state.guessed_mask) |
+            (Game.other_misses != (state.other_misses or 0))
+    ).update({ name: getattr(state, name) for name in GAME_COLUMNS
+               if name != 'game_id' }, synchronize_session=False)
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class MemoryBackend:
+    '''Active game states held in this process only
+
+    Only correct when every request for a game reaches the same process
+    (a single worker).  Each change is appended to the replay log
+    ``<path>/games-<pid>.jsonl`` before the response is sent; after each
+    flush the log is replaced by one holding only the changes not yet
+    flushed, so it stays as small as the set of dirty games.
+    '''
+    def __init__(self, path, fsync=False):
+        self._lock = threading.Lock()
+        self._games = {}     # game_id -> [GameState, version, dirty, updated]
+        self._dir = path
+        self._fsync = fsync
+        self._pid = None
+        self._log = None
+        os.makedirs(path, exist_ok=True)
+
+    def _check_pid(self):
+        '''Start an empty cache and a new replay log in a forked process'''
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._games = {}
+            self._log = open(os.path.join(
+                self._dir, 'games-{}.jsonl'.format(self._pid)), 'a', encoding='utf8')
+
+    def get(self, game_id):
+        with self._lock:
+            self._check_pid()
+            entry = self._games.get(game_id)
+            return None if entry is None else (GameState.from_game(entry[0]), entry[1])
+
+    def put(self, state, dirty):
+        with self._lock:
+            self._check_pid()
+            entry = self._games.get(state.game_id)
+            version = 1 if entry is None else entry[1] + 1
+            self._games[state.game_id] = [GameState.from_game(state), version,
+                                          dirty, time.time()]
+            if dirty:
+                self._log.write(json.dumps(game_to_state(state)) + '\n')
+                self._log.flush()
+                if self._fsync:
+                    os.fsync(self._log.fileno())
+            return version
+
+    def delete(self, game_id):
+        with self._lock:
+            self._check_pid()
+            self._games.pop(game_id, None)
+
+    def dirty(self):
+        with self._lock:
+            self._check_pid()
+            return [ (GameState.from_game(e[0]), e[1])
+                     for e in self._games.values() if e[2] ]
+
+    def mark_clean(self, flushed, idle_ttl):
+        '''Clear the dirty flag of entries still at the flushed versions and
+        evict clean entries idle for ``idle_ttl`` seconds'''
+        cutoff = time.time() - idle_ttl
+        with self._lock:
+            self._check_pid()
+            for game_id, version in flushed:
+                entry = self._games.get(game_id)
+                if entry is not None and entry[1] == version:
+                    entry[2] = False
+            for game_id in [ k for k, e in self._games.items()
+                             if not e[2] and e[3] < cutoff ]:
+                del self._games[game_id]
+            self._rotate([ e[0] for e in self._games.values() if e[2] ])
+
+    def _rotate(self, states):
+        '''Replace the replay log with one holding only ``states``.  The new
+        log is written aside and renamed over the old one, so a crash
+        meanwhile leaves one of the two whole.'''
+        path = self._log.name
+        with open(path + '.new', 'w', encoding='utf8') as new:
+            new.write(''.join(json.dumps(game_to_state(state)) + '\n'
+                              for state in states))
+            new.flush()
+            if self._fsync:
+                os.fsync(new.fileno())
+        os.replace(path + '.new', path)
+        self._log.close()
+        self._log = open(path, 'a', encoding='utf8')
+
+    def orphaned_logs(self):
+        '''Return replay logs left behind by processes that have exited'''
+        paths = []
+        for path in glob.glob(os.path.join(self._dir, 'games-*.jsonl')):
+            pid = int(os.path.basename(path)[6:-6])
+            if pid != os.getpid() and not _pid_alive(pid):
+                paths.append(path)
+        return paths
+
+    @contextlib.contextmanager
+    def recovering(self):
+        '''Hold an exclusive lock on the log directory, so two workers
+        starting together do not replay or delete the same log'''
+        with open(os.path.join(self._dir, 'recover.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+class SqliteBackend:
+    '''Active game states in a local sqlite file shared by all workers on
+    the host.  Each change is committed to the file, so a worker crash
+    loses nothing and the file itself is the replay log.'''
+    def __init__(self, path, fsync=False):
+        self._path = path
+        self._sync = 'FULL' if fsync else 'NORMAL'
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS game_state ('
+                         'game_id TEXT PRIMARY KEY, state TEXT NOT NULL, '
+                         'version INTEGER NOT NULL, dirty INTEGER NOT NULL, '
+                         'updated REAL NOT NULL)')
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self._path, timeout=10)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=' + self._sync)
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def get(self, game_id):
+        row = self._conn().execute(
+            'SELECT state, version FROM game_state WHERE game_id = ?',
+            (game_id,)).fetchone()
+        return None if row is None else (state_to_game(json.loads(row[0])), row[1])
+
+    def put(self, state, dirty):
+        with self._conn() as conn:
+            conn.execute(
+                'INSERT INTO game_state VALUES (?, ?, 1, ?, ?) '
+                'ON CONFLICT(game_id) DO UPDATE SET state = excluded.state, '
+                'version = version + 1, dirty = excluded.dirty, '
+                'updated = excluded.updated',
+                (state.game_id, json.dumps(game_to_state(state)), int(dirty),
+                 time.time()))
+            return conn.execute(
+                'SELECT version FROM game_state WHERE game_id = ?',
+                (state.game_id,)).fetchone()[0]
+
+    def delete(self, game_id):
+        with self._conn() as conn:
+            conn.execute('DELETE FROM game_state WHERE game_id = ?', (game_id,))
+
+    def dirty(self):
+        return [ (state_to_game(json.loads(state)), version) for state, version in
+                 self._conn().execute(
+                     'SELECT state, version FROM game_state WHERE dirty = 1') ]
+
+    def mark_clean(self, flushed, idle_ttl):
+        with self._conn() as conn:
+            conn.executemany(
+                'UPDATE game_state SET dirty = 0 WHERE game_id = ? AND version = ?',
+                flushed)
+            conn.execute('DELETE FROM game_state WHERE dirty = 0 AND updated < ?',
+                         (time.time() - idle_ttl,))
+
+    def orphaned_logs(self):
+        return []
+
+    def recovering(self):
+        return contextlib.nullcontext()
+
+class GameStore:
+    '''Optional write-behind cache of active game state
+
+    Configured by ``GAME_STORE`` in ``config.yaml``:
+      * ``backend`` - ``none`` (default; every guess commits to the games
+        DB), ``memory`` (this process only; single worker) or ``sqlite``
+        (a local file shared by the workers on one host)
+      * ``path`` - The replay log directory (``memory``) or state file
+        (``sqlite``)
+      * ``flush_interval`` - Seconds between flushes of changed games
+      * ``idle_ttl`` - Seconds before a flushed, idle game leaves the cache
+      * ``fsync`` - Sync each change to disk, not just to the OS
+
+    ``REAPER`` ``idle_hours`` tells which cached games the reaper may have
+    abandoned meanwhile: those are checked against the games DB when loaded.
+
+    A game row is written to the games DB when it is created and when it
+    ends (see ``end``), in the request's transaction; guesses in between only touch the
+    cache and are flushed by a background thread every ``flush_interval``
+    seconds, in a session of its own, whether or not requests keep coming.
+    A finished game leaves the cache once the request has committed (see
+    ``committed``), so a failed commit leaves the game as it was.
+
+    If a worker crashes, the changes since the last flush are in the
+    replay log (``memory``) or the state file (``sqlite``) and are written
+    to the games DB by the next worker to start, so the loss is bounded by
+    what the OS had not written to disk: nothing for a process crash, and
+    for a host crash at most the unsynced writes (none with ``fsync``).
+    Should the local files themselves be lost, the games DB is behind by at
+    most ``flush_interval`` seconds of guesses.
+    '''
+    def __init__(self):
+        self.backend = None
+        self.flush_interval = 30
+        self.idle_ttl = 3600
+        self.reap_after = 24 * 3600
+        self._lock = threading.Lock()
+        self._pid = None          # process whose recovery and flusher ran
+        self._stop = threading.Event()
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    def configure(self, config):
+        '''Select the backend from the application ``config``'''
+        options = dict(config.get('GAME_STORE') or {})
+        kind = options.get('backend', 'none')
+        fsync = bool(options.get('fsync', False))
+        self.flush_interval = float(options.get('flush_interval', 30))
+        self.idle_ttl = float(options.get('idle_ttl', 3600))
+        self.reap_after = float(dict(config.get('REAPER') or {})
+                                .get('idle_hours', 24)) * 3600
+        if kind == 'memory':
+            self.backend = MemoryBackend(
+                options.get('path', '/tmp/langman-games'), fsync)
+        elif kind == 'sqlite':
+            self.backend = SqliteBackend(
+                options.get('path', '/tmp/langman-games.db'), fsync)
+        elif kind in ('none', None):
+            self.backend = None
+        else:
+            raise ValueError('Unknown GAME_STORE backend {}'.format(kind))
+        with self._lock:
+            self._stop.set()          # stop the flusher of the old backend
+            self._pid = None
+
+    def _start(self):
+        '''Once per process: replay the logs of crashed workers, then start
+        the thread that flushes changed games'''
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self.recover()
+            self._stop = threading.Event()
+            threading.Thread(target=self._flush_loop, args=(self._stop,),
+                             name='game-store-flush', daemon=True).start()
+            self._pid = os.getpid()
+
+    def _flush_loop(self, stop):
+        while not stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                log.exception('Could not flush cached game changes')
+
+    @staticmethod
+    def _session():
+        '''Return a new session of the games DB, apart from the request's'''
+        return Session(bind=registry.engine('DB_GAMES'))
+
+    def recover(self):
+        '''Write changes left behind by crashed workers to the games DB,
+        then flush.  Commits in a session of its own.'''
+        with self.backend.recovering():
+            for path in self.backend.orphaned_logs():
+                latest = {}
+                try:
+                    with open(path, encoding='utf8') as replay:
+                        for line in replay:
+                            try:
+                                state = state_to_game(json.loads(line))
+                            except ValueError:
+                                break          # torn final line
+                            latest[state.game_id] = state
+                except FileNotFoundError:
+                    continue
+                session = self._session()
+                try:
+                    for state in latest.values():
+                        write_forward(session, state)
+                    session.commit()
+                finally:
+                    session.close()
+                os.remove(path)
+                if os.path.exists(path + '.new'):
+                    os.remove(path + '.new')
+                log.info('Replayed %d games from %s', len(latest), path)
+        self.flush()
+
+    def load(self, session, game_id):
+        '''Return game ``game_id`` or None.  With a backend, the game is a
+        ``GameState`` from the cache (cached on a miss), not attached to
+        ``session``; changes reach the DB through ``save``.
+
+        A cached game idle for long enough that the reaper may have
+        abandoned it (its last guess more than ``reap_after`` less
+        ``flush_interval`` seconds ago, as the DB can be that far behind)
+        is checked in the games DB first, and if it has ended there, it
+        leaves the cache and the row is returned.'''
+        if not self.enabled:
+            return session.query(Game).filter(Game.game_id == game_id).one_or_none()
+        self._start()
+        cached = self.backend.get(game_id)
+        if cached is not None:
+            state = cached[0]
+            idle_since = datetime.datetime.now() - datetime.timedelta(
+                seconds=self.reap_after - self.flush_interval)
+            if (state.last_move or state.start_time) >= idle_since or \
+               session.query(Game.end_time).filter(
+                   Game.game_id == game_id).scalar() is None:
+                return state
+            self.backend.delete(game_id)
+        game = session.query(Game).filter(Game.game_id == game_id).one_or_none()
+        if game is None:
+            return None
+        state = GameState.from_game(game)
+        if state._result() == 'active':
+            self.backend.put(state, dirty=False)
+        return state
+
+    def cached(self, game_id):
+        '''Return the cached ``GameState`` of game ``game_id``, or None if it
+        is not cached'''
+        if not self.enabled:
+            return None
+        cached = self.backend.get(game_id)
+        return None if cached is None else cached[0]
+
+    def created(self, game):
+        '''Cache a new ``game`` that has been committed to the games DB'''
+        if self.enabled:
+            self._start()
+            self.backend.put(GameState.from_game(game), dirty=False)
+
+    def save(self, session, game):
+        '''Record a guess in the active ``game``: with a backend, in the
+        cache only, to be flushed by the background thread'''
+        if self.enabled:
+            self._start()
+            self.backend.put(game, dirty=True)
+
+    def end(self, session, game, end_time):
+        '''End the finished ``game`` at ``end_time`` in the games DB in
+        ``session``, for the caller to commit along with the player's
+        counters and then to call ``committed``.  Returns False, writing
+        nothing, if the game has ended there meanwhile (abandoned by the
+        reaper), so it is not counted twice.'''
+        if not self.enabled:
+            ended = session.query(Game).filter(
+                Game.game_id == game.game_id, Game.end_time.is_(None)
+            ).update({Game.end_time: end_time}, synchronize_session=False)
+            if ended:
+                set_committed_value(game, 'end_time', end_time)
+            return bool(ended)
+        self._start()
+        game.end_time = end_time
+        return bool(write_forward(session, game))
+
+    def committed(self, game):
+        '''Drop ``game`` from the cache if it has finished; call once the
+        transaction that ``save`` wrote it in has committed'''
+        if self.enabled and game._result() != 'active':
+            self.backend.delete(game.game_id)
+
+    def delete(self, game_id):
+        if self.enabled:
+            self.backend.delete(game_id)
+
+    def flush(self):
+        '''Write all changed games to the games DB in a session of its own
+        and commit; returns the number of games written'''
+        if not self.enabled:
+            return 0
+        dirty = self.backend.dirty()
+        if dirty:
+            session = self._session()
+            try:
+                for state, version in dirty:
+                    write_forward(session, state)
+                session.commit()
+            finally:
+                session.close()
+        self.backend.mark_clean(
+            [ (state.game_id, version) for state, version in dirty ],
+            self.idle_ttl)
+        return len(dirty)
+
+game_store = GameStore()
@@ -1,20 +1,25 @@
 import datetime
+import logging
 import random
 import uuid
 
-from flask import g
+from flask import g, request, Response
 from flask_restplus import Resource, Namespace
-from sqlalchemy.sql import func
-from unidecode import unidecode
 import flask_jwt_extended as JWT
-from .langman_orm import Usage, User, Game
+from werkzeug.http import quote_etag
+from .langman_orm import LETTER_BITS, User, Game
+from .game_store import game_store
+from .leaderboard import record_game
+from .tokens import tokens
+from .usage_index import DIFFICULTIES, SeenSet, usage_index
 
 games_api = Namespace('games', description='Creating and playing games')
+log = logging.getLogger(__name__)
 
 @games_api.route('')
 class Games(Resource):
     valid_langs = ('en', 'es', 'fr')
-    @JWT.jwt_required
+    @tokens.jwt_required
     def post(self):
         '''Start a new game and return the game id
 
@@ -22,6 +27,7 @@ class Games(Resource):
 
         :payload:
               * ``language`` Language to play in (e.g., 'en')
+              * ``difficulty`` Optional, one of 'easy', 'medium' or 'hard'
 
         :returns:
            A success message:
@@ -38,49 +44,116 @@ class Games(Resource):
         if lang not in self.valid_langs:
             return {'message': 'New game POST language must be from ' +
                                ', '.join(Games.valid_langs)}, 400
+        difficulty = games_api.payload.get('difficulty')
+        if difficulty is not None and difficulty not in DIFFICULTIES:
+            return {'message': 'New game POST difficulty must be from ' +
+                               ', '.join(DIFFICULTIES)}, 400
 
-        # if user does not exist, create user; get user id
-        user = g.games_db.query(User).filter(User.user_id == user_id).one_or_none()
-        if user is None:
-            user = User(
-                user_id = user_id, 
-                user_name = name,
-                first_time = datetime.datetime.now(),
-            )
-            g.games_db.add(user)
-            g.games_db.commit()
-            user = g.games_db.query(User).filter(User.user_name == name).one()
-        user._game_started(lang)
-        
-        # select a usage example
-        usage = g.usage_db.query(Usage).filter(
-            Usage.language==lang
-        ).order_by(func.random()).first()
-        
-        # create the new game
+        # select a usage example the player has not seen, from the
+        # difficulty's bucket if given (a new player has no record yet)
+        seen = SeenSet(g.games_db.query(User.seen_usages)
+                                 .filter(User.user_id == user_id).scalar())
+        usage = usage_index.random(lang, difficulty, seen)
+
+        # create or update the player's record and create the new game,
+        # committed together
+        now = datetime.datetime.now()
+        User._upsert_game_started(g.games_db, user_id, name, lang,
+                                  seen.to_bytes(), now)
         new_game_id = str(uuid.uuid4())
         new_game = Game(
             game_id  = new_game_id,
-            player   = user.user_id,
+            player   = user_id,
             usage_id = usage.usage_id,
+            guessed_mask = 0,
+            other_misses = 0,
+            guess_order = '',
             bad_guesses = 0,
-            reveal_word = '_' * len(usage.secret_word),
-            start_time = datetime.datetime.now()
+            start_time = now,
+            last_move = now
         )
         g.games_db.add(new_game)
+        game_store.created(new_game)
         g.games_db.commit()
 
         # return the new game id
         return { 'message': 'success', 'game_id':new_game_id,
-                 'access_token': JWT.create_access_token(
-                     identity=user_id,
-                     user_claims={'access':'player',
-                                  'name':name,
-                                  'game_id':new_game_id}) }
+                 'access_token': tokens.game_token(user_id, name, new_game_id) }
+
+def _guess_letter(letter):
+    '''Return ``letter`` lower-cased, or None if it is not a single
+    alphabetic character'''
+    if not (isinstance(letter, str) and letter.isalpha() and len(letter) == 1):
+        return None
+    return letter.lower()
+
+def _already_guessed(game, letter):
+    '''True if ``letter``, from ``_guess_letter``, was guessed in ``game``'''
+    if letter in LETTER_BITS:
+        return bool(game.guessed_mask & LETTER_BITS[letter])
+    return letter in (game.guess_order or '')
+
+def _game_etag(game):
+    '''Return the entity tag of a game GET response: the game id, its
+    ``_version`` and the ``game_token_epoch``, so every worker gives the
+    same tag for the same state, and a cached response's access token stays
+    usable for as long as the tag matches.  The tag is weak, as workers
+    hand out different tokens for the same state.'''
+    return '{}-{}-{}'.format(game.game_id, game._version(), tokens.game_token_epoch())
+
+def _playable_game(game_id):
+    '''Return the active game ``game_id`` and its usage for a guess, aborting
+    if the token is not for this game or the game is missing or over'''
+    user_claims = JWT.get_jwt_claims()
+    if user_claims.get('game_id', '') != game_id:
+        games_api.abort(503, 'Unauthorized access to game {}'.format(game_id))
+    # check input is valid; return error if game non-existent or inactive
+    game = game_store.load(g.games_db, game_id)
+    if game is None:
+        games_api.abort(404, 'Game with id {} does not exist'.format(game_id))
+    if game._result() != 'active':
+        games_api.abort(403, 'Game with id {} is over'.format(game_id))
+    return game, usage_index.get(game.usage_id)
+
+def _apply_guess(game, usage, letter):
+    '''Update ``game`` for the new guess ``letter``, from ``_guess_letter``;
+    a letter outside ``LETTER_BITS`` (such as 'é') is never in the folded
+    secret word, so it is counted in ``other_misses``'''
+    game.guessed_mask |= LETTER_BITS.get(letter, 0)
+    game.guess_order = (game.guess_order or '') + letter
+    if not usage.guess.is_good(letter):
+        game.bad_guesses += 1
+        if letter not in LETTER_BITS:
+            game.other_misses = (game.other_misses or 0) + 1
+    game.last_move = datetime.datetime.now()
+
+def _finish_update(game, usage, old_dict):
+    '''Record the end of ``game`` if it is over, save it, and return its
+    state for the response, checked against the state ``old_dict``'''
+    # if game is over, update the user record
+    outcome = game._result()
+    if outcome != 'active':
+        if not game_store.end(g.games_db, game, game.last_move):
+            # abandoned by the reaper since it was loaded; already counted
+            games_api.abort(403, 'Game with id {} is over'.format(game.game_id))
+        user = g.games_db.query(User).filter(User.user_id == game.player).one()
+        user._game_ended(outcome, game.end_time - game.start_time)            
+        record_game(g.games_db, user, usage.language, outcome,
+                    game.end_time - game.start_time, game.end_time)
+    else:
+        game_store.save(g.games_db, game)
+
+    game_dict = game._to_dict(old_dict, usage)
+    game_dict['usage']  = usage.blanked()
+    game_dict['lang']   = usage.language
+    game_dict['source'] = usage.source
+    if outcome != 'active':
+        game_dict['secret_word'] = usage.secret_word
+    return game_dict
 
 @games_api.route('/<game_id>')
 class OneGame(Resource):
-    @JWT.jwt_required
+    @tokens.jwt_required
     def get(self, game_id):
         '''Get the game ``game_id`` information
 
@@ -91,42 +164,55 @@ class OneGame(Resource):
               * ``game_id`` The game's UUID
               * ``player`` The player's name
               * ``usage_id`` The game usage id from the Usages table
-              * ``guessed`` A string of guessed letters
+              * ``guessed`` A string of guessed letters, in alphabetical order
               * ``reveal_word`` Guessed letters in otherwise blanked word string
               * ``bad_guesses`` Number of incorrect guesses so far
               * ``start_time`` The epoch ordinal time when game began
               * ``end_time`` The epoch ordinal time when game ended
-              * ``result`` Game outcome from ('lost', 'won', 'active')
+              * ``result`` Game outcome from ('lost', 'won', 'abandoned',
+                'active')
               * ``usage`` The full sentence example with guess-word blanked
               * ``lang`` The language of the example, such as 'en'
               * ``source`` The book from which the usage example originated
+              * ``access_token`` The token for playing this game
+
+        The response carries a weak ``ETag`` that changes with each guess
+        (and with the token period); a request with that tag in
+        ``If-None-Match`` gets an empty 304 instead.  With the game state
+        cache enabled, an active game answers a 304 without a database
+        query.
         '''
         # check input is valid
-        game = g.games_db.query(Game).filter(Game.game_id == game_id).one_or_none()
+        game = game_store.load(g.games_db, game_id)
         
         # if game does not exist or belongs to another user, produce error code
         if (game is None or game.player != JWT.get_jwt_identity()
             or 'game_id' in JWT.get_jwt_claims()):
-            print(game._to_dict(), JWT.get_jwt_identity(), JWT.get_jwt_claims())
+            log.info('Game %s refused to user %s', game_id, JWT.get_jwt_identity())
             games_api.abort(404, 'Game {} is unauthorized'.format(game_id))
         
+        etag = _game_etag(game)
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+            response.set_etag(etag, weak=True)
+            return response
+
+        # provide the access token for this game, reused for its token period
+        token = tokens.game_token(
+                JWT.get_jwt_identity(), JWT.get_jwt_claims()['name'], game_id)
+        
         # get usage record because it contains the language and usage example
-        usage = g.usage_db.query(Usage).filter(Usage.usage_id == game.usage_id).one()
+        usage = usage_index.get(game.usage_id)
         
         # return game state
-        game_dict = game._to_dict()
-        game_dict['usage']  = usage.usage.format(word='_'*len(usage.secret_word))
+        game_dict = game._to_dict(usage=usage)
+        game_dict['usage']  = usage.blanked()
         game_dict['lang']   = usage.language
         game_dict['source'] = usage.source
-
-        # provide the access token for this game
-        game_dict['access_token'] = JWT.create_access_token(
-                identity   = JWT.get_jwt_identity(), 
-                user_claims={'access':'player', 'game_id':game_id,
-                             'name':JWT.get_jwt_claims()['name']})
-        return game_dict
+        game_dict['access_token'] = token
+        return game_dict, 200, {'ETag': quote_etag(etag, weak=True)}
     
-    @JWT.jwt_required
+    @tokens.jwt_required
     def put(self, game_id):
         '''Update game ``game_id`` as resulting from a guessed letter
 
@@ -141,7 +227,7 @@ class OneGame(Resource):
               * ``game_id`` The game's UUID
               * ``player`` The player's name
               * ``usage_id`` The game usage id from the Usages table
-              * ``guessed`` A string of guessed letters
+              * ``guessed`` A string of guessed letters, in alphabetical order
               * ``reveal_word`` Guessed letters in otherwise blanked word string
               * ``bad_guesses`` Number of incorrect guesses so far
               * ``start_time`` The epoch ordinal time when game began
@@ -151,54 +237,25 @@ class OneGame(Resource):
         This method interacts with the database to update the
         indicated game.
         '''
-        user_claims = JWT.get_jwt_claims()
-        if user_claims.get('game_id', '') != game_id:
-            games_api.abort(503, 'Unauthorized access to game {}'.format(game_id))
-        # check input is valid; return error if game non-existent or inactive
-        game = g.games_db.query(Game).filter(Game.game_id == game_id).one_or_none()
-        if game is None:
-            games_api.abort(404, 'Game with id {} does not exist'.format(game_id))
-        if game._result() != 'active':
-            games_api.abort(403, 'Game with id {} is over'.format(game_id))
-        old_dict = game._to_dict()       # NEW LINE IN UPDATE
-        if ('letter' not in games_api.payload or
-            not games_api.payload['letter'].isalpha() or
-            len(games_api.payload['letter']) != 1):
+        game, usage = _playable_game(game_id)
+        old_dict = game._to_dict(usage=usage)
+        letter = _guess_letter((games_api.payload or {}).get('letter'))
+        if letter is None:
             games_api.abort(400, 'PUT requires one alphabetic character in "letter" field')
-        letter = games_api.payload['letter'].lower()
         
         # update game state according to guess
-        if letter in game.guessed:             # check for repeated guess
+        if _already_guessed(game, letter):            # check for repeated guess
             games_api.abort(403, 'Letter {} was already guessed'.format(letter))
-        game.guessed = game.guessed + letter
-        usage  = g.usage_db.query(Usage).filter(Usage.usage_id == game.usage_id).one()
-        if letter in unidecode(usage.secret_word.lower()):
-            game.reveal_word = ''.join([
-                l if unidecode(l.lower()) in game.guessed else '_'
-                for l in usage.secret_word])
-        else:
-            game.bad_guesses += 1
-            
-        # if game is over, update the user record
-        outcome = game._result()
-        if outcome != 'active':
-            user = g.games_db.query(User).filter(User.user_id == game.player).one()
-            game.end_time = datetime.datetime.now()
-            user._game_ended(outcome, game.end_time - game.start_time)            
+        _apply_guess(game, usage, letter)
 
         # return the modified game state
-        game_dict = game._to_dict(old_dict)
-        game_dict['usage']  = usage.usage.format(word='_'*len(usage.secret_word))
-        game_dict['lang']   = usage.language
-        game_dict['source'] = usage.source
-        if outcome != 'active':
-            game_dict['secret_word'] = usage.secret_word
-        
+        game_dict = _finish_update(game, usage, old_dict)
         g.games_db.commit()
+        game_store.committed(game)
 
         return game_dict
     
-    @JWT.jwt_required
+    @tokens.jwt_required
     def delete(self, game_id):
         '''Delete record for game ``game_id``
 
@@ -213,6 +270,7 @@ class OneGame(Resource):
         if JWT.get_jwt_claims().get('game_id', '') != game_id:
             games_api.abort(503, 'Unauthorized access to game {}'.format(game_id))
 
+        game_store.delete(game_id)
         game = g.games_db.query(Game).filter(Game.game_id == game_id).one_or_none()
         if game is not None:
             g.games_db.delete(game)
@@ -223,3 +281,59 @@ class OneGame(Resource):
 
         return {'message': msg}
     
+@games_api.route('/<game_id>/guesses')
+class GameGuesses(Resource):
+    @tokens.jwt_required
+    def put(self, game_id):
+        '''Update game ``game_id`` with a sequence of guessed letters
+
+        :route: ``/<game_id>/guesses`` PUT (valid game-specific token required)
+
+        :payload:
+           The guessed letters as an object:
+              * ``letters`` A list of single letters, applied in order
+
+        :returns:
+           The object for a game as from the ``/<game_id>`` PUT, after all
+           the letters, plus:
+              * ``results`` A list with, for each letter, an object with the
+                ``letter``, the ``status`` code its single PUT would return,
+                and either ``correct`` (whether it was in the word) or the
+                error ``message``
+
+        Each letter gets the same checks as a single PUT (one alphabetic
+        character, not yet guessed, game still active); refused letters
+        are reported and skipped.  All the accepted letters are saved in
+        one transaction.
+        '''
+        game, usage = _playable_game(game_id)
+        letters = (games_api.payload or {}).get('letters')
+        if not isinstance(letters, list):
+            games_api.abort(400, 'PUT requires a list of letters in "letters" field')
+
+        old_dict = game._to_dict(usage=usage)
+        results = []
+        for letter in letters:
+            guess = _guess_letter(letter)
+            if game._result(usage.guess) != 'active':
+                results.append({'letter': letter, 'status': 403,
+                                'message': 'Game with id {} is over'.format(game_id)})
+            elif guess is None:
+                results.append({'letter': letter, 'status': 400, 'message':
+                                'PUT requires one alphabetic character in "letter" field'})
+            elif _already_guessed(game, guess):
+                results.append({'letter': letter, 'status': 403, 'message':
+                                'Letter {} was already guessed'.format(guess)})
+            else:
+                bad_guesses = game.bad_guesses
+                _apply_guess(game, usage, guess)
+                old_dict = game._to_dict(old_dict, usage)   # check each step
+                results.append({'letter': letter, 'status': 200,
+                                'correct': game.bad_guesses == bad_guesses})
+
+        game_dict = _finish_update(game, usage, None)
+        game_dict['results'] = results
+        g.games_db.commit()
+        game_store.committed(game)
+
+        return game_dict
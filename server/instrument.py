@@ -0,0 +1,134 @@
+import bisect
+import cProfile
+import os
+import random
+import threading
+import time
+
+from flask import g, has_request_context, jsonify, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+BUCKETS_MS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+class Histograms:
+    '''Latency histograms keyed by ``(endpoint, phase)`` for this process'''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}       # key -> [bucket counts, count, sum in ms]
+
+    def add(self, endpoint, phase, ms):
+        i = bisect.bisect_left(BUCKETS_MS, ms)
+        with self._lock:
+            entry = self._data.get((endpoint, phase))
+            if entry is None:
+                entry = self._data[(endpoint, phase)] = [[0] * (len(BUCKETS_MS) + 1), 0, 0.0]
+            entry[0][i] += 1
+            entry[1] += 1
+            entry[2] += ms
+
+    def to_dict(self):
+        '''Return the histograms as ``{endpoint: {phase: stats}}`` where the
+        stats hold the ``count``, ``sum_ms`` and cumulative ``buckets``'''
+        with self._lock:
+            items = [ (k, list(e[0]), e[1], e[2]) for k, e in self._data.items() ]
+        result = {}
+        for (endpoint, phase), counts, count, total in sorted(items):
+            cumulative, buckets = 0, {}
+            for bound, n in zip(BUCKETS_MS + ('+Inf',), counts):
+                cumulative += n
+                buckets[str(bound)] = cumulative
+            result.setdefault(endpoint, {})[phase] = {
+                'count': count, 'sum_ms': round(total, 3), 'buckets': buckets}
+        return result
+
+histograms = Histograms()
+
+def record(phase, seconds):
+    '''Add ``seconds`` to the current request's timing for ``phase``; does
+    nothing unless instrumentation is on'''
+    if has_request_context() and hasattr(g, '_timings'):
+        timing = g._timings.setdefault(phase, [0.0, 0])
+        timing[0] += seconds
+        timing[1] += 1
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('_query_start', []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['_query_start'].pop()
+    record('sql', elapsed)
+    record('sql_' + statement.lstrip().split(None, 1)[0].lower(), elapsed)
+
+def _before_commit(session):
+    session.info['_commit_start'] = time.perf_counter()
+
+def _after_commit(session):
+    start = session.info.pop('_commit_start', None)
+    if start is not None:
+        record('commit', time.perf_counter() - start)
+
+def init_app(app):
+    '''Turn on request instrumentation if ``INSTRUMENT`` in the config has
+    ``enabled: true``; otherwise nothing is registered at all.
+
+    Each request is timed in phases: ``total``, ``jwt`` (token
+    verification, recorded by ``tokens.verify_jwt_in_request``), ``sql`` (every statement, also split by kind as
+    ``sql_select``, ``sql_insert``, ...) and ``commit`` (flush and commit).
+    The timings are sent in a ``Server-Timing`` header and added to
+    per-process histograms served as JSON at ``/api/metrics`` to local
+    clients.  A ``profile_rate`` fraction of requests is also run under
+    cProfile, with the stats written to ``profile_dir``.
+    '''
+    options = dict(app.config.get('INSTRUMENT') or {})
+    if not options.get('enabled', False):
+        return
+    profile_rate = float(options.get('profile_rate', 0.0))
+    profile_dir = options.get('profile_dir', '/tmp/langman-profiles')
+    if profile_rate > 0:
+        os.makedirs(profile_dir, exist_ok=True)
+
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Session, 'before_commit', _before_commit)
+        event.listen(Session, 'after_commit', _after_commit)
+
+    @app.before_request
+    def start_timing():
+        g._timings = {}
+        g._request_start = time.perf_counter()
+        if profile_rate > 0 and random.random() < profile_rate:
+            g._profiler = cProfile.Profile()
+            g._profiler.enable()
+
+    @app.after_request
+    def finish_timing(response):
+        if not hasattr(g, '_request_start'):
+            return response
+        record('total', time.perf_counter() - g._request_start)
+        profiler = g.pop('_profiler', None)
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(os.path.join(profile_dir, '{:.6f}-{}-{}.prof'.format(
+                time.time(), request.method, request.endpoint)))
+
+        endpoint = '{} {}'.format(
+            request.method, request.url_rule.rule if request.url_rule else '<unmatched>')
+        header = []
+        for phase, (seconds, count) in g._timings.items():
+            histograms.add(endpoint, phase, seconds * 1000)
+            header.append('{};dur={:.3f}{}'.format(
+                phase, seconds * 1000,
+                ';desc="{} calls"'.format(count) if count > 1 else ''))
+        response.headers['Server-Timing'] = ', '.join(header)
+        return response
+
+    @app.route('/api/metrics')
+    def metrics():
+        if request.remote_addr not in ('127.0.0.1', '::1', None):
+            return jsonify(message='Metrics are only served locally'), 403
+        from .tokens import tokens
+        return jsonify(pid=os.getpid(), buckets_ms=BUCKETS_MS,
+                       histograms=histograms.to_dict(), tokens=tokens.stats())
@@ -1,17 +1,35 @@
 import datetime
-import json
+import functools
 
-from sqlalchemy import create_engine, Column, types, MetaData, ForeignKey
+from sqlalchemy import create_engine, Column, types, MetaData, ForeignKey, Index
+from sqlalchemy import bindparam, text
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
-from unidecode import unidecode
+from sqlalchemy.orm import sessionmaker, relationship, object_session
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.sql import func
 
+from .consistency import consistency_checks
 from .util import date_to_ordinal
 
 meta = MetaData()
 base_games = declarative_base(meta)
 base_usage = declarative_base(meta)
 
+LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+LETTER_BITS = { l: 1 << i for i, l in enumerate(LETTERS) }
+
+def letters_to_mask(letters):
+    '''Return the bit mask of ``letters`` (bit 0 for 'a' to bit 25 for
+    'z'); anything not in ``LETTERS`` is ignored'''
+    mask = 0
+    for letter in letters:
+        mask |= LETTER_BITS.get(letter, 0)
+    return mask
+
+def mask_to_letters(mask):
+    '''Return the letters of bit mask ``mask`` in alphabetical order'''
+    return ''.join([ l for i, l in enumerate(LETTERS) if mask >> i & 1 ])
+
 class Usage(base_usage):
     '''Table ``usages`` with fields:
       * ``usage_id`` - UUID primary key string of length 38
@@ -19,6 +37,8 @@ class Usage(base_usage):
       * ``secret_word`` - Word to be guesses (length <= 25)
       * ``usage`` - Usage sentence, length <= 400,  with word blanked
       * ``source`` - Text from which the usage sentence is drawn
+      * ``content_hash`` - Digest of the other fields, used to skip
+        unchanged rows when reloading the corpus
     '''
     __tablename__ = 'usages'
     usage_id    = Column(types.Integer, primary_key=True)
@@ -26,126 +46,411 @@ class Usage(base_usage):
     secret_word = Column(types.String(length=25), nullable=False)
     usage       = Column(types.String(length=400), nullable=False)
     source      = Column(types.String(length=100))
+    content_hash = Column(types.String(length=32))
 
 class User(base_games):
     '''Table ``users`` with fields:
       * ``user_id`` - UUID primary key of length 38
       * ``user_name`` - String of maximum length 30
       * ``num_games`` - Integer count of games started
-      * ``outcomes`` - JSON string storing game counts by outcome
-      * ``by_lang`` - JSON string storing game counts by game language
+      * ``outcome_<outcome>`` - Integer count of games by outcome, one
+        column for each of ``OUTCOMES`` (``abandoned`` games are those
+        closed by the ``reap-games`` command)
+      * ``lang_<lang>`` - Integer count of games by language, one column
+        for each of ``LANGUAGES``
       * ``first_time`` - DateTime indicating when first game was played
-      * ``total_time`` - TimeDelta of total time with active games
-      * ``avg_time`` - TimeDelta of the average game length
+      * ``total_micros`` - Integer total length of the finished games in
+        microseconds, added to in the counters' ``UPDATE``
+      * ``seen_usages`` - Bitmap of the usage ids already served to the
+        player (see ``usage_index.SeenSet``)
     '''
     __tablename__ = 'users'
+    OUTCOMES       = ('active', 'won', 'lost', 'abandoned')
+    LANGUAGES      = ('en', 'es', 'fr')
     user_id        = Column(types.String(length=38), primary_key=True)
     user_name      = Column(types.String(length=30), nullable=False)
     num_games      = Column(types.Integer, default=0)
-    outcomes       = Column(types.Text, default='{}')
-    by_lang        = Column(types.Text, default='{}')
+    outcome_active = Column(types.Integer, nullable=False, default=0, server_default='0')
+    outcome_won    = Column(types.Integer, nullable=False, default=0, server_default='0')
+    outcome_lost   = Column(types.Integer, nullable=False, default=0, server_default='0')
+    outcome_abandoned = Column(types.Integer, nullable=False, default=0, server_default='0')
+    lang_en        = Column(types.Integer, nullable=False, default=0, server_default='0')
+    lang_es        = Column(types.Integer, nullable=False, default=0, server_default='0')
+    lang_fr        = Column(types.Integer, nullable=False, default=0, server_default='0')
     first_time     = Column(types.DateTime)
-    total_time     = Column(types.Interval)
-    avg_time       = Column(types.Interval)
-
-    # TODO: fix this
-    # games          = relationship('Game', foreign_keys='Game.user_id')
-    def _incr_json_field(self, field, key):
-        '''Increment the value of self.``field``[``key``] by one where 
-        ``field`` is a JSON text string. (Does not commit.)'''
-        d = json.loads(getattr(self, field))
-        d[key] = d.get(key, 0) + 1
-        setattr(self, field, json.dumps(d))
-
-    def _decr_json_field(self, field, key):
-        '''Decrement the value of self.``field``[``key``] by one where 
-        ``field`` is a JSON text string.  (Does not commit.)'''
-        d = json.loads(getattr(self, field))
-        d[key] = d.get(key, 0) - 1
-        setattr(self, field, json.dumps(d))
-        
+    total_micros   = Column(types.BigInteger, nullable=False, default=0, server_default='0')
+    seen_usages    = Column(types.LargeBinary)
+
+    games          = relationship('Game', back_populates='user', lazy='dynamic')
+
+    @property
+    def outcomes(self):
+        '''Dict of game counts by outcome'''
+        return { k: getattr(self, 'outcome_' + k) or 0 for k in self.OUTCOMES }
+
+    @property
+    def by_lang(self):
+        '''Dict of game counts by language'''
+        return { k: getattr(self, 'lang_' + k) or 0 for k in self.LANGUAGES }
+
+    @property
+    def total_time(self):
+        '''TimeDelta of the total length of the finished games'''
+        return datetime.timedelta(microseconds=self.total_micros or 0)
+
+    @property
+    def avg_time(self):
+        '''TimeDelta of the average game length, over the games started'''
+        return self.total_time / (self.num_games or 1)
+
+    def _incr_counters(self, **deltas):
+        '''Add each of ``deltas`` (a column name mapped to an amount) to
+        this user's row in a single ``UPDATE ... SET x = x + n``, so
+        concurrent games of one player cannot lose updates.  The loaded
+        values are adjusted to match without marking them as changed.
+        (Does not commit.)'''
+        cls = type(self)
+        object_session(self).query(cls).filter(cls.user_id == self.user_id).update(
+            { getattr(cls, k): func.coalesce(getattr(cls, k), 0) + v
+              for k, v in deltas.items() }, synchronize_session=False)
+        for k, v in deltas.items():
+            set_committed_value(self, k, (getattr(self, k) or 0) + v)
+
     def _game_started(self, lang):
-        '''Update the number of games ``num_games`` and both ``outcomes`` and
-        ``by_lang`` counts by one. (Does not commit.)'''
-        self.num_games = (self.num_games or 0) + 1
-        self._incr_json_field('outcomes', 'active')
-        self._incr_json_field('by_lang', lang)
+        '''Update the number of games ``num_games`` and both the ``active``
+        outcome and ``lang`` counts by one. (Does not commit.)'''
+        self._incr_counters(**{'num_games': 1, 'outcome_active': 1,
+                               'lang_' + lang: 1})
+
+    @classmethod
+    def _upsert_game_started(cls, session, user_id, user_name, lang,
+                             seen_usages, now):
+        '''Count a game started in ``lang`` by player ``user_id`` as
+        ``_game_started`` does and store their ``seen_usages``, creating
+        their record (named ``user_name``, first played ``now``) if there is
+        none.  On sqlite and PostgreSQL this is one ``INSERT ... ON
+        CONFLICT`` statement; elsewhere the record is read and updated
+        through the ORM.  (Does not commit.)'''
+        if session.get_bind().dialect.name in ('sqlite', 'postgresql'):
+            session.execute(game_started_upsert(lang), {
+                'user_id': user_id, 'user_name': user_name,
+                'first_time': now, 'seen_usages': seen_usages})
+            return
+        user = session.query(cls).get(user_id)
+        if user is None:
+            user = cls(user_id=user_id, user_name=user_name, first_time=now)
+            session.add(user)
+            session.flush()
+        user._game_started(lang)
+        user.seen_usages = seen_usages
 
     def _game_ended(self, outcome, time_delta):
-        '''Update the ``total_time`` and ``avg_time`` according to a game that 
-        took ``time_delta`` time. Also, update ``outcomes`` by converting one
-        active game to have outcome ``outcome``. (Does not commit.)'''
-        self._decr_json_field('outcomes', 'active')
-        self._incr_json_field('outcomes', outcome)
-        self.total_time  = time_delta + (self.total_time or datetime.timedelta(0))
-        self.avg_time    = self.total_time / self.num_games
-class Game(base_games):
+        '''Add a game that took ``time_delta`` time to ``total_micros``, and
+        update the outcome counts by converting one active game to have
+        outcome ``outcome``, all in the counters' ``UPDATE``. (Does not
+        commit.)'''
+        self._incr_counters(**{'outcome_active': -1, 'outcome_' + outcome: 1,
+                               'total_micros': time_delta // datetime.timedelta(microseconds=1)})
+
+@functools.lru_cache(maxsize=None)
+def game_started_upsert(lang):
+    '''Return the statement of ``User._upsert_game_started`` for ``lang``'''
+    counters = ('num_games', 'outcome_active', 'lang_' + lang)
+    return text(
+        'INSERT INTO users (user_id, user_name, first_time, seen_usages, ' +
+        ', '.join(counters) + ') VALUES (:user_id, :user_name, :first_time, '
+        ':seen_usages, 1, 1, 1) ON CONFLICT (user_id) DO UPDATE SET '
+        'seen_usages = excluded.seen_usages, ' +
+        ', '.join('{0} = COALESCE(users.{0}, 0) + 1'.format(c) for c in counters)
+    ).bindparams(bindparam('first_time', type_=types.DateTime),
+                 bindparam('seen_usages', type_=types.LargeBinary))
+
+class GameMethods:
+    '''Game logic shared by the ``Game`` row and the ``GameState`` kept in
+    the ``game_store`` cache.  The letters guessed are the bit mask
+    ``guessed_mask``, plus ``other_misses`` guesses of letters outside it
+    (such as 'é'), which the folded secret word never has; the revealed
+    word is worked out when needed from the precomputed positions in the
+    usage's ``GuessTable``.'''
+    __slots__ = ()
+    FIELDS = ('game_id', 'player', 'usage_id', 'guessed_mask', 'other_misses',
+              'guess_order', 'bad_guesses', 'start_time', 'end_time', 'last_move')
+
+    def _usage(self):
+        '''Return the ``UsageRow`` of the game from the ``usage_index``'''
+        from .usage_index import usage_index
+        return usage_index.get(self.usage_id)
+
+    def _version(self):
+        '''Return the version of the game state, which grows with every
+        change: two per letter guessed, plus one once the game has ended'''
+        guesses = bin(self.guessed_mask or 0).count('1') + (self.other_misses or 0)
+        return 2 * guesses + (self.end_time is not None)
+
+    def _result(self, guess_table=None):
+        '''Return the result of the game: lost, won, abandoned (ended
+        without being won or lost), or active.  ``guess_table`` is the
+        usage's ``GuessTable``, looked up if not given.'''
+        if self.bad_guesses == 6:
+            return 'lost'
+        if guess_table is None:
+            guess_table = self._usage().guess
+        if guess_table.solved(self.guessed_mask or 0):
+            return 'won'
+        elif self.end_time is not None:
+            return 'abandoned'
+        else:
+            return 'active'
+
+    def _to_dict(self, old_dict=None, usage=None):
+        '''Convert the game into a dictionary suitable for JSON serialization
+
+        Only the documented fields are emitted: the columns, with
+        ``guessed`` (in alphabetical order) and ``reveal_word`` spelled out
+        from ``guessed_mask`` (and ``guess_order`` for the other letters), DateTime fields converted by the
+        date_to_ordinals function, and the ``result``.  ``usage`` is the
+        game's ``UsageRow``, looked up if not given.
+
+        When ``consistency_checks`` says so, the state is checked, and so
+        is the transition to it from ``old_dict`` if given.'''
+        if usage is None:
+            usage = self._usage()
+        mask = self.guessed_mask or 0
+        guessed = mask_to_letters(mask)
+        if self.other_misses:
+            guessed = ''.join(sorted(guessed + ''.join(
+                l for l in self.guess_order or '' if l not in LETTER_BITS)))
+        as_dict = {
+            'game_id': self.game_id,
+            'player': self.player,
+            'usage_id': self.usage_id,
+            'guessed': guessed,
+            'reveal_word': usage.guess.reveal(usage.secret_word, mask),
+            'bad_guesses': self.bad_guesses,
+            'start_time': date_to_ordinal(self.start_time),
+            'end_time': date_to_ordinal(self.end_time),
+            'result': self._result(usage.guess),
+        }
+
+        if consistency_checks.due():
+            try:
+                if old_dict is not None:
+                    assert ( (as_dict['player'] == old_dict['player']) and
+                             (as_dict['usage_id'] == old_dict['usage_id']) and
+                             (old_dict['result'] == 'active') and
+                             (set(old_dict['guessed']) <= set(as_dict['guessed'])) and
+                             (len(as_dict['guessed']) - len(old_dict['guessed']) in (0,1)) ), \
+                             'Invalid game state update from {} to {}'.format(old_dict, as_dict)
+                self._check_consistent(usage.guess)
+            except AssertionError as error:
+                if consistency_checks.failed(self.game_id, error):
+                    raise
+
+        return as_dict
+
+    def _check_consistent(self, guess_table=None):
+        '''Test record to make sure ``guessed_mask`` and ``bad_guesses`` are
+        consistent: the bad guesses are the guessed letters missing from
+        the secret word, per the usage's ``guess_table`` (looked up if not
+        given), and the ``other_misses``'''
+        if guess_table is None:
+            guess_table = self._usage().guess
+        mask = self.guessed_mask or 0
+        misses = guess_table.misses(mask) + (self.other_misses or 0)
+        result = self._result(guess_table)
+        assert ( (0 <= mask < 1 << len(LETTERS)) and
+                 (misses == self.bad_guesses) and
+                 (result in ('lost', 'won', 'abandoned', 'active')) and
+                 (self.bad_guesses <= 6) and
+                 ((self.bad_guesses == 6) or (result in ('active', 'won', 'abandoned'))) ), \
+                'Invalid game state: {} {} {}'.format(mask_to_letters(mask), misses,
+                                                      self.bad_guesses)
+
+class Game(GameMethods, base_games):
     '''Table ``games`` with fields:
       * ``game_id`` - UUID primary key of length 38
       * ``player`` - Player key from ``users`` table, length 38
       * ``usage_id`` - Integer index usage in ``usages`` table
-      * ``guessed`` - A string of the letters guessed so far
-      * ``reveal_word`` - Secret word with guessed letters filled in
+      * ``guessed_mask`` - Bit mask of the letters guessed so far (see
+        ``LETTER_BITS``)
+      * ``other_misses`` - Number of guesses of letters not in
+        ``LETTER_BITS``, all bad
+      * ``guess_order`` - The letters guessed so far, in the order guessed
+        (empty in games from before it was kept)
       * ``bad_guesses`` - Number of bad guesses so far as an integer
       * ``start_time`` - DateTime indicating when the game started
-      * ``end_time`` - DateTime indicating when the game ended
+      * ``end_time`` - DateTime indicating when the game ended, or when it
+        was abandoned
+      * ``last_move`` - DateTime of the last guess (the start until then;
+        null in games from before it was kept), by which the reaper tells
+        idle games
     '''
     __tablename__ = 'games'
     game_id     = Column(types.String(length=38), primary_key=True)
     player      = Column(types.String(length=38), ForeignKey(User.user_id), nullable=False)
     usage_id    = Column(types.Integer, nullable=False) # no foreignkey across DBs
-    guessed     = Column(types.String(length=30), default='')
-    reveal_word = Column(types.String(length=25), nullable=False)
+    guessed_mask = Column(types.Integer, nullable=False, default=0, server_default='0')
+    other_misses = Column(types.Integer, nullable=False, default=0, server_default='0')
+    guess_order = Column(types.String(length=32), nullable=False, default='', server_default='')
     bad_guesses = Column(types.Integer)
     start_time  = Column(types.DateTime)
     end_time    = Column(types.DateTime)
+    last_move   = Column(types.DateTime)
 
-    # TODO: update langman_orm to use relationships correctly
-    # user = relationship('User', foreign_keys='Friend.user_id')
-    # friend = relationship('User', foreign_keys='Friend.friend_id')
+    user = relationship('User', back_populates='games')
 
-    def _result(self):
-        '''Return the result of the game: lost, won, or active'''
-        if self.bad_guesses == 6:
-            return 'lost'
-        elif '_' not in self.reveal_word:
-            return 'won'
-        else:
-            return 'active'
+    __table_args__ = (
+        # a player's games by recency, for keyset pagination of their history
+        Index('ix_games_player_start', 'player', 'start_time', 'game_id'),
+        # unfinished games by age and finished games by end, for the reaper
+        # and for export-games to read what ended since its last run
+        Index('ix_games_end_start', 'end_time', 'start_time'),
+    )
 
-    def _to_dict(self, old_dict=None):
-        '''Convert the game into a dictionary suitable for JSON serialization
+class GameState(GameMethods):
+    '''The columns of one game in slots, without SQLAlchemy's per-instance
+    state; the form in which the ``game_store`` caches active games'''
+    __slots__ = GameMethods.FIELDS
 
-        Special attention is paid to DateTime fields using the
-        date_to_ordinals function.'''
-        as_dict = { k:v for k,v in self.__dict__.items() if not k.startswith('_') }
-        as_dict['result'] = self._result()
-        as_dict['start_time'] = date_to_ordinal(as_dict.get('start_time'))
-        as_dict['end_time'] = date_to_ordinal(as_dict.get('end_time'))
-
-        if old_dict is not None:
-            print('checking new dict vs old dict in game class')
-            assert ( (as_dict['player'] == old_dict['player']) and
-                     (as_dict['usage_id'] == old_dict['usage_id']) and
-                     (old_dict['result'] == 'active') and 
-                     (as_dict['guessed'].startswith(old_dict['guessed'])) and
-                     (len(as_dict['guessed']) - len(old_dict['guessed']) in (0,1)) ), \
-                     'Invalid game state update from {} to {}'.format(old_dict, as_dict)
-        self._check_consistent()
+    def __init__(self, **values):
+        for name in self.FIELDS:
+            setattr(self, name, values.get(name))
 
-        return as_dict
+    @classmethod
+    def from_game(cls, game):
+        '''Return the state of ``game``, a ``Game`` or ``GameState``'''
+        return cls(**{ name: getattr(game, name) for name in cls.FIELDS })
 
-    def _check_consistent(self):
-        '''Test record to make sure ``guessed`` and ``reveal_word`` are
-        consistent'''
-        dec_reveal = unidecode(self.reveal_word)
-        good_guesses = set([ l for l in self.guessed if l in dec_reveal ])
-        bad_guesses = set([ l for l in self.guessed if l not in dec_reveal ])
-        result = self._result()
-        assert ( (len(bad_guesses) == self.bad_guesses) and
-                 (len(bad_guesses.intersection(dec_reveal)) == 0) and
-                 (result in ('lost', 'won', 'active')) and
-                 (self.bad_guesses <= 6) and
-                 ((self.bad_guesses == 6) or (result in ('active', 'won'))) ), \
-                'Invalid game state: {} {} {}'.format(good_guesses, bad_guesses, self.reveal_word)
-        
+class ArchivedGame(base_games):
+    '''Table ``games_archive`` of finished games moved out of ``games`` by
+    the ``reap-games`` command, with the same fields as ``games``'''
+    __tablename__ = 'games_archive'
+    game_id     = Column(types.String(length=38), primary_key=True)
+    player      = Column(types.String(length=38), nullable=False)
+    usage_id    = Column(types.Integer, nullable=False)
+    guessed_mask = Column(types.Integer, nullable=False, default=0, server_default='0')
+    other_misses = Column(types.Integer, nullable=False, default=0, server_default='0')
+    guess_order = Column(types.String(length=32), nullable=False, default='', server_default='')
+    bad_guesses = Column(types.Integer)
+    start_time  = Column(types.DateTime)
+    end_time    = Column(types.DateTime)
+    last_move   = Column(types.DateTime)
+
+    __table_args__ = (
+        Index('ix_games_archive_end', 'end_time'),
+    )
+
+class Ranking(base_games):
+    '''Table ``leaderboard`` of per-player totals over finished games,
+    updated as each game ends, with fields:
+      * ``period`` - ``all``, an ISO week such as ``w2020-07``, or a day
+        such as ``d2020-02-14``
+      * ``lang`` - Two-letter language code, or ``all``
+      * ``user_id`` - Player key from ``users`` table
+      * ``user_name`` - The player's name
+      * ``games`` - Number of finished games
+      * ``wins`` - Number of games won
+      * ``total_seconds`` - Total length of the finished games in seconds
+      * ``win_rate`` - ``wins`` / ``games``
+      * ``avg_seconds`` - ``total_seconds`` / ``games``
+    '''
+    __tablename__ = 'leaderboard'
+    period        = Column(types.String(length=12), primary_key=True)
+    lang          = Column(types.String(length=3), primary_key=True)
+    user_id       = Column(types.String(length=38), primary_key=True)
+    user_name     = Column(types.String(length=30))
+    games         = Column(types.Integer, nullable=False, default=0)
+    wins          = Column(types.Integer, nullable=False, default=0)
+    total_seconds = Column(types.Float, nullable=False, default=0.0)
+    win_rate      = Column(types.Float, nullable=False, default=0.0)
+    avg_seconds   = Column(types.Float, nullable=False, default=0.0)
+
+    __table_args__ = (
+        Index('ix_leaderboard_wins', 'period', 'lang', 'wins'),
+        Index('ix_leaderboard_win_rate', 'period', 'lang', 'win_rate'),
+        Index('ix_leaderboard_avg_seconds', 'period', 'lang', 'avg_seconds'),
+    )
+
+class LetterRollup(base_games):
+    '''Table ``rollup_letters`` of finished games counted by the letters of
+    their secret word, kept up to date by ``flask export-games``, with
+    fields:
+      * ``lang`` - Two-letter language code
+      * ``letter`` - A folded letter of the secret word
+      * ``position`` - Its position in the secret word, from 0
+      * ``games`` - Number of finished games with ``letter`` at ``position``
+      * ``revealed`` - How many of those guessed the letter
+      * ``won`` - How many of those were won
+    '''
+    __tablename__ = 'rollup_letters'
+    lang      = Column(types.String(length=3), primary_key=True)
+    letter    = Column(types.String(length=1), primary_key=True)
+    position  = Column(types.Integer, primary_key=True)
+    games     = Column(types.Integer, nullable=False, default=0)
+    revealed  = Column(types.Integer, nullable=False, default=0)
+    won       = Column(types.Integer, nullable=False, default=0)
+
+class LengthRollup(base_games):
+    '''Table ``rollup_lengths`` of finished games counted by the length of
+    their secret word, kept up to date by ``flask export-games``, with
+    fields:
+      * ``lang`` - Two-letter language code
+      * ``word_length`` - Characters in the secret word
+      * ``games``, ``won``, ``lost``, ``abandoned`` - Number of finished
+        games, and of each result
+      * ``bad_guesses`` - Total bad guesses of those games
+      * ``total_seconds`` - Total length of those games in seconds
+    '''
+    __tablename__ = 'rollup_lengths'
+    lang          = Column(types.String(length=3), primary_key=True)
+    word_length   = Column(types.Integer, primary_key=True)
+    games         = Column(types.Integer, nullable=False, default=0)
+    won           = Column(types.Integer, nullable=False, default=0)
+    lost          = Column(types.Integer, nullable=False, default=0)
+    abandoned     = Column(types.Integer, nullable=False, default=0)
+    bad_guesses   = Column(types.Integer, nullable=False, default=0)
+    total_seconds = Column(types.Float, nullable=False, default=0.0)
+
+class GuessOrderRollup(base_games):
+    '''Table ``rollup_guess_order`` of the guesses of finished games counted
+    by when they were made, kept up to date by ``flask export-games``, with
+    fields:
+      * ``lang`` - Two-letter language code
+      * ``letter`` - A letter guessed
+      * ``turn`` - Which guess of the game it was, from 0
+      * ``guesses`` - Number of times ``letter`` was guessed at ``turn``
+      * ``good`` - How many of those were in the secret word
+    '''
+    __tablename__ = 'rollup_guess_order'
+    lang      = Column(types.String(length=3), primary_key=True)
+    letter    = Column(types.String(length=1), primary_key=True)
+    turn      = Column(types.Integer, primary_key=True)
+    guesses   = Column(types.Integer, nullable=False, default=0)
+    good      = Column(types.Integer, nullable=False, default=0)
+
+class FirstGuessRollup(base_games):
+    '''Table ``rollup_first_guesses`` of finished games counted by their
+    first guess, kept up to date by ``flask export-games``, with fields:
+      * ``lang`` - Two-letter language code
+      * ``letter`` - The letter guessed first
+      * ``games`` - Number of finished games opened with ``letter``
+      * ``good`` - How many of those had it in the secret word
+      * ``won`` - How many of those were won
+    '''
+    __tablename__ = 'rollup_first_guesses'
+    lang      = Column(types.String(length=3), primary_key=True)
+    letter    = Column(types.String(length=1), primary_key=True)
+    games     = Column(types.Integer, nullable=False, default=0)
+    good      = Column(types.Integer, nullable=False, default=0)
+    won       = Column(types.Integer, nullable=False, default=0)
+
+class ExportMark(base_games):
+    '''Table ``export_marks`` of how far each export has got:
+      * ``name`` - The export, such as ``games``
+      * ``high_water`` - Games that ended before this have been exported
+      * ``updated`` - When the export last ran
+    '''
+    __tablename__ = 'export_marks'
+    name       = Column(types.String(length=30), primary_key=True)
+    high_water = Column(types.DateTime, nullable=False)
+    updated    = Column(types.DateTime, nullable=False)
@@ -0,0 +1,178 @@
+import datetime
+import threading
+import time
+
+from sqlalchemy import text
+
+from .langman_orm import ArchivedGame, Game, Ranking, User
+from .usage_index import usage_index
+
+WINDOWS = ('all', 'week', 'day')
+SORTS = {
+    # sort name -> order; ties go to the faster player, then by user_id
+    'wins':     (Ranking.wins.desc(), Ranking.avg_seconds, Ranking.user_id),
+    'win_rate': (Ranking.win_rate.desc(), Ranking.avg_seconds, Ranking.user_id),
+    'avg_time': (Ranking.avg_seconds, Ranking.user_id),
+}
+
+UPSERT = text(
+    'INSERT INTO leaderboard (period, lang, user_id, user_name, games, wins, '
+    'total_seconds, win_rate, avg_seconds) '
+    'VALUES (:period, :lang, :user_id, :user_name, 1, :won, :seconds, :won, :seconds) '
+    'ON CONFLICT (period, lang, user_id) DO UPDATE SET '
+    'user_name = excluded.user_name, '
+    'games = leaderboard.games + 1, '
+    'wins = leaderboard.wins + excluded.wins, '
+    'total_seconds = leaderboard.total_seconds + excluded.total_seconds, '
+    'win_rate = (leaderboard.wins + excluded.wins) * 1.0 / (leaderboard.games + 1), '
+    'avg_seconds = (leaderboard.total_seconds + excluded.total_seconds) / (leaderboard.games + 1)')
+
+def periods(when):
+    '''Return the leaderboard periods a game ending at ``when`` counts in'''
+    return {'all': 'all',
+            'week': when.strftime('w%G-%V'),
+            'day': when.strftime('d%Y-%m-%d')}
+
+def oldest_periods(now, keep_days, keep_weeks):
+    '''Return the oldest ``day`` and ``week`` periods kept at ``now``: the
+    last ``keep_days`` days and ``keep_weeks`` weeks, the current included'''
+    return {'day': periods(now - datetime.timedelta(days=keep_days - 1))['day'],
+            'week': periods(now - datetime.timedelta(weeks=keep_weeks - 1))['week']}
+
+def prune(session, now, keep_days, keep_weeks):
+    '''Delete the leaderboard rows of the days and weeks before those kept
+    at ``now`` (see ``oldest_periods``).  Period names sort in time order
+    after their prefix, so each is a range delete on the primary key.
+    Does not commit; returns the number of rows deleted.'''
+    deleted = 0
+    for oldest in oldest_periods(now, keep_days, keep_weeks).values():
+        deleted += session.query(Ranking).filter(
+            Ranking.period.like(oldest[0] + '%'), Ranking.period < oldest
+        ).delete(synchronize_session=False)
+    return deleted
+
+def record_game(session, user, lang, outcome, time_delta, when):
+    '''Add a finished game of ``user`` to the leaderboard rows for every
+    window, both for ``lang`` and for all languages.  One executemany of
+    upserts; the first game recorded in a process on a new day also prunes
+    the periods past retention.  Does not commit.'''
+    won = 1 if outcome == 'won' else 0
+    seconds = time_delta.total_seconds()
+    session.execute(UPSERT, [
+        {'period': period, 'lang': l, 'user_id': user.user_id,
+         'user_name': user.user_name, 'won': won, 'seconds': seconds}
+        for period in periods(when).values() for l in (lang, 'all') ])
+    leaderboard.rolled_over(session, when)
+
+class Leaderboard:
+    '''Top-N reads of the ``leaderboard`` table
+
+    Each read is an index range scan of at most ``limit`` rows; results
+    are also kept in this process for ``cache_seconds`` so repeated reads
+    do not reach the database.  Rows of the last ``keep_days`` days and
+    ``keep_weeks`` weeks are kept; older ones are pruned as the day rolls
+    over.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cache = {}
+        self._pruned = None       # the day period last pruned in
+        self.cache_seconds = 2.0
+        self.min_games = 5
+        self.keep_days = 7
+        self.keep_weeks = 8
+
+    def configure(self, config):
+        options = dict(config.get('LEADERBOARD') or {})
+        self.cache_seconds = float(options.get('cache_seconds', 2.0))
+        self.min_games = int(options.get('min_games', 5))
+        self.keep_days = max(1, int(options.get('keep_days', 7)))
+        self.keep_weeks = max(1, int(options.get('keep_weeks', 8)))
+        with self._lock:
+            self._cache = {}
+            self._pruned = None
+
+    def rolled_over(self, session, now):
+        '''Prune the periods past retention in ``session`` if this process
+        has not yet done so on the day of ``now``; does not commit'''
+        day = periods(now)['day']
+        with self._lock:
+            if self._pruned == day:
+                return
+            self._pruned = day
+        prune(session, now, self.keep_days, self.keep_weeks)
+
+    def top(self, session, lang, window, sort, limit, now):
+        '''Return up to ``limit`` leaderboard entries as dicts.  Players need
+        ``min_games`` finished games to be ranked by win rate or time.
+        Ties are ranked by average time, then by ``user_id``, so the same
+        rows always get the same ranks.'''
+        key = (lang, periods(now)[window], sort, limit)
+        with self._lock:
+            hit = self._cache.get(key)
+        if hit is not None and time.monotonic() - hit[0] < self.cache_seconds:
+            return hit[1]
+
+        query = session.query(Ranking).filter(
+            Ranking.period == key[1], Ranking.lang == lang)
+        if sort != 'wins':
+            query = query.filter(Ranking.games >= self.min_games)
+        rows = query.order_by(*SORTS[sort]).limit(limit).all()
+        leaders = [ {'rank': i + 1,
+                     'user_name': r.user_name,
+                     'games': r.games,
+                     'wins': r.wins,
+                     'win_rate': round(r.win_rate, 4),
+                     'avg_time': round(r.avg_seconds, 3)}
+                    for i, r in enumerate(rows) ]
+        with self._lock:
+            self._cache[key] = (time.monotonic(), leaders)
+        return leaders
+
+leaderboard = Leaderboard()
+
+def rebuild(session, chunk_size=1000, now=None):
+    '''Recompute the ``leaderboard`` table from the games won or lost in
+    ``games`` and ``games_archive`` and commit.  Abandoned games are not
+    counted, nor are games in days or weeks past the retention of
+    ``leaderboard`` at ``now``.  Returns the number of games counted.'''
+    oldest = oldest_periods(now or datetime.datetime.now(),
+                            leaderboard.keep_days, leaderboard.keep_weeks)
+    totals = {}       # (period, lang, user_id) -> [games, wins, seconds]
+    counted = 0
+    for table in (Game, ArchivedGame):
+        query = session.query(table.player, table.usage_id, table.bad_guesses,
+                              table.guessed_mask, table.start_time, table.end_time) \
+                       .filter(table.end_time.isnot(None)) \
+                       .yield_per(chunk_size)
+        for player, usage_id, bad_guesses, guessed_mask, start_time, end_time in query:
+            try:
+                usage = usage_index.get(usage_id)
+            except KeyError:
+                continue
+            won = 0 if bad_guesses == 6 else 1
+            if won and not usage.guess.solved(guessed_mask):
+                continue               # abandoned
+            lang = usage.language
+            seconds = (end_time - start_time).total_seconds()
+            for window, period in periods(end_time).items():
+                if window in oldest and period < oldest[window]:
+                    continue
+                for l in (lang, 'all'):
+                    entry = totals.setdefault((period, l, player), [0, 0, 0.0])
+                    entry[0] += 1
+                    entry[1] += won
+                    entry[2] += seconds
+            counted += 1
+
+    names = dict(session.query(User.user_id, User.user_name))
+    session.query(Ranking).delete(synchronize_session=False)
+    rows = [ {'period': period, 'lang': lang, 'user_id': user_id,
+              'user_name': names.get(user_id), 'games': n, 'wins': wins,
+              'total_seconds': seconds, 'win_rate': wins / n,
+              'avg_seconds': seconds / n}
+             for (period, lang, user_id), (n, wins, seconds) in totals.items() ]
+    for i in range(0, len(rows), chunk_size):
+        session.execute(Ranking.__table__.insert(), rows[i:i+chunk_size])
+    session.commit()
+    return counted
@@ -0,0 +1,50 @@
+import datetime
+
+from flask import g, request
+from flask_restplus import Resource, Namespace
+
+from .leaderboard import leaderboard, SORTS, WINDOWS
+
+leaderboard_api = Namespace('leaderboard', description='Top players')
+
+@leaderboard_api.route('')
+class Leaderboard(Resource):
+    valid_langs = ('en', 'es', 'fr')
+    max_limit = 100
+    def get(self):
+        '''Get the top players
+
+        :route: ``/`` GET
+
+        :query:
+              * ``lang`` Only count games in this language (default: all)
+              * ``window`` One of 'all', 'week' or 'day' (default 'all')
+              * ``sort`` One of 'wins', 'win_rate' or 'avg_time' (default 'wins')
+              * ``limit`` Number of players (default 10, at most 100)
+
+        :returns:
+           The leaderboard:
+              * ``lang``, ``window``, ``sort`` The options used
+              * ``leaders`` List of objects with the player's ``rank``,
+                ``user_name``, finished ``games``, ``wins``, ``win_rate``
+                and ``avg_time`` (seconds per game)
+        '''
+        lang = request.args.get('lang') or 'all'
+        window = request.args.get('window') or 'all'
+        sort = request.args.get('sort') or 'wins'
+        if lang != 'all' and lang not in self.valid_langs:
+            leaderboard_api.abort(400, 'lang must be from ' + ', '.join(self.valid_langs))
+        if window not in WINDOWS:
+            leaderboard_api.abort(400, 'window must be from ' + ', '.join(WINDOWS))
+        if sort not in SORTS:
+            leaderboard_api.abort(400, 'sort must be from ' + ', '.join(SORTS))
+        try:
+            limit = min(int(request.args.get('limit', 10)), self.max_limit)
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            leaderboard_api.abort(400, 'limit must be a positive integer')
+
+        return {'lang': lang, 'window': window, 'sort': sort,
+                'leaders': leaderboard.top(g.games_db, lang, window, sort, limit,
+                                           datetime.datetime.now())}
@@ -0,0 +1,184 @@
+import collections
+import os
+import sqlite3
+import threading
+import time
+
+class MemoryBuckets:
+    '''Token buckets and unknown usernames held in this process'''
+    def __init__(self, max_entries=100000):
+        self._lock = threading.Lock()
+        self._buckets = {}     # key -> [tokens, updated, full_at]
+        self._unknown = collections.OrderedDict()   # user name -> expires
+        self.max_entries = max_entries
+
+    def level(self, key, rate, burst, take=0):
+        now = time.time()
+        with self._lock:
+            if len(self._buckets) > self.max_entries:
+                for k in [ k for k, b in self._buckets.items() if b[2] <= now ]:
+                    del self._buckets[k]
+            bucket = self._buckets.get(key)
+            tokens = burst if bucket is None else min(
+                burst, bucket[0] + (now - bucket[1]) * rate)
+            left = max(0.0, tokens - take)
+            self._buckets[key] = [left, now, now + (burst - left) / rate]
+            return tokens
+
+    def is_unknown(self, user_name):
+        with self._lock:
+            expires = self._unknown.get(user_name)
+            if expires is not None and expires <= time.time():
+                del self._unknown[user_name]
+                expires = None
+        return expires is not None
+
+    def remember_unknown(self, user_name, ttl):
+        with self._lock:
+            self._unknown[user_name] = time.time() + ttl
+            self._unknown.move_to_end(user_name)
+            while len(self._unknown) > self.max_entries:
+                self._unknown.popitem(last=False)
+
+    def forget_unknown(self, user_name):
+        with self._lock:
+            self._unknown.pop(user_name, None)
+
+class SqliteBuckets:
+    '''Token buckets and unknown usernames in a local sqlite file shared by
+    all workers on the host, so the limits hold per host rather than per
+    worker, and a name registered through one worker is known to all'''
+    def __init__(self, path):
+        self._path = path
+        self._local = threading.local()
+        self._calls = 0
+        conn = self._conn()
+        conn.execute('CREATE TABLE IF NOT EXISTS login_buckets ('
+                     'key TEXT PRIMARY KEY, tokens REAL NOT NULL, '
+                     'updated REAL NOT NULL, full_at REAL NOT NULL)')
+        conn.execute('CREATE TABLE IF NOT EXISTS login_unknown ('
+                     'user_name TEXT PRIMARY KEY, expires REAL NOT NULL)')
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self._path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def level(self, key, rate, burst, take=0):
+        now = time.time()
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, updated FROM login_buckets '
+                               'WHERE key = ?', (key,)).fetchone()
+            tokens = burst if row is None else min(burst, row[0] + (now - row[1]) * rate)
+            left = max(0.0, tokens - take)
+            conn.execute('INSERT OR REPLACE INTO login_buckets VALUES (?, ?, ?, ?)',
+                         (key, left, now, now + (burst - left) / rate))
+            self._calls += 1
+            if self._calls % 1000 == 0:      # drop refilled buckets & expired names
+                conn.execute('DELETE FROM login_buckets WHERE full_at <= ?', (now,))
+                conn.execute('DELETE FROM login_unknown WHERE expires <= ?', (now,))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return tokens
+
+    def is_unknown(self, user_name):
+        return self._conn().execute(
+            'SELECT 1 FROM login_unknown WHERE user_name = ? AND expires > ?',
+            (user_name, time.time())).fetchone() is not None
+
+    def remember_unknown(self, user_name, ttl):
+        self._conn().execute('INSERT OR REPLACE INTO login_unknown VALUES (?, ?)',
+                             (user_name, time.time() + ttl))
+
+    def forget_unknown(self, user_name):
+        self._conn().execute('DELETE FROM login_unknown WHERE user_name = ?',
+                             (user_name,))
+
+class LoginGuard:
+    '''Cheap checks that turn away abusive login traffic before it reaches
+    the ``auth`` table or the password hasher
+
+    * A token bucket per client address, charged for every registration
+      and every failed login, and one per username, charged for every
+      failed login.  Logins are refused while either bucket is empty;
+      successful logins cost nothing.
+    * A negative cache of usernames not found in ``auth``, so repeated
+      logins as unknown users skip the database.  A registration drops
+      the name from it.
+
+    Configured by ``LOGIN_LIMITS`` in ``config.yaml``:
+      * ``ip_rate``, ``ip_burst`` - Tokens per second and bucket size per
+        client address
+      * ``user_rate``, ``user_burst`` - The same per username
+      * ``unknown_ttl`` - Seconds to remember an unknown username
+      * ``backend`` - Where the buckets and the negative cache are kept:
+        ``memory`` (default) or ``sqlite`` (a local file shared by the
+        workers on one host)
+      * ``path`` - The sqlite file
+
+    With ``memory`` and several workers, a name registered through one
+    worker may be refused by another for up to ``unknown_ttl`` seconds, so
+    run those with ``sqlite``.
+    '''
+    def __init__(self):
+        self.buckets = MemoryBuckets()
+        self.ip_rate, self.ip_burst = 0.5, 30
+        self.user_rate, self.user_burst = 0.1, 5
+        self.unknown_ttl = 30
+
+    def configure(self, config):
+        options = dict(config.get('LOGIN_LIMITS') or {})
+        self.ip_rate = float(options.get('ip_rate', 0.5))
+        self.ip_burst = float(options.get('ip_burst', 30))
+        self.user_rate = float(options.get('user_rate', 0.1))
+        self.user_burst = float(options.get('user_burst', 5))
+        self.unknown_ttl = float(options.get('unknown_ttl', 30))
+        kind = options.get('backend', 'memory')
+        if kind == 'memory':
+            self.buckets = MemoryBuckets()
+        elif kind == 'sqlite':
+            self.buckets = SqliteBuckets(options.get('path', '/tmp/langman-logins.db'))
+        else:
+            raise ValueError('Unknown LOGIN_LIMITS backend {}'.format(kind))
+
+    def _wait(self, key, rate, burst, take=0):
+        '''Seconds until bucket ``key`` has a token, 0 if it has one now (and
+        then ``take`` tokens are taken)'''
+        tokens = self.buckets.level(key, rate, burst, take)
+        return 0.0 if tokens >= 1 else (1 - tokens) / rate
+
+    def register_wait(self, address):
+        '''Charge a registration from ``address``; return 0 if it may go
+        ahead, else the seconds to wait'''
+        return self._wait('ip:' + str(address), self.ip_rate, self.ip_burst, 1)
+
+    def login_wait(self, address, user_name):
+        '''Return 0 if a login as ``user_name`` from ``address`` may be
+        tried, else the seconds to wait.  Does not charge.'''
+        return max(self._wait('ip:' + str(address), self.ip_rate, self.ip_burst),
+                   self._wait('user:' + str(user_name), self.user_rate, self.user_burst))
+
+    def login_failed(self, address, user_name):
+        '''Charge a failed login to both buckets'''
+        self.buckets.level('ip:' + str(address), self.ip_rate, self.ip_burst, 1)
+        self.buckets.level('user:' + str(user_name), self.user_rate, self.user_burst, 1)
+
+    def is_unknown(self, user_name):
+        '''True if ``user_name`` was recently looked up and not found'''
+        return self.buckets.is_unknown(user_name)
+
+    def remember_unknown(self, user_name):
+        self.buckets.remember_unknown(user_name, self.unknown_ttl)
+
+    def forget_unknown(self, user_name):
+        self.buckets.forget_unknown(user_name)
+
+login_guard = LoginGuard()
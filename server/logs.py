@@ -0,0 +1,192 @@
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+import uuid
+
+from flask import g, has_request_context, request
+from flask.logging import default_handler
+
+# attributes every LogRecord has; anything else was passed as ``extra``
+RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+access_log = logging.getLogger('server.access')
+
+class JsonFormatter(logging.Formatter):
+    '''Formats a record as one JSON object per line with its ``time``,
+    ``level``, ``logger`` and ``message``, any ``extra`` fields (such as
+    ``request_id``, ``game_id`` and ``latency_ms``) and the ``exc`` text'''
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.utcfromtimestamp(record.created)
+                            .isoformat(timespec='milliseconds') + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_FIELDS and value is not None:
+                entry[key] = value
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class ContextFilter(logging.Filter):
+    '''Adds the ``request_id`` and ``game_id`` of the current request to
+    records logged while handling it'''
+    def filter(self, record):
+        if has_request_context():
+            if getattr(record, 'request_id', None) is None:
+                record.request_id = g.get('request_id')
+            if getattr(record, 'game_id', None) is None:
+                record.game_id = (request.view_args or {}).get('game_id')
+        return True
+
+class RateLimitFilter(logging.Filter):
+    '''Lets through at most ``burst`` records per ``interval`` seconds of
+    each repeated line (same logger, level and message template) at
+    ``level`` or above.  The first record let through once a window with
+    dropped records is over carries their count as ``suppressed``.'''
+    def __init__(self, level=logging.ERROR, burst=5, interval=60.0, max_keys=10000):
+        super().__init__()
+        self.level, self.burst, self.interval = level, burst, interval
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._windows = {}      # key -> [window start, let through, dropped]
+
+    def filter(self, record):
+        if record.levelno < self.level:
+            return True
+        key = (record.name, record.levelno, str(record.msg))
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                if window is not None and window[2]:
+                    record.suppressed = window[2]
+                if len(self._windows) >= self.max_keys:
+                    self._windows.clear()
+                window = self._windows[key] = [now, 0, 0]
+            if window[1] >= self.burst:
+                window[2] += 1
+                return False
+            window[1] += 1
+        return True
+
+class QueueHandler(logging.handlers.QueueHandler):
+    '''Hands records to a listener thread that writes them with
+    ``handlers``.  A full queue drops the record (counted in ``dropped``)
+    instead of making the logging thread wait, and a forked process starts
+    its own listener on its first record.'''
+    def __init__(self, handlers, maxsize=10000):
+        super().__init__(queue.Queue(maxsize))
+        self.handlers = handlers
+        self.dropped = 0
+        self.listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _start(self):
+        with self._start_lock:
+            if self._pid != os.getpid():
+                self.queue = queue.Queue(self.queue.maxsize)
+                self.listener = logging.handlers.QueueListener(
+                    self.queue, *self.handlers, respect_handler_level=True)
+                self.listener.start()
+                self._pid = os.getpid()
+
+    def prepare(self, record):
+        '''Format the message and traceback now, in the logging thread, as
+        the arguments may change once the call returns'''
+        record = logging.makeLogRecord(vars(record))
+        record.message = record.getMessage()
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg, record.args, record.exc_info = record.message, None, None
+        return record
+
+    def enqueue(self, record):
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        '''Write out the queued records and stop the listener'''
+        if self.listener is not None and self._pid == os.getpid():
+            self.listener.stop()
+            self.listener = None
+            self._pid = None
+        super().close()
+
+def shutdown():
+    '''Write out the queued records and stop the listener threads'''
+    root = logging.getLogger()
+    for handler in [ h for h in root.handlers if isinstance(h, QueueHandler) ]:
+        root.removeHandler(handler)
+        handler.close()
+
+def init_app(app):
+    '''Send all logging through a ``QueueHandler`` on the root logger, so
+    request threads never wait on log I/O, and log each request to the
+    ``server.access`` logger with its latency.
+
+    Configured by ``LOGGING`` in ``config.yaml``:
+      * ``level`` - Level of the root logger (default ``INFO``)
+      * ``levels`` - Dict of logger name to level, such as
+        ``server.access: WARNING`` to turn off the per-request records
+      * ``stream`` - ``stderr`` (default) or ``stdout``
+      * ``queue_size`` - Records waiting for the writer thread before new
+        ones are dropped
+      * ``error_burst``, ``error_interval`` - Repeats of one error line let
+        through per interval in seconds
+
+    Records are written as JSON lines by ``JsonFormatter``; those logged
+    during a request carry its ``request_id`` (from the ``X-Request-ID``
+    header, or a new one, echoed in the response) and the ``game_id`` of
+    the URL.
+    '''
+    options = dict(app.config.get('LOGGING') or {})
+    stream = sys.stdout if options.get('stream') == 'stdout' else sys.stderr
+    target = logging.StreamHandler(stream)
+    target.setFormatter(JsonFormatter())
+    handler = QueueHandler([target], int(options.get('queue_size', 10000)))
+    handler.addFilter(RateLimitFilter(
+        logging.ERROR, int(options.get('error_burst', 5)),
+        float(options.get('error_interval', 60))))
+    handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    shutdown()
+    root.addHandler(handler)
+    root.setLevel(str(options.get('level', 'INFO')).upper())
+    for name, level in (options.get('levels') or {}).items():
+        logging.getLogger(name).setLevel(str(level).upper())
+    app.logger.removeHandler(default_handler)   # errors go through the queue too
+    atexit.register(shutdown)
+
+    @app.before_request
+    def start_request_log():
+        g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+        g._log_start = time.perf_counter()
+
+    @app.after_request
+    def request_log(response):
+        if 'request_id' not in g:
+            return response
+        response.headers['X-Request-ID'] = g.request_id
+        if access_log.isEnabledFor(logging.INFO):
+            access_log.info('%s %s %s', request.method, request.path,
+                            response.status_code, extra={
+                                'status': response.status_code,
+                                'latency_ms': round(
+                                    (time.perf_counter() - g._log_start) * 1000, 3)})
+        return response
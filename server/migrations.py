@@ -0,0 +1,159 @@
+import datetime
+import json
+
+from sqlalchemy import inspect, text, types
+
+from .langman_orm import ArchivedGame, Game, LETTER_BITS, User, letters_to_mask
+
+def add_missing_columns(engine, table):
+    '''Add the columns of ``table`` (a SQLAlchemy ``Table``) that the
+    database does not have yet with ``ALTER TABLE ... ADD COLUMN``.  Returns
+    the names of the added columns.'''
+    existing = set(c['name'] for c in inspect(engine).get_columns(table.name))
+    added = []
+    for column in table.columns:
+        if column.name in existing:
+            continue
+        ddl = 'ALTER TABLE {} ADD COLUMN {} {}'.format(
+            table.name, column.name, column.type.compile(engine.dialect))
+        if column.server_default is not None:
+            ddl += " DEFAULT '{}'".format(column.server_default.arg)
+        if not column.nullable and column.server_default is not None:
+            ddl += ' NOT NULL'
+        engine.execute(ddl)
+        added.append(column.name)
+    return added
+
+def widen_columns(engine, table):
+    '''Lengthen the string columns of ``table`` that are shorter in the
+    database than in the model.  (sqlite does not enforce lengths, so
+    nothing is done there.)  Returns the names of the widened columns.'''
+    if engine.dialect.name == 'sqlite':
+        return []
+    existing = { c['name']: c['type'] for c in inspect(engine).get_columns(table.name) }
+    widened = []
+    for column in table.columns:
+        length = getattr(column.type, 'length', None)
+        current = getattr(existing.get(column.name), 'length', None)
+        if length and current and current < length:
+            engine.execute('ALTER TABLE {} ALTER COLUMN {} TYPE {}'.format(
+                table.name, column.name, column.type.compile(engine.dialect)))
+            widened.append(column.name)
+    return widened
+
+def add_missing_indexes(engine, table):
+    '''Create the indexes of ``table`` that the database does not have yet.
+    Returns the names of the created indexes.'''
+    existing = set(i['name'] for i in inspect(engine).get_indexes(table.name))
+    created = []
+    for index in table.indexes:
+        if index.name not in existing:
+            index.create(engine)
+            created.append(index.name)
+    return created
+
+def migrate_user_counters(engine):
+    '''Move the JSON ``outcomes`` and ``by_lang`` text fields of ``users``
+    into the counter columns.  Rows whose counters were already filled in
+    are left alone, so this can be rerun.  Returns the number of rows
+    converted.'''
+    add_missing_columns(engine, User.__table__)
+    existing = set(c['name'] for c in inspect(engine).get_columns('users'))
+    if not {'outcomes', 'by_lang'} <= existing:
+        return 0
+
+    counters = [ 'outcome_' + k for k in User.OUTCOMES ] + \
+               [ 'lang_' + k for k in User.LANGUAGES ]
+    converted = 0
+    with engine.begin() as conn:
+        rows = conn.execute(
+            'SELECT user_id, outcomes, by_lang FROM users WHERE ' +
+            ' AND '.join('{} = 0'.format(c) for c in counters)).fetchall()
+        for user_id, outcomes, by_lang in rows:
+            values = {}
+            for prefix, blob, keys in (('outcome_', outcomes, User.OUTCOMES),
+                                       ('lang_', by_lang, User.LANGUAGES)):
+                counts = json.loads(blob or '{}')
+                for key in keys:
+                    values[prefix + key] = int(counts.get(key, 0))
+            if any(values.values()):
+                values['user_id'] = user_id
+                conn.execute(text(
+                    'UPDATE users SET ' +
+                    ', '.join('{0} = :{0}'.format(c) for c in counters) +
+                    ' WHERE user_id = :user_id'), values)
+                converted += 1
+    return converted
+
+def migrate_game_times(engine):
+    '''Copy the ``total_time`` Interval of ``users`` into the
+    ``total_micros`` counter, for rows where that is still 0.  The old
+    ``total_time`` and ``avg_time`` columns are left in place, unused.
+    Returns the number of rows converted.'''
+    add_missing_columns(engine, User.__table__)
+    existing = set(c['name'] for c in inspect(engine).get_columns('users'))
+    if 'total_time' not in existing:
+        return 0
+    pick = text('SELECT user_id, total_time FROM users WHERE total_micros = 0 '
+                'AND total_time IS NOT NULL').columns(total_time=types.Interval)
+    update = text('UPDATE users SET total_micros = :micros WHERE user_id = :user_id')
+    with engine.begin() as conn:
+        values = [ {'user_id': user_id,
+                    'micros': total_time // datetime.timedelta(microseconds=1)}
+                   for user_id, total_time in conn.execute(pick) ]
+        if values:
+            conn.execute(update, values)
+    return len(values)
+
+def migrate_compact_games(engine, usages, batch_size=1000):
+    '''Convert the rows of ``games`` and ``games_archive`` from the
+    ``guessed`` letters and ``reveal_word`` columns to ``guessed_mask``,
+    ``other_misses`` and ``guess_order``, then drop ``reveal_word``, which
+    the usage and the mask give back (sqlite needs 3.35 or later for that).
+    ``guessed`` is left in place, unused.
+
+    The guessed letters are kept as they were, in the order guessed, in
+    ``guess_order``; those outside ``LETTER_BITS`` (such as 'é'), which
+    were always misses, are counted in ``other_misses``.  ``bad_guesses``
+    of unfinished games is recounted with the ``GuessTable`` of
+    ``usages.get(usage_id)`` (kept as it was if the usage is gone), so they
+    play on consistently; finished games keep the count, and so the result,
+    they ended with.  Rows are converted ``batch_size`` at a time; a table
+    without ``reveal_word`` is skipped, so this can be rerun after an
+    interruption.  Returns the number of rows converted.'''
+    converted = 0
+    for table in (Game.__table__, ArchivedGame.__table__):
+        add_missing_columns(engine, table)
+        existing = set(c['name'] for c in inspect(engine).get_columns(table.name))
+        if 'reveal_word' not in existing:
+            continue
+        pick = text('SELECT game_id, usage_id, guessed, bad_guesses, end_time FROM {} '
+                    'WHERE game_id > :after ORDER BY game_id '
+                    'LIMIT :n'.format(table.name))
+        update = text('UPDATE {} SET guessed_mask = :mask, other_misses = :other, '
+                      'guess_order = :order, bad_guesses = :bad '
+                      'WHERE game_id = :game_id'.format(table.name))
+        after = ''
+        while True:
+            with engine.begin() as conn:
+                rows = conn.execute(pick, after=after, n=batch_size).fetchall()
+                if not rows:
+                    break
+                values = []
+                for game_id, usage_id, guessed, bad_guesses, end_time in rows:
+                    order = ''.join(dict.fromkeys(
+                        l for l in (guessed or '').lower() if l.isalpha()))
+                    mask = letters_to_mask(order)
+                    other = len([ l for l in order if l not in LETTER_BITS ])
+                    if end_time is None:
+                        try:
+                            bad_guesses = usages.get(usage_id).guess.misses(mask) + other
+                        except KeyError:
+                            pass
+                    values.append({'game_id': game_id, 'mask': mask, 'other': other,
+                                   'order': order, 'bad': bad_guesses})
+                conn.execute(update, values)
+            converted += len(rows)
+            after = rows[-1][0]
+        engine.execute('ALTER TABLE {} DROP COLUMN reveal_word'.format(table.name))
+    return converted
@@ -0,0 +1,122 @@
+import base64
+import hashlib
+import hmac
+import os
+import threading
+
+class HasherBusy(Exception):
+    '''Raised when too many password hashes are already waiting'''
+
+class Pbkdf2Hasher:
+    '''PBKDF2-HMAC-SHA256 with ``iterations`` rounds'''
+    scheme = 'pbkdf2-sha256'
+
+    def __init__(self, iterations=200000):
+        self.params = (int(iterations),)
+
+    @staticmethod
+    def derive(password, salt, iterations):
+        return hashlib.pbkdf2_hmac('sha256', password, salt, iterations)
+
+class ScryptHasher:
+    '''scrypt with CPU/memory cost ``n``, block size ``r`` and
+    parallelism ``p``; uses about ``128 * n * r`` bytes'''
+    scheme = 'scrypt'
+
+    def __init__(self, n=16384, r=8, p=1):
+        self.params = (int(n), int(r), int(p))
+
+    @staticmethod
+    def derive(password, salt, n, r, p):
+        return hashlib.scrypt(password, salt=salt, n=n, r=r, p=p, dklen=32,
+                              maxmem=128 * r * (n + p + 2) + (1 << 20))
+
+HASHERS = { cls.scheme: cls for cls in (Pbkdf2Hasher, ScryptHasher) }
+
+def encode(scheme, params, salt, digest):
+    '''Return the versioned hash string ``$scheme$param...$salt$digest``'''
+    return '$'.join([''] + [scheme] + [ str(p) for p in params ] +
+                    [ base64.b64encode(salt).decode(),
+                      base64.b64encode(digest).decode() ])
+
+def decode(encoded):
+    '''Return the ``(scheme, params, salt, digest)`` of a hash string'''
+    parts = encoded.split('$')
+    return (parts[1], tuple(int(p) for p in parts[2:-2]),
+            base64.b64decode(parts[-2]), base64.b64decode(parts[-1]))
+
+def is_versioned(encoded):
+    '''True for hash strings made here, False for legacy (MD5) hashes'''
+    return encoded.startswith('$')
+
+class Passwords:
+    '''Hashes and verifies passwords with a pluggable key derivation
+    function, a bounded number at a time
+
+    Configured by ``PASSWORDS`` in ``config.yaml``:
+      * ``scheme`` - ``scrypt`` (default) or ``pbkdf2-sha256`` for new hashes
+      * ``scrypt_n``, ``scrypt_r``, ``scrypt_p`` - scrypt cost parameters
+      * ``pbkdf2_iterations`` - PBKDF2 rounds
+      * ``workers`` - Hashes computed at once
+      * ``max_pending`` - Hashes running or waiting at once; beyond that
+        ``HasherBusy`` is raised rather than letting logins queue up
+
+    Hash strings carry their scheme and parameters, so hashes made with
+    older settings still verify; ``needs_rehash`` tells when to replace
+    them.  Hashes run on the calling request's thread: this caps the
+    hashes computed and waiting at once, it does not free the thread.
+    hashlib's KDFs release the GIL, so they run in parallel with each
+    other and with the worker's other requests.
+    '''
+    def __init__(self):
+        self.hasher = ScryptHasher()
+        self.workers = 4
+        self._running = threading.BoundedSemaphore(4)
+        self._slots = threading.BoundedSemaphore(16)
+
+    def configure(self, config):
+        options = dict(config.get('PASSWORDS') or {})
+        scheme = options.get('scheme', 'scrypt')
+        if scheme == 'scrypt':
+            self.hasher = ScryptHasher(options.get('scrypt_n', 16384),
+                                       options.get('scrypt_r', 8),
+                                       options.get('scrypt_p', 1))
+        elif scheme in ('pbkdf2', 'pbkdf2-sha256'):
+            self.hasher = Pbkdf2Hasher(options.get('pbkdf2_iterations', 200000))
+        else:
+            raise ValueError('Unknown PASSWORDS scheme {}'.format(scheme))
+        self.workers = int(options.get('workers', 4))
+        self._running = threading.BoundedSemaphore(self.workers)
+        self._slots = threading.BoundedSemaphore(
+            max(self.workers, int(options.get('max_pending', 16))))
+
+    def _run(self, derive, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HasherBusy('Too many password checks in progress')
+        try:
+            with self._running:
+                return derive(*args)
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        '''Return a new versioned hash string for ``password``'''
+        salt = os.urandom(16)
+        digest = self._run(self.hasher.derive, password.encode(), salt,
+                           *self.hasher.params)
+        return encode(self.hasher.scheme, self.hasher.params, salt, digest)
+
+    def verify(self, encoded, password):
+        '''True if ``password`` matches the versioned hash ``encoded``'''
+        scheme, params, salt, digest = decode(encoded)
+        computed = self._run(HASHERS[scheme].derive, password.encode(), salt, *params)
+        return hmac.compare_digest(computed, digest)
+
+    def needs_rehash(self, encoded):
+        '''True if ``encoded`` was not made with the current settings'''
+        if not is_versioned(encoded):
+            return True
+        scheme, params = decode(encoded)[:2]
+        return (scheme, params) != (self.hasher.scheme, self.hasher.params)
+
+passwords = Passwords()
@@ -1,10 +1,20 @@
+import datetime
 import os
-import csv
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
 
-from .langman_orm import base_games, base_usage, Usage
-from .auth_orm import base as base_auth
+from .langman_orm import ArchivedGame, base_games, base_usage, Game, Usage, User
+from .audit import audit_games
+from .auth_orm import base as base_auth, Auth
+from .corpus import iter_corpus_csv, load_corpus
+from .export import FORMATS, export_games
+from .db import registry
+from .leaderboard import rebuild as rebuild_leaderboard
+from .migrations import (add_missing_columns, add_missing_indexes,
+                         migrate_compact_games, migrate_game_times,
+                         migrate_user_counters, widen_columns)
+from .reaper import archive_finished, reap_idle
+from .usage_index import usage_index
+from .usage_search import usage_search
 from .util import get_config
 
 import click
@@ -19,25 +29,176 @@ def init_db():
     base_usage.metadata.create_all(db_usage)
     db_games   = create_engine(config['DB_GAMES'])
     base_games.metadata.create_all(db_games)
+    add_missing_indexes(db_games, Game.__table__)
+    add_missing_indexes(db_games, ArchivedGame.__table__)
+    converted  = migrate_user_counters(db_games)
+    if converted:
+        print('Converted counters of', converted, 'rows in User table')
+    converted  = migrate_game_times(db_games)
+    if converted:
+        print('Converted total_time of', converted, 'rows in User table')
 
     db_auth   = create_engine(config['DB_AUTH'])
     base_auth.metadata.create_all(db_auth)
+    widen_columns(db_auth, Auth.__table__)    # pass_hash holds versioned hashes
+    add_missing_indexes(db_auth, Auth.__table__)
 
-    Session = sessionmaker(db_usage)
-    session = Session()
-    if session.query(Usage).count() == 0:
-        data = []
-        R = csv.reader(open('data/usages.csv', encoding='utf8'))
-        for row in R:
-            if len(row[4]) <= 500:
-                data.append( Usage(
-                    usage_id    = int(row[0]),
-                    language    = row[1],
-                    secret_word = row[3],
-                    usage       = row[4],
-                    source      = row[5]
-                ))
-
-        print('Adding', len(data), 'rows to Usage table')
-        session.add_all(data)
-        session.commit()
+    add_missing_columns(db_usage, Usage.__table__)
+    _load_corpus(db_usage, 'data/usages.csv', 1000)
+    _index_usages(db_usage)
+
+    usage_index.configure(config)             # to recount bad guesses
+    converted = migrate_compact_games(db_games, usage_index)
+    if converted:
+        print('Converted guesses of', converted, 'rows to guessed_mask and guess_order')
+    widen_columns(db_games, Game.__table__)   # guess_order holds other letters too
+    widen_columns(db_games, ArchivedGame.__table__)
+
+def _load_corpus(engine, path, chunk_size):
+    '''Upsert the corpus CSV at ``path`` into ``usages``, printing progress'''
+    def progress(totals):
+        print('  {rows} rows read: {inserted} inserted, {updated} updated, '
+              '{unchanged} unchanged'.format(**totals), end='\r')
+    totals = load_corpus(engine, iter_corpus_csv(path), chunk_size, progress)
+    print('\nLoaded {rows} rows into Usage table ({inserted} inserted, {updated} '
+          'updated, {unchanged} unchanged) in {seconds:.2f}s, '
+          '{rows_per_sec:.0f} rows/sec'.format(**totals))
+
+@app.cli.command('load-corpus')
+@click.argument('path', default='data/usages.csv')
+@click.option('--chunk-size', default=1000, help='Rows per transaction')
+def load_corpus_command(path, chunk_size):
+    '''Stream the corpus CSV at PATH into the usages table, inserting new
+    rows and updating changed ones by usage_id.'''
+    config = get_config(os.environ['FLASK_ENV'], open('server/config.yaml'))
+    db_usage = create_engine(config['DB_USAGE'])
+    base_usage.metadata.create_all(db_usage)
+    add_missing_columns(db_usage, Usage.__table__)
+    _load_corpus(db_usage, path, chunk_size)
+    _index_usages(db_usage)
+
+def _index_usages(engine):
+    '''Rebuild the search index of the usages table, printing the outcome'''
+    try:
+        backend, count = usage_search.rebuild(engine)
+    except Exception as e:
+        print('Search index not built ({}); searches will use the in-memory '
+              'index'.format(e))
+    else:
+        print('Indexed', count, 'usages for search with', backend)
+
+@app.cli.command('index-usages')
+def index_usages_command():
+    '''Rebuild the full-text search index of the usages table (sqlite FTS5
+    or PostgreSQL tsvector)'''
+    config = get_config(os.environ['FLASK_ENV'], open('server/config.yaml'))
+    _index_usages(create_engine(config['DB_USAGE']))
+
+@app.cli.command('rebuild-leaderboard')
+def rebuild_leaderboard_command():
+    '''Recompute the leaderboard table from the finished games'''
+    config = get_config(os.environ['FLASK_ENV'], open('server/config.yaml'))
+    registry.configure(config)
+    usage_index.configure(config)
+    counted = rebuild_leaderboard(registry.session('DB_GAMES'))
+    registry.remove()
+    print('Rebuilt leaderboard from', counted, 'finished games')
+
+@app.cli.command('reap-games')
+@click.option('--idle-hours', type=float,
+              help='Abandon unfinished games with no guess for this long')
+@click.option('--archive-days', type=float,
+              help='Archive games that ended this long ago')
+@click.option('--batch-size', type=int, help='Games per transaction')
+@click.option('--to', 'path', type=click.Path(dir_okay=False),
+              help='Append archived games to this .jsonl.gz file instead of '
+                   'the games_archive table')
+def reap_games_command(idle_hours, archive_days, batch_size, path):
+    '''Mark idle unfinished games as abandoned, then move finished games
+    out of the games table.  Defaults come from REAPER in config.yaml.
+
+    Archived games no longer appear in a player's game history.'''
+    config = get_config(os.environ['FLASK_ENV'], open('server/config.yaml'))
+    options = dict(config.get('REAPER') or {})
+    if idle_hours is None:
+        idle_hours = float(options.get('idle_hours', 24))
+    if archive_days is None:
+        archive_days = float(options.get('archive_days', 90))
+    if batch_size is None:
+        batch_size = int(options.get('batch_size', 500))
+    db_games = create_engine(config['DB_GAMES'])
+    base_games.metadata.create_all(db_games)
+    add_missing_columns(db_games, User.__table__)
+    add_missing_columns(db_games, Game.__table__)
+    add_missing_columns(db_games, ArchivedGame.__table__)
+    add_missing_indexes(db_games, Game.__table__)
+
+    now = datetime.datetime.now()
+    totals = reap_idle(db_games, now - datetime.timedelta(hours=idle_hours),
+                       batch_size, lambda t: print(
+                           '  {games} games abandoned'.format(**t), end='\r'))
+    print('\nAbandoned {games} games of {players} players idle over {hours:g} '
+          'hours in {seconds:.2f}s'.format(hours=idle_hours, **totals))
+    totals = archive_finished(db_games, now - datetime.timedelta(days=archive_days),
+                              batch_size, path, lambda t: print(
+                                  '  {games} games archived'.format(**t), end='\r'))
+    print('\nArchived {games} games ended over {days:g} days ago to {target} '
+          'in {seconds:.2f}s'.format(days=archive_days,
+                                     target=path or 'games_archive', **totals))
+
+@app.cli.command('audit-games')
+@click.option('--report', 'path', default='audit-games.csv',
+              type=click.Path(dir_okay=False), help='CSV file of inconsistent games')
+@click.option('--archive', is_flag=True, help='Audit games_archive instead of games')
+@click.option('--workers', type=int, help='Checking processes (default: one per CPU)')
+@click.option('--chunk-size', default=10000, help='Games per chunk sent to a worker')
+def audit_games_command(path, archive, workers, chunk_size):
+    '''Check the guessed letters and bad guesses of every game against its
+    usage, on a pool of processes, and report the inconsistent games'''
+    config = get_config(os.environ['FLASK_ENV'], open('server/config.yaml'))
+    registry.configure(config)
+    usage_index.configure(config)
+    guess_tables = { usage_id: row.guess for usage_id, row in usage_index.rows().items() }
+    table = (ArchivedGame if archive else Game).__table__
+    totals = audit_games(create_engine(config['DB_GAMES']), guess_tables, path,
+                         table, workers, chunk_size, lambda t: print(
+                             '  {games} games checked'.format(**t), end='\r'))
+    print('\nChecked {games} games of {table} in {seconds:.2f}s: {inconsistent} '
+          'inconsistent, reported in {path}'.format(table=table.name, path=path,
+                                                   **totals))
+
+@app.cli.command('export-games')
+@click.option('--to', 'path', type=click.Path(file_okay=False),
+              help='Directory of the partitioned files')
+@click.option('--format', 'fmt', type=click.Choice(FORMATS))
+@click.option('--chunk-size', type=int, help='Games read per fetch')
+@click.option('--lag-minutes', type=float,
+              help='Leave games that ended this recently for the next run')
+def export_games_command(path, fmt, chunk_size, lag_minutes):
+    '''Write the games that ended since the last export, with their usage,
+    to compressed files partitioned by end date and language, and add them
+    to the rollup_letters, rollup_lengths, rollup_guess_order and
+    rollup_first_guesses tables.  Defaults come from EXPORT in
+    config.yaml.'''
+    config = get_config(os.environ['FLASK_ENV'], open('server/config.yaml'))
+    options = dict(config.get('EXPORT') or {})
+    path = path or options.get('path', 'exports')
+    fmt = fmt or options.get('format', 'jsonl')
+    if chunk_size is None:
+        chunk_size = int(options.get('chunk_size', 10000))
+    if lag_minutes is None:
+        lag_minutes = float(options.get('lag_minutes', 10))
+    registry.configure(config)
+    usage_index.configure(config)
+    db_games = create_engine(config['DB_GAMES'])
+    base_games.metadata.create_all(db_games)
+    add_missing_indexes(db_games, Game.__table__)
+    add_missing_indexes(db_games, ArchivedGame.__table__)
+
+    totals = export_games(db_games, path, fmt, chunk_size, lag_minutes * 60,
+                          lambda t: print('  {games} games exported'.format(**t),
+                                          end='\r'))
+    print('\nExported {games} games ended from {since} to {until} into {files} '
+          '{fmt} files under {path} in {seconds:.2f}s ({skipped} of unknown '
+          'usages skipped)'.format(fmt=fmt, path=path, **dict(
+              totals, since=totals['since'] or 'the start')))
@@ -0,0 +1,115 @@
+import datetime
+import gzip
+import json
+import time
+
+from sqlalchemy import bindparam, func, select, text
+
+from .game_store import game_to_state
+from .langman_orm import ArchivedGame, Game
+
+ABANDON_COUNTERS = text(
+    'UPDATE users SET outcome_active = outcome_active - :n, '
+    'outcome_abandoned = outcome_abandoned + :n WHERE user_id = :user_id')
+
+def reap_idle(engine, cutoff, batch_size=500, progress=None):
+    '''Mark the unfinished games with no guess since ``cutoff`` (their
+    ``last_move``, or their start in games from before it was kept) as
+    abandoned by setting their ``end_time``, and move them from the
+    ``active`` to the ``abandoned`` count of their players
+
+    Games are handled ``batch_size`` at a time, each batch in its own
+    transaction: one UPDATE of the games, guarded by the same condition as
+    the pick so a game finished or played in the meantime is left alone,
+    then one executemany of counter updates, one per player.  Guesses held
+    in a ``game_store`` cache reach ``last_move`` within its
+    ``flush_interval``, which should be far shorter than the idle time; a
+    cached game reaped all the same cannot be ended and counted again (see
+    ``GameStore.end``).  ``progress``, if given, is called with the
+    running totals after each batch.
+
+    :returns: dict with counts of ``games`` abandoned and ``players``
+              updated and the ``seconds`` taken
+    '''
+    games = Game.__table__
+    idle = games.c.end_time.is_(None) & \
+        (func.coalesce(games.c.last_move, games.c.start_time) < cutoff)
+    pick = select([games.c.game_id]).where(idle) \
+                                    .order_by(games.c.start_time).limit(batch_size)
+    ids = bindparam('ids', expanding=True)
+    close = games.update().where(games.c.game_id.in_(ids) & idle) \
+                          .values(end_time=bindparam('now'))
+    closed = select([games.c.player, func.count()]).where(
+        games.c.game_id.in_(ids) & (games.c.end_time == bindparam('now'))
+    ).group_by(games.c.player)
+
+    totals = {'games': 0, 'players': 0}
+    players = set()
+    start = time.perf_counter()
+    while True:
+        with engine.begin() as conn:
+            batch = [ row[0] for row in conn.execute(pick) ]
+            if not batch:
+                break
+            now = datetime.datetime.now()
+            conn.execute(close, ids=batch, now=now)
+            counts = conn.execute(closed, ids=batch, now=now).fetchall()
+            if counts:
+                conn.execute(ABANDON_COUNTERS, [ {'user_id': player, 'n': n}
+                                                 for player, n in counts ])
+        totals['games'] += sum(n for _, n in counts)
+        players.update(player for player, _ in counts)
+        totals['players'] = len(players)
+        if progress is not None:
+            progress(totals)
+    totals['seconds'] = time.perf_counter() - start
+    return totals
+
+def archive_finished(engine, cutoff, batch_size=500, path=None, progress=None):
+    '''Move the games that ended before ``cutoff`` out of ``games``
+
+    They go to the ``games_archive`` table, or, given a ``path``, are
+    appended to that gzip-compressed JSON-lines file, one game state per
+    line.  Games are moved ``batch_size`` at a time, oldest first, each
+    batch deleted in its own transaction once copied; a batch written to
+    the file is flushed before its delete commits, so an interruption can
+    repeat a batch in the file but not lose one.  ``progress``, if given,
+    is called with the running totals after each batch.
+
+    :returns: dict with the count of ``games`` archived and the
+              ``seconds`` taken
+    '''
+    games = Game.__table__
+    pick = select([games]).where(games.c.end_time < cutoff) \
+                          .order_by(games.c.end_time).limit(batch_size)
+    ids = bindparam('ids', expanding=True)
+    copy = ArchivedGame.__table__.insert().from_select(
+        [ c.name for c in games.columns ],
+        select([games]).where(games.c.game_id.in_(ids)))
+    remove = games.delete().where(games.c.game_id.in_(ids))
+
+    archive = gzip.open(path, 'at', encoding='utf8') if path else None
+    totals = {'games': 0}
+    start = time.perf_counter()
+    try:
+        while True:
+            with engine.begin() as conn:
+                rows = conn.execute(pick).fetchall()
+                if not rows:
+                    break
+                batch = [ row.game_id for row in rows ]
+                if archive is None:
+                    conn.execute(copy, ids=batch)
+                else:
+                    archive.write(''.join(json.dumps(game_to_state(row)) + '\n'
+                                          for row in rows))
+                    archive.flush()
+                conn.execute(remove, ids=batch)
+            totals['games'] += len(batch)
+            if progress is not None:
+                progress(totals)
+    finally:
+        if archive is not None:
+            archive.close()
+    totals['seconds'] = time.perf_counter() - start
+    return totals
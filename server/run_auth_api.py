@@ -2,9 +2,10 @@ from flask import Flask, g
 from flask_restplus import Api
 from flask_cors import CORS
 import flask_jwt_extended as JWT
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
 
+from .db import registry
+from .login_guard import login_guard
+from .passwords import passwords
 from .util import get_config
 from .auth_api import auth_api
 
@@ -26,19 +27,19 @@ if 'JWT_ACCESS_TOKEN_EXPIRES' not in app.config:
     app.config['JWT_ACCESS_TOKEN_EXPIRES'] = 86400 # default to 1 day
 
 jwt = JWT.JWTManager(app)
+registry.configure(app.config)
+passwords.configure(app.config)
+login_guard.configure(app.config)
 
 @app.before_request
 def init_db():
     '''Initialize db by creating the global db_session'''
-    if not hasattr(g, 'auth_db'):
-        db_auth = create_engine(app.config['DB_AUTH'])
-        g.auth_db = sessionmaker(db_auth)()
+    g.auth_db = registry.session('DB_AUTH')
 
 @app.teardown_request
 def close_db(exception):
-    '''Close down db connection'''
-    if hasattr(g, 'auth_db'):
-        g.auth_db.close()
-        _ = g.pop('auth_db')
+    '''Return the db connection to the pool'''
+    registry.remove()
+    g.pop('auth_db', None)
 
 
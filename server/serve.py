@@ -0,0 +1,7 @@
+'''The application gunicorn serves: the Flask (WSGI) app, or with
+``SERVER_MODE: async`` in ``config.yaml`` the ASGI app of ``server.asgi``.
+``config/gunicorn.conf.py`` picks the matching worker class.'''
+from .app import app
+
+if app.config.get('SERVER_MODE', 'sync') == 'async':
+    from .asgi import app
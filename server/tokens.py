@@ -0,0 +1,149 @@
+import collections
+import datetime
+import functools
+import hashlib
+import threading
+import time
+
+import flask_jwt_extended as JWT
+from flask import request
+from flask_jwt_extended.config import config as jwt_config
+from flask_jwt_extended.utils import ctx_stack
+
+from .instrument import record
+
+class TokenManager:
+    '''Issues access tokens and caches their verification in this process
+
+    * Game-scoped tokens are remembered per ``(user_id, game_id)`` and handed
+      out again for the rest of the ``game_token_period`` they were issued
+      in, instead of signing a new one on every game GET.  A period is the
+      token lifetime less ``refresh_margin``, so each token has at least
+      that many seconds left when its period ends, and every worker agrees
+      on the period number (``game_token_epoch``).
+    * Verified claims are cached by the SHA-256 digest of the
+      ``Authorization`` header for at most ``verify_ttl`` seconds and never
+      past the token's ``exp``, so a client reusing a token skips the
+      signature check in views decorated with ``tokens.jwt_required``.
+
+    Both caches are bounded LRUs.  Options come from ``TOKENS`` in
+    ``config.yaml``; ``stats`` returns the issue and verify counts.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._issued = collections.OrderedDict()    # (user_id, game_id) -> (token, epoch)
+        self._verified = collections.OrderedDict()  # digest -> (claims, header, expires)
+        self.refresh_margin = 300
+        self.verify_ttl = 300
+        self.max_entries = 10000
+        self.counts = collections.Counter()
+
+    def configure(self, config):
+        options = dict(config.get('TOKENS') or {})
+        self.refresh_margin = float(options.get('refresh_margin', 300))
+        self.verify_ttl = float(options.get('verify_ttl', 300))
+        self.max_entries = int(options.get('max_entries', 10000))
+        with self._lock:
+            self._issued.clear()
+            self._verified.clear()
+
+    def _remember(self, cache, key, value):
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > self.max_entries:
+            cache.popitem(last=False)
+
+    def create(self, identity, user_claims):
+        '''Sign and return a new access token'''
+        with self._lock:
+            self.counts['issued'] += 1
+        return JWT.create_access_token(identity=identity, user_claims=user_claims)
+
+    def game_token_period(self):
+        '''Return the seconds a game token is handed out for: the token
+        lifetime less ``refresh_margin``, or None if tokens never expire'''
+        expires = jwt_config.access_expires
+        if not isinstance(expires, datetime.timedelta):
+            return None
+        return max(expires.total_seconds() - self.refresh_margin, 1.0)
+
+    def game_token_epoch(self, now=None):
+        '''Return the number of the current ``game_token_period``, the same
+        in every process (0 if tokens never expire)'''
+        period = self.game_token_period()
+        if period is None:
+            return 0
+        return int((time.time() if now is None else now) // period)
+
+    def game_token(self, identity, name, game_id):
+        '''Return an access token for game ``game_id``, reusing the one last
+        issued for it during the current ``game_token_epoch``'''
+        key = (identity, game_id)
+        epoch = self.game_token_epoch()
+        with self._lock:
+            cached = self._issued.get(key)
+            if cached is not None and cached[1] == epoch:
+                self._issued.move_to_end(key)
+                self.counts['reused'] += 1
+                return cached[0]
+        token = self.create(identity, {'access':'player', 'name':name,
+                                       'game_id':game_id})
+        with self._lock:
+            self._remember(self._issued, key, (token, epoch))
+        return token
+
+    def jwt_required(self, fn):
+        '''View decorator like ``flask_jwt_extended.jwt_required`` that
+        verifies the access token with ``verify_jwt_in_request``'''
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            self.verify_jwt_in_request()
+            return fn(*args, **kwargs)
+        return wrapper
+
+    def verify_jwt_in_request(self):
+        '''Make the claims of the request's access token available to
+        ``get_jwt_identity`` and ``get_jwt_claims``: from the cache if the
+        same ``Authorization`` header was verified before, else verified by
+        ``flask_jwt_extended.verify_jwt_in_request`` and cached.  Either way
+        the time taken is recorded as the request's ``jwt`` phase.'''
+        start = time.perf_counter()
+        try:
+            self._verify()
+        finally:
+            record('jwt', time.perf_counter() - start)
+
+    def _verify(self):
+        header = request.headers.get(jwt_config.header_name)
+        if not header or request.method in jwt_config.exempt_methods:
+            JWT.verify_jwt_in_request()
+            return
+        digest = hashlib.sha256(header.encode()).digest()
+        now = time.time()
+        with self._lock:
+            cached = self._verified.get(digest)
+            if cached is not None:
+                if cached[2] > now:
+                    self._verified.move_to_end(digest)
+                    self.counts['verify_cached'] += 1
+                    ctx_stack.top.jwt = dict(cached[0])
+                    ctx_stack.top.jwt_header = cached[1]
+                    return
+                del self._verified[digest]
+        JWT.verify_jwt_in_request()
+        claims = dict(JWT.get_raw_jwt())
+        expires = min(claims.get('exp', now), now + self.verify_ttl)
+        with self._lock:
+            self.counts['verified'] += 1
+            self._remember(self._verified, digest,
+                           (claims, JWT.get_raw_jwt_header(), expires))
+
+    def stats(self):
+        '''Return the token counts: ``issued`` (signed), ``reused`` (game
+        tokens handed out again), ``verified`` (signature checked) and
+        ``verify_cached`` (claims from the cache)'''
+        with self._lock:
+            return { k: self.counts[k]
+                     for k in ('issued', 'reused', 'verified', 'verify_cached') }
+
+tokens = TokenManager()
@@ -0,0 +1,349 @@
+import array
+import collections
+import functools
+import logging
+import math
+import os
+import random
+import threading
+import time
+
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import OperationalError
+from unidecode import unidecode
+
+from .corpus import iter_corpus_csv
+from .langman_orm import LETTER_BITS, letters_to_mask
+
+log = logging.getLogger(__name__)
+
+class GuessTable(collections.namedtuple('GuessTable',
+                                         'folded masks base_mask letters_mask')):
+    '''Precomputed guess lookup for one secret word:
+      * ``folded`` - The secret word lower-cased and ``unidecode`` folded
+      * ``masks`` - Dict from folded letter to the bit mask of the
+        positions that letter reveals
+      * ``base_mask`` - Positions shown from the start (characters that do
+        not fold to a single letter, such as hyphens)
+      * ``letters_mask`` - The letters of the word as a mask of
+        ``LETTER_BITS``, like a game's ``guessed_mask``
+
+    A guess is then a dict lookup, and the revealed positions are the
+    union of the guessed letters' masks.
+    '''
+    __slots__ = ()
+
+    @classmethod
+    def build(cls, secret_word):
+        masks = {}
+        base_mask = 0
+        pieces = [ unidecode(l.lower()) for l in secret_word ]
+        for i, piece in enumerate(pieces):
+            if len(piece) == 1 and piece in LETTER_BITS:
+                masks[piece] = masks.get(piece, 0) | (1 << i)
+            else:
+                base_mask |= 1 << i
+        return cls(''.join(pieces), masks, base_mask, letters_to_mask(masks))
+
+    def is_good(self, letter):
+        '''True if the folded ``letter`` occurs in the secret word'''
+        return letter in self.masks
+
+    def misses(self, guessed_mask):
+        '''Return the number of letters in ``guessed_mask`` not in the word'''
+        return bin(guessed_mask & ~self.letters_mask).count('1')
+
+    def solved(self, guessed_mask):
+        '''True if ``guessed_mask`` holds every letter of the word'''
+        return not self.letters_mask & ~guessed_mask
+
+    def reveal_mask(self, guessed_mask):
+        '''Return the bit mask of positions revealed by the letters in
+        ``guessed_mask``'''
+        mask = self.base_mask
+        for letter, positions in self.masks.items():
+            if guessed_mask & LETTER_BITS[letter]:
+                mask |= positions
+        return mask
+
+    def reveal(self, secret_word, guessed_mask):
+        '''Return ``secret_word`` with the positions not revealed by
+        ``guessed_mask`` blanked as underscores'''
+        mask = self.reveal_mask(guessed_mask)
+        return ''.join([ l if mask >> i & 1 else '_'
+                         for i, l in enumerate(secret_word) ])
+
+class UsageRow(collections.namedtuple(
+        'UsageRow', 'usage_id language secret_word usage source guess')):
+    '''Read-only copy of one ``usages`` record, with the same attribute
+    names as the ``Usage`` ORM class, plus the ``GuessTable`` of its
+    secret word as ``guess``'''
+    __slots__ = ()
+
+    @classmethod
+    def build(cls, usage_id, language, secret_word, usage, source):
+        return cls(usage_id, language, secret_word, usage, source,
+                   GuessTable.build(secret_word))
+
+    def reveal(self, guessed_mask):
+        '''Return the secret word as revealed by the letters in
+        ``guessed_mask``'''
+        return self.guess.reveal(self.secret_word, guessed_mask)
+
+    def blanked(self):
+        '''Return the usage sentence with the secret word blanked'''
+        return blank_usage(self.usage, self.secret_word)
+
+@functools.lru_cache(maxsize=8192)
+def blank_usage(usage, secret_word):
+    '''Return the ``usage`` sentence with its ``{word}`` placeholder filled
+    with one underscore per letter of ``secret_word``; memoized, as the
+    result for a usage never changes'''
+    return usage.format(word='_'*len(secret_word))
+
+DIFFICULTIES = ('easy', 'medium', 'hard')
+
+def letter_order(rows):
+    '''Return the folded letters of the secret words of ``rows`` from most
+    to least frequent'''
+    counts = collections.Counter()
+    for row in rows:
+        counts.update(l for l in row.guess.folded if l in row.guess.masks)
+    return sorted(counts, key=lambda l: (-counts[l], l))
+
+def difficulty_key(guess, order):
+    '''Return the sort key of a secret word's difficulty from its
+    ``GuessTable``: the misses of a player guessing letters in the
+    language's frequency ``order`` before the word is revealed (short
+    words with rare letters miss most), then the Shannon entropy of the
+    word's letters, lower being harder (fewer, more repeated letters)'''
+    hidden = set(guess.masks)
+    misses = 0
+    for letter in order:
+        if not hidden:
+            break
+        if letter in hidden:
+            hidden.discard(letter)
+        else:
+            misses += 1
+    counts = [ bin(mask).count('1') for mask in guess.masks.values() ]
+    total = sum(counts)
+    entropy = -sum(c / total * math.log2(c / total) for c in counts) if total else 0.0
+    return (misses, -entropy)
+
+def difficulty_buckets(rows):
+    '''Return a dict from ``(language, difficulty)`` to the array of usage
+    ids of ``rows`` at that difficulty.  Each language's usages are ranked
+    by ``difficulty_key`` and split in equal thirds over ``DIFFICULTIES``.'''
+    by_lang = {}
+    for row in rows:
+        by_lang.setdefault(row.language, []).append(row)
+    buckets = {}
+    for lang, lang_rows in by_lang.items():
+        order = letter_order(lang_rows)
+        lang_rows.sort(key=lambda row: difficulty_key(row.guess, order))
+        for rank, row in enumerate(lang_rows):
+            level = DIFFICULTIES[rank * len(DIFFICULTIES) // len(lang_rows)]
+            buckets.setdefault((lang, level), array.array('l')).append(row.usage_id)
+    return buckets
+
+class SeenSet:
+    '''Bitmap of the usage ids served to one player: bit ``usage_id`` is set
+    once that usage was picked, so 6000 usages take 750 bytes.  Stored as
+    bytes in ``users.seen_usages``.'''
+    def __init__(self, data=None):
+        self.bits = bytearray(data or b'')
+
+    def __contains__(self, usage_id):
+        i = usage_id >> 3
+        return i < len(self.bits) and bool(self.bits[i] >> (usage_id & 7) & 1)
+
+    def add(self, usage_id):
+        i = usage_id >> 3
+        if i >= len(self.bits):
+            self.bits.extend(bytes(i + 1 - len(self.bits)))
+        self.bits[i] |= 1 << (usage_id & 7)
+
+    def discard_all(self, usage_ids):
+        for usage_id in usage_ids:
+            i = usage_id >> 3
+            if i < len(self.bits):
+                self.bits[i] &= ~(1 << (usage_id & 7)) & 0xff
+
+    def to_bytes(self):
+        return bytes(self.bits)
+
+def read_corpus(path):
+    '''Yield a ``UsageRow`` for each usable row of the corpus CSV at ``path``
+
+    Rows are skipped the same way as when ``init-db`` fills the ``usages``
+    table.'''
+    for row in iter_corpus_csv(path):
+        yield UsageRow.build(*row)
+
+class UsageIndex:
+    '''In-memory, read-only index over the usage corpus
+
+    Keeps an array of usage ids per language and per ``(language,
+    difficulty)`` bucket plus one ``UsageRow`` per usage, with the guess
+    table of its secret word folded and its difficulty scored once at load
+    time, so that picking a random puzzle and looking up a game's usage
+    need no database round trip.  The corpus is read from the ``usages``
+    table at ``DB_USAGE`` or, when that is not set or the table is empty,
+    from the ``USAGE_CSV`` file (default ``data/usages.csv``).  A database
+    that cannot be read is logged; a reload then keeps the corpus already
+    loaded, and a first load raises the error.
+
+    The source file's modification time is checked at most every
+    ``USAGE_INDEX_CHECK`` seconds (default 30) and the index reloads when it
+    changes.  A reload builds new structures and swaps them in one
+    assignment, so readers never see a half-built index.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._url = None
+        self._csv_path = 'data/usages.csv'
+        self._check_interval = 30
+        self._data = None          # (by_lang, by_id, by_level) once loaded
+        self._stamp = None         # (path, mtime) of the loaded source
+        self._checked = 0
+
+    def configure(self, config):
+        '''Take the corpus location from the application ``config``.  The
+        corpus is loaded on first use.'''
+        with self._lock:
+            self._url = config.get('DB_USAGE')
+            self._csv_path = config.get('USAGE_CSV', self._csv_path)
+            self._check_interval = float(config.get('USAGE_INDEX_CHECK', 30))
+            self._data = None
+
+    def _sqlite_path(self):
+        '''Return the file path of ``DB_USAGE`` if it is a sqlite database'''
+        if self._url and self._url.startswith('sqlite'):
+            return make_url(self._url).database
+        return None
+
+    def _source_stamp(self, path):
+        try:
+            return (path, os.stat(path).st_mtime)
+        except (OSError, TypeError):
+            return (path, None)
+
+    def _read_db(self):
+        '''Return a list of ``UsageRow`` from the ``usages`` table'''
+        from .db import registry
+        engine = registry.engine('DB_USAGE')
+        result = engine.execute(
+            'SELECT usage_id, language, secret_word, usage, source FROM usages')
+        return [ UsageRow.build(*row) for row in result ]
+
+    def _load(self):
+        '''Read the corpus and swap in the new index'''
+        rows = []
+        path = self._sqlite_path()
+        if self._url:
+            try:
+                rows = self._read_db()
+            except OperationalError:
+                log.exception('Could not read the usages table at DB_USAGE')
+                if self._data is None:
+                    raise
+                self._checked = time.monotonic()
+                return
+            if not rows:
+                log.warning('The usages table is empty; reading %s', self._csv_path)
+        if not rows:
+            path = self._csv_path
+            rows = list(read_corpus(path))
+
+        by_lang = {}
+        by_id = {}
+        for row in sorted(rows, key=lambda row: row.usage_id):
+            by_lang.setdefault(row.language, array.array('l')).append(row.usage_id)
+            by_id[row.usage_id] = row
+        self._data = (by_lang, by_id, difficulty_buckets(by_id.values()))
+        self._stamp = self._source_stamp(path)
+        self._checked = time.monotonic()
+
+    def refresh(self):
+        '''Load the corpus if it was never loaded or its source file has
+        changed since the last load.  Cheap when called on every request.'''
+        if (self._data is not None and
+            time.monotonic() - self._checked < self._check_interval):
+            return
+        with self._lock:
+            if self._data is None:
+                self._load()
+            elif time.monotonic() - self._checked >= self._check_interval:
+                self._checked = time.monotonic()
+                if self._source_stamp(self._stamp[0]) != self._stamp:
+                    self._load()
+
+    def reload(self):
+        '''Unconditionally re-read the corpus'''
+        with self._lock:
+            self._load()
+
+    def random(self, lang, difficulty=None, seen=None):
+        '''Return a random ``UsageRow`` in language ``lang``, from the
+        ``difficulty`` bucket if one of ``DIFFICULTIES`` is given (or any
+        difficulty if that bucket is empty), or None if the language has no
+        usages
+
+        With a ``SeenSet`` ``seen``, a usage not in it is picked and added
+        to it.  A few random draws are tried before scanning the pool from
+        a random position, so the expected cost stays constant until the
+        pool is nearly used up.  Once every usage in the pool has been
+        seen, their bits are cleared and the pool starts over.'''
+        self.refresh()
+        by_lang, by_id, by_level = self._data
+        ids = by_level.get((lang, difficulty)) or by_lang.get(lang)
+        if not ids:
+            return None
+        if seen is None:
+            return by_id[ids[random.randrange(len(ids))]]
+
+        usage_id = None
+        for _ in range(8):
+            candidate = ids[random.randrange(len(ids))]
+            if candidate not in seen:
+                usage_id = candidate
+                break
+        else:
+            start = random.randrange(len(ids))
+            for i in range(len(ids)):
+                candidate = ids[(start + i) % len(ids)]
+                if candidate not in seen:
+                    usage_id = candidate
+                    break
+        if usage_id is None:           # every usage seen: start over
+            seen.discard_all(ids)
+            usage_id = ids[random.randrange(len(ids))]
+        seen.add(usage_id)
+        return by_id[usage_id]
+
+    def get(self, usage_id):
+        '''Return the ``UsageRow`` with id ``usage_id``; raises ``KeyError``
+        if the id is not in the corpus'''
+        self.refresh()
+        return self._data[1][usage_id]
+
+    def ids(self, lang, difficulty=None):
+        '''Return the array of usage ids in language ``lang``, or only those
+        at ``difficulty`` if given'''
+        self.refresh()
+        if difficulty is not None:
+            return self._data[2].get((lang, difficulty), array.array('l'))
+        return self._data[0].get(lang, array.array('l'))
+
+    def rows(self):
+        '''Return the dict from usage id to ``UsageRow``.  The same object
+        is returned until the corpus reloads; do not modify it.'''
+        self.refresh()
+        return self._data[1]
+
+    def __len__(self):
+        self.refresh()
+        return len(self._data[1])
+
+usage_index = UsageIndex()
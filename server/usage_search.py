@@ -0,0 +1,298 @@
+'''Full-text search over the usage corpus
+
+Each usage is indexed as three fields: the secret ``word``, the
+``sentence`` with the word filled in, and the ``source`` title.  Text is
+folded with ``unidecode`` and lower-cased, as the game folds guesses and
+secret words, then split into ``[a-z0-9]+`` tokens, so 'Éclair' and
+'eclair' match alike.  The same tokens are stored in every backend:
+
+* ``fts5`` - A sqlite FTS5 table ``usage_fts`` in the ``DB_USAGE``
+  database, ranked by ``bm25``
+* ``postgres`` - A table ``usage_search`` with a weighted ``tsvector`` and
+  a GIN index, ranked by ``ts_rank``
+* ``memory`` - An inverted index built in this process from the
+  ``usage_index``, ranked by BM25
+
+The database indexes are (re)built by ``flask index-usages``, which
+``init-db`` and ``load-corpus`` also run.  The committed ``usages.db``
+holds no ``usage_fts`` table; the Procfile builds it when a dyno starts.
+'''
+import math
+import re
+import threading
+
+from sqlalchemy import text
+from unidecode import unidecode
+
+from .usage_index import usage_index
+
+TOKEN = re.compile('[a-z0-9]+')
+FIELDS = ('word', 'sentence', 'source')
+WEIGHTS = (4.0, 1.0, 0.5)        # per field, for ranking
+
+def fold_tokens(value):
+    '''Return the folded tokens of the string ``value``'''
+    return TOKEN.findall(unidecode(value or '').lower())
+
+def parse_query(q):
+    '''Return the phrases of the query string ``q`` as lists of tokens:
+    each double-quoted part is one phrase, every other word its own'''
+    phrases = []
+    for quoted, bare in re.findall(r'"([^"]*)"?|(\S+)', q or ''):
+        if quoted:
+            phrases.append(fold_tokens(quoted))
+        else:
+            phrases.extend([ token ] for token in fold_tokens(bare))
+    return [ phrase for phrase in phrases if phrase ]
+
+def documents(rows):
+    '''Yield a dict with the ``usage_id``, ``language`` and folded fields
+    (tokens joined by spaces) of each usage in ``rows``'''
+    for row in rows:
+        sentence = row.usage.replace('{word}', row.secret_word)
+        yield {'usage_id': row.usage_id, 'language': row.language,
+               'word': ' '.join(fold_tokens(row.secret_word)),
+               'sentence': ' '.join(fold_tokens(sentence)),
+               'source': ' '.join(fold_tokens(row.source))}
+
+KEYSET = ('WHERE :after_id IS NULL OR score > :after_score OR '
+          '(score = :after_score AND usage_id > :after_id) '
+          'ORDER BY score, usage_id LIMIT :limit')
+
+class Fts5Search:
+    '''Search in the sqlite FTS5 table ``usage_fts``'''
+    name = 'fts5'
+    table = 'usage_fts'
+
+    def create(self, conn):
+        conn.execute('DROP TABLE IF EXISTS usage_fts')
+        conn.execute("CREATE VIRTUAL TABLE usage_fts USING fts5(word, sentence, "
+                     "source, language UNINDEXED, tokenize='unicode61')")
+
+    def insert(self, conn, rows):
+        conn.execute(text('INSERT INTO usage_fts (rowid, word, sentence, source, '
+                          'language) VALUES (:usage_id, :word, :sentence, '
+                          ':source, :language)'), list(documents(rows)))
+
+    def search(self, conn, phrases, source, lang, after, limit):
+        terms = [ '{word sentence} : "' + ' '.join(phrase) + '"' for phrase in phrases ]
+        terms += [ 'source : "' + token + '"' for token in source ]
+        query = text(
+            'SELECT score, usage_id FROM (SELECT bm25(usage_fts, {}) AS score, '
+            'rowid AS usage_id FROM usage_fts WHERE usage_fts MATCH :match{}) '
+            .format(', '.join(map(str, WEIGHTS)),
+                    ' AND language = :lang' if lang else '') + KEYSET)
+        return conn.execute(query, match=' AND '.join(terms), lang=lang,
+                            after_score=after[0], after_id=after[1],
+                            limit=limit).fetchall()
+
+class PostgresSearch:
+    '''Search in the table ``usage_search``, whose ``document`` holds the
+    fields with weights A (word), B (sentence) and C (source)'''
+    name = 'postgres'
+    table = 'usage_search'
+
+    def create(self, conn):
+        conn.execute('CREATE TABLE IF NOT EXISTS usage_search ('
+                     'usage_id INTEGER PRIMARY KEY, language VARCHAR(2) NOT NULL, '
+                     'document TSVECTOR NOT NULL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_usage_search_document '
+                     'ON usage_search USING GIN (document)')
+        conn.execute('TRUNCATE usage_search')
+
+    def insert(self, conn, rows):
+        conn.execute(text(
+            "INSERT INTO usage_search VALUES (:usage_id, :language, "
+            "setweight(to_tsvector('simple', :word), 'A') || "
+            "setweight(to_tsvector('simple', :sentence), 'B') || "
+            "setweight(to_tsvector('simple', :source), 'C'))"), list(documents(rows)))
+
+    def search(self, conn, phrases, source, lang, after, limit):
+        terms = [ '(' + ' <-> '.join(token + ':AB' for token in phrase) + ')'
+                  for phrase in phrases ]
+        terms += [ token + ':C' for token in source ]
+        # ts_rank takes weights for D, C, B, A of at most 1
+        weights = '{' + ', '.join(str(w / max(WEIGHTS)) for w in (0.0,) + WEIGHTS[::-1]) + '}'
+        query = text(
+            'SELECT score, usage_id FROM (SELECT '
+            "-ts_rank('{}', document, q)::float8 AS score, usage_id "
+            "FROM usage_search, to_tsquery('simple', :query) q "
+            'WHERE document @@ q{}) AS matches '.format(
+                weights, ' AND language = :lang' if lang else '') + KEYSET)
+        return conn.execute(query, query=' & '.join(terms), lang=lang,
+                            after_score=after[0], after_id=after[1],
+                            limit=limit).fetchall()
+
+class MemorySearch:
+    '''Search in an inverted index of the ``usage_index`` rows, rebuilt
+    when the corpus reloads'''
+    name = 'memory'
+    k1, b = 1.2, 0.75
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rows = None
+        self._index = None
+
+    def _build(self, rows):
+        '''Return, per field, the postings (token -> usage_id -> token
+        positions), the field length of each usage and the average length,
+        and the language of each usage'''
+        fields = [ ({}, {}) for _ in FIELDS ]
+        languages = {}
+        for doc in documents(rows.values()):
+            languages[doc['usage_id']] = doc['language']
+            for name, (postings, lengths) in zip(FIELDS, fields):
+                tokens = doc[name].split()
+                lengths[doc['usage_id']] = len(tokens)
+                for i, token in enumerate(tokens):
+                    postings.setdefault(token, {}).setdefault(doc['usage_id'], []).append(i)
+        return ([ (postings, lengths, sum(lengths.values()) / max(len(lengths), 1))
+                  for postings, lengths in fields ], languages)
+
+    def _index_for(self, rows):
+        with self._lock:
+            if self._rows is not rows:
+                self._index = self._build(rows)
+                self._rows = rows
+            return self._index
+
+    @staticmethod
+    def _phrase_ids(postings, phrase):
+        '''Return the usage ids whose field has the tokens of ``phrase`` in
+        a row'''
+        lists = [ postings.get(token, {}) for token in phrase ]
+        ids = set(lists[0])
+        for found in lists[1:]:
+            ids.intersection_update(found)
+        if len(phrase) > 1:
+            ids = { usage_id for usage_id in ids
+                    if any(all(start + i in lists[i][usage_id]
+                               for i in range(1, len(phrase)))
+                           for start in lists[0][usage_id]) }
+        return ids
+
+    def search(self, conn, phrases, source, lang, after, limit):
+        fields, languages = self._index_for(usage_index.rows())
+        total = len(languages)
+        matched = None
+        for phrase in phrases:
+            ids = set()
+            for postings, _, _ in fields[:2]:          # word and sentence
+                ids |= self._phrase_ids(postings, phrase)
+            matched = ids if matched is None else matched & ids
+        for token in source:
+            ids = set(fields[2][0].get(token, {}))
+            matched = ids if matched is None else matched & ids
+        if lang:
+            matched = { usage_id for usage_id in matched if languages[usage_id] == lang }
+
+        # query words score in the word and sentence, source words in the source
+        terms = [ [ token for phrase in phrases for token in phrase ] ] * 2 + [ source ]
+        scores = []
+        for usage_id in matched:
+            score = 0.0
+            for weight, (postings, lengths, avg), tokens in zip(WEIGHTS, fields, terms):
+                for token in tokens:
+                    found = postings.get(token, {})
+                    tf = len(found.get(usage_id, ()))
+                    if tf:
+                        idf = math.log(1 + (total - len(found) + 0.5) / (len(found) + 0.5))
+                        score += weight * idf * tf * (self.k1 + 1) / (
+                            tf + self.k1 * (1 - self.b + self.b * lengths[usage_id] / avg))
+            scores.append((-score, usage_id))
+        scores.sort()
+        if after[1] is not None:
+            scores = [ key for key in scores if key > tuple(after) ]
+        return scores[:limit]
+
+BACKENDS = { cls.name: cls for cls in (Fts5Search, PostgresSearch, MemorySearch) }
+
+class UsageSearch:
+    '''Ranked search of usages, with keyset pagination
+
+    Configured by ``SEARCH`` in ``config.yaml``:
+      * ``backend`` - ``auto`` (default: the ``DB_USAGE`` database's index if
+        it has been built, else ``memory``), ``fts5``, ``postgres`` or
+        ``memory``
+
+    ``auto`` decides on the first search in each process, so a server
+    started before ``flask index-usages`` searches in memory until it
+    restarts.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.backend_name = 'auto'
+        self._backend = None
+
+    def configure(self, config):
+        options = dict(config.get('SEARCH') or {})
+        name = options.get('backend', 'auto')
+        if name != 'auto' and name not in BACKENDS:
+            raise ValueError('Unknown SEARCH backend {}'.format(name))
+        with self._lock:
+            self.backend_name = name
+            self._backend = None
+
+    @staticmethod
+    def database_backend(engine):
+        '''Return the backend for the dialect of ``engine``, or None'''
+        if engine.dialect.name == 'sqlite':
+            return Fts5Search()
+        elif engine.dialect.name == 'postgresql':
+            return PostgresSearch()
+        return None
+
+    def _pick(self, session):
+        with self._lock:
+            if self._backend is None:
+                if self.backend_name != 'auto':
+                    self._backend = BACKENDS[self.backend_name]()
+                else:
+                    engine = session.get_bind()
+                    backend = self.database_backend(engine)
+                    if backend is None or not engine.has_table(backend.table):
+                        backend = MemorySearch()
+                    self._backend = backend
+            return self._backend
+
+    def search(self, session, q, lang=None, source=None, after=(None, None), limit=20):
+        '''Return up to ``limit`` ``(score, usage_id)`` pairs of the usages
+        matching every phrase of query ``q`` in their word or sentence and
+        every word of ``source`` in their source, best first (lowest
+        score), after the ``(score, usage_id)`` key ``after``'''
+        phrases = parse_query(q)
+        source_tokens = fold_tokens(source)
+        if not (phrases or source_tokens):
+            return []
+        backend = self._pick(session)
+        conn = session.connection() if backend.name != 'memory' else None
+        return [ (float(score), usage_id) for score, usage_id in backend.search(
+            conn, phrases, source_tokens, lang, after, limit) ]
+
+    def rebuild(self, engine, chunk_size=1000):
+        '''Build the database index of ``engine`` from its ``usages`` table;
+        returns the backend name and number of usages indexed
+
+        The usages are streamed and indexed ``chunk_size`` at a time, so
+        memory stays bounded for any corpus size.  The whole rebuild is one
+        transaction: searches see the old index until it commits.'''
+        backend = self.database_backend(engine)
+        if backend is None:
+            raise ValueError('No search index for {}'.format(engine.dialect.name))
+        count = 0
+        with engine.begin() as conn:
+            backend.create(conn)
+            result = conn.execution_options(stream_results=True).execute(
+                'SELECT usage_id, language, secret_word, usage, source FROM usages')
+            while True:
+                rows = result.fetchmany(chunk_size)
+                if not rows:
+                    break
+                backend.insert(conn, rows)
+                count += len(rows)
+        with self._lock:
+            self._backend = None
+        return backend.name, count
+
+usage_search = UsageSearch()
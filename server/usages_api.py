@@ -0,0 +1,81 @@
+import base64
+import json
+
+from flask import g, request
+from flask_restplus import Resource, Namespace
+
+from .usage_index import usage_index
+from .usage_search import usage_search
+from .tokens import tokens
+
+usages_api = Namespace('usages', description='Searching the usage corpus')
+
+def encode_cursor(key):
+    '''Return an opaque page cursor for the position after the search
+    result ``(score, usage_id)`` key'''
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode()).decode()
+
+def decode_cursor(cursor):
+    '''Return the ``(score, usage_id)`` key encoded in ``cursor``'''
+    score, usage_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return float(score), int(usage_id)
+
+@usages_api.route('/search')
+class SearchUsages(Resource):
+    valid_langs = ('en', 'es', 'fr')
+    max_limit = 100
+    @tokens.jwt_required
+    def get(self):
+        '''Search the usage sentences, best matches first
+
+        :route: ``/search`` GET (valid token required)
+
+        :query:
+              * ``q`` Words to find in the secret word or the sentence;
+                a part in double quotes must appear as a phrase
+              * ``source`` Words to find in the source book's title
+              * ``lang`` Only usages in this language (default: all)
+              * ``limit`` Number of usages per page (default 20, at most 100)
+              * ``after`` The ``next`` cursor from the previous page
+
+        :returns:
+           A page of usages:
+              * ``usages`` List of objects with the ``usage_id``, ``lang``,
+                ``secret_word``, the ``usage`` sentence with the word
+                filled in, and the ``source``
+              * ``next`` Cursor for the following page, or null on the last
+
+        At least one of ``q`` and ``source`` is required.  Matching ignores
+        case and accents (letters are folded as in the game); matches in
+        the secret word rank above matches in the sentence.  Pages are
+        found by keyset on ``(rank, usage_id)``.
+        '''
+        q = request.args.get('q', '')
+        source = request.args.get('source', '')
+        lang = request.args.get('lang') or None
+        if not (q.strip() or source.strip()):
+            usages_api.abort(400, 'Search requires q or source')
+        if lang is not None and lang not in self.valid_langs:
+            usages_api.abort(400, 'lang must be from ' + ', '.join(self.valid_langs))
+        try:
+            limit = min(int(request.args.get('limit', 20)), self.max_limit)
+            after = request.args.get('after')
+            key = decode_cursor(after) if after else (None, None)
+        except (ValueError, TypeError):
+            usages_api.abort(400, 'Invalid limit or after cursor')
+        if limit < 1:
+            usages_api.abort(400, 'Invalid limit or after cursor')
+
+        found = usage_search.search(g.usage_db, q, lang, source, key, limit + 1)
+        page = []
+        for score, usage_id in found[:limit]:
+            try:
+                usage = usage_index.get(usage_id)
+            except KeyError:                 # index ahead of the loaded corpus
+                continue
+            page.append({'usage_id': usage.usage_id, 'lang': usage.language,
+                         'secret_word': usage.secret_word,
+                         'usage': usage.usage.replace('{word}', usage.secret_word),
+                         'source': usage.source})
+        return {'usages': page,
+                'next': encode_cursor(found[limit - 1]) if len(found) > limit else None}
@@ -0,0 +1,114 @@
+import base64
+import datetime
+import json
+
+from flask import g, request
+from flask_restplus import Resource, Namespace
+from sqlalchemy import tuple_
+import flask_jwt_extended as JWT
+
+from .game_store import game_store
+from .langman_orm import User, Game
+from .tokens import tokens
+from .usage_index import usage_index
+from .util import date_to_ordinal
+
+users_api = Namespace('users', description='Player history and statistics')
+
+def encode_cursor(game):
+    '''Return an opaque page cursor for the position after ``game``'''
+    return base64.urlsafe_b64encode(json.dumps(
+        [game.start_time.isoformat(), game.game_id]).encode()).decode()
+
+def decode_cursor(cursor):
+    '''Return the ``(start_time, game_id)`` key encoded in ``cursor``'''
+    start_time, game_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return datetime.datetime.fromisoformat(start_time), game_id
+
+def _seconds(interval):
+    return None if interval is None else interval.total_seconds()
+
+@users_api.route('/me/games')
+class MyGames(Resource):
+    max_limit = 100
+    @tokens.jwt_required
+    def get(self):
+        '''List the player's games, most recent first
+
+        :route: ``/me/games`` GET (valid token required)
+
+        :query:
+              * ``limit`` Number of games per page (default 20, at most 100)
+              * ``after`` The ``next`` cursor from the previous page
+
+        :returns:
+           A page of games:
+              * ``games`` List of game objects as from ``/api/games/<game_id>``
+                GET, without the usage sentence, plus ``lang`` and, for
+                finished games, ``secret_word``
+              * ``next`` Cursor for the following page, or null on the last
+
+        Pages are found by keyset on ``(start_time, game_id)`` using the
+        ``(player, start_time, game_id)`` index, so each page costs the same
+        however far back it is.
+        '''
+        try:
+            limit = min(int(request.args.get('limit', 20)), self.max_limit)
+            after = request.args.get('after')
+            key = decode_cursor(after) if after else None
+        except (ValueError, TypeError):
+            users_api.abort(400, 'Invalid limit or after cursor')
+        if limit < 1:
+            users_api.abort(400, 'Invalid limit or after cursor')
+
+        query = g.games_db.query(Game).filter(Game.player == JWT.get_jwt_identity())
+        if key is not None:
+            query = query.filter(tuple_(Game.start_time, Game.game_id) < key)
+        games = query.order_by(Game.start_time.desc(), Game.game_id.desc()) \
+                     .limit(limit + 1).all()
+
+        page = []
+        for game in games[:limit]:
+            if game.end_time is None:        # active games may be ahead in the cache
+                game = game_store.cached(game.game_id) or game
+            usage = usage_index.get(game.usage_id)
+            game_dict = game._to_dict(usage=usage)
+            game_dict['lang'] = usage.language
+            if game_dict['result'] != 'active':
+                game_dict['secret_word'] = usage.secret_word
+            page.append(game_dict)
+        return {'games': page,
+                'next': encode_cursor(games[limit - 1]) if len(games) > limit else None}
+
+@users_api.route('/me/stats')
+class MyStats(Resource):
+    @tokens.jwt_required
+    def get(self):
+        '''Get the player's game statistics
+
+        :route: ``/me/stats`` GET (valid token required)
+
+        :returns:
+           The player's totals, read from their ``users`` record:
+              * ``user_id`` The player's UUID
+              * ``num_games`` Number of games started
+              * ``outcomes`` Game counts by outcome ('active', 'won', 'lost',
+                'abandoned')
+              * ``by_lang`` Game counts by language
+              * ``first_time`` The epoch ordinal time of the first game
+              * ``total_time`` Seconds spent in finished games
+              * ``avg_time`` Average seconds per game
+        '''
+        user_id = JWT.get_jwt_identity()
+        user = g.games_db.query(User).filter(User.user_id == user_id).one_or_none()
+        if user is None:
+            user = User(user_id=user_id, num_games=0)
+        return {
+            'user_id':    user_id,
+            'num_games':  user.num_games or 0,
+            'outcomes':   user.outcomes,
+            'by_lang':    user.by_lang,
+            'first_time': date_to_ordinal(user.first_time),
+            'total_time': _seconds(user.total_time),
+            'avg_time':   _seconds(user.avg_time),
+        }